@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+"""
+Bulk administration of the bot database. The running bot picks up the changes after its next Long Poll request.
+
+    ./admin.py enable pidors --all
+    ./admin.py disable hardbass --chats 12,15,40
+    ./admin.py enable pidors --file chats.txt      # one chat id per line, "-" for stdin
+    ./admin.py export > chats.jsonl
+    ./admin.py import --replace < chats.jsonl
+
+Export format is one JSON object per line: {"chat_id": 12, "features": ["pidors"]}
+"""
+
+import argparse
+import json
+import sys
+
+from ubotvk.config import Config
+from ubotvk.database import Database
+
+
+DB_FILE = 'data/bot_db.sqlite3'
+
+
+def read_chat_ids(args, db):
+    if args.all:
+        return db.get_chats()
+    if args.chats:
+        return [int(chat) for chat in args.chats.split(',')]
+
+    file = sys.stdin if args.file == '-' else open(args.file, 'r')
+    with file:
+        return [int(line) for line in file if line.strip()]
+
+
+def set_feature(args, db, enabled):
+    if Config.INSTALLED_FEATURES and args.feature not in Config.INSTALLED_FEATURES:
+        sys.exit('Feature "{}" is not installed. Installed features: {}'.format(
+            args.feature, ', '.join(Config.INSTALLED_FEATURES)))
+    if not enabled and args.feature in Config.DEFAULT_FEATURES:
+        sys.exit('Feature "{}" is on by default and can not be disabled in the database'.format(args.feature))
+
+    changed = db.set_feature(read_chat_ids(args, db), args.feature, enabled=enabled)
+    print('{} {} for {} chats'.format('Enabled' if enabled else 'Disabled', args.feature, changed),
+          file=sys.stderr)
+
+
+def export_features(args, db):
+    file = sys.stdout if args.output == '-' else open(args.output, 'w')
+    with file:
+        for chat_id, features in db.iter_features():
+            file.write(json.dumps({'chat_id': chat_id, 'features': features}, separators=(',', ':')) + '\n')
+
+
+def import_features(args, db):
+    file = sys.stdin if args.input == '-' else open(args.input, 'r')
+    with file:
+        rows = (json.loads(line) for line in file if line.strip())
+        count = db.import_features(((row['chat_id'], row['features']) for row in rows), replace=args.replace)
+    print('Imported {} chats'.format(count), file=sys.stderr)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='UbotVK administration')
+    parser.add_argument('--db', default=DB_FILE, help='Path to the bot database, default: ' + DB_FILE)
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    for name in ['enable', 'disable']:
+        command = commands.add_parser(name, help='{} a feature for many chats at once'.format(name.capitalize()))
+        command.add_argument('feature')
+        chats = command.add_mutually_exclusive_group(required=True)
+        chats.add_argument('--all', action='store_true', help='All chats in the database')
+        chats.add_argument('--chats', help='Comma separated chat ids')
+        chats.add_argument('--file', help='File with one chat id per line, "-" for stdin')
+
+    command = commands.add_parser('export', help='Write chats and their features as JSON lines')
+    command.add_argument('--output', default='-', help='Output file, stdout by default')
+
+    command = commands.add_parser('import', help='Read chats and their features from JSON lines')
+    command.add_argument('--input', default='-', help='Input file, stdin by default')
+    command.add_argument('--replace', action='store_true',
+                         help='Replace features of chats that are already in the database instead of merging')
+
+    args = parser.parse_args(argv)
+    db = Database(args.db, source='admin')
+
+    if args.command == 'enable':
+        set_feature(args, db, enabled=True)
+    elif args.command == 'disable':
+        set_feature(args, db, enabled=False)
+    elif args.command == 'export':
+        export_features(args, db)
+    elif args.command == 'import':
+        import_features(args, db)
+
+
+if __name__ == '__main__':
+    main()
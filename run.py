@@ -1,9 +1,13 @@
 #!/usr/bin/env python
 
+import signal
+
 from ubotvk.bot import Bot
 
 
 bot = Bot()
+signal.signal(signal.SIGTERM, bot.request_stop)
+signal.signal(signal.SIGHUP, bot.request_reload)
 
 try:
     bot.start_loop()
@@ -16,3 +20,6 @@ except Exception as err:
     """, exc_info=True)
     bot.crash_handler(exc=err)
     raise
+
+finally:
+    bot.shutdown()
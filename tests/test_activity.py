@@ -0,0 +1,36 @@
+import unittest
+
+from ubotvk.activity import ChatActivity, deep_size
+
+
+class TestActivity(unittest.TestCase):
+    def test_chat_activity(self):
+        now = [0]
+        activity = ChatActivity(clock=lambda: now[0])
+
+        now[0] = 10
+        activity.touch(1)
+        now[0] = 20
+        activity.touch(2)
+        now[0] = 30
+        activity.touch(1)
+
+        # Chats without updates count as active at start
+        self.assertListEqual(activity.coldest({1, 2, 3}), [3, 2, 1])
+        self.assertEqual(activity.idle_for(2), 10)
+        self.assertEqual(activity.idle_for(3), 30)
+
+        now[0] = 45
+        activity.prune(max_idle=20)
+        self.assertListEqual(list(activity), [1])
+        self.assertListEqual(activity.coldest({1, 2}), [2, 1])
+
+    def test_deep_size(self):
+        profile = {'id': 1, 'first_name': 'Ivan', 'last_name': 'Ivanov'}
+        self.assertGreater(deep_size({1: profile}), deep_size(profile))
+        # Shared objects are counted once
+        self.assertLess(deep_size([profile, profile]), 2 * deep_size([profile]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,263 @@
+import unittest
+
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from ubotvk import config
+from ubotvk.activity import ChatActivity
+from ubotvk.bot import Bot
+from ubotvk.config import Config, ConfigError
+from ubotvk.metrics import metrics
+from ubotvk.replay import StubVkApi
+from ubotvk.update import Update, peer_id
+
+MB = 1024 * 1024
+
+
+class StubFeature:
+    """
+    Keeps `sizes` bytes of state per chat
+    """
+
+    def __init__(self, sizes):
+        self.triggered_by = []
+        self.sizes = dict(sizes)
+        self.evicted = []
+
+    def evict_chat(self, chat_id):
+        self.evicted.append(chat_id)
+        return self.sizes.pop(chat_id, 0)
+
+    def memory_usage(self):
+        return sum(self.sizes.values())
+
+
+class BotTestCase(unittest.TestCase):
+    """
+    Creates a Bot with VK API stubbed out in a temporary directory
+    """
+    settings = {'INSTALLED_FEATURES': ('hardbass',), 'DEFAULT_FEATURES': ('hardbass',), 'DEBUG': False,
+                'RECORD_DIR': None, 'CALLBACK_PORT': None, 'SNAPSHOT_FILE': 'data/bot.snapshot',
+                'SNAPSHOT_INTERVAL': 0, 'DEDUP_PERSIST': False}
+
+    def setUp(self):
+        self.saved = {name: getattr(Config, name) for name in self.settings}
+        for name, value in self.settings.items():
+            setattr(Config, name, value)
+        self.cwd = os.getcwd()
+        self.workdir = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.workdir, 'data'))
+        os.chdir(self.workdir)
+        self.vk = StubVkApi()
+        self.bot = Bot(vk_api=self.vk)
+
+    def tearDown(self):
+        self.bot.shutdown(timeout=1)
+        os.chdir(self.cwd)
+        shutil.rmtree(self.workdir)
+        for name, value in self.saved.items():
+            setattr(Config, name, value)
+
+
+class TestCallbackConfig(BotTestCase):
+    def setUp(self):
+        super().setUp()
+        self.saved.update({name: getattr(Config, name)
+                           for name in ('CALLBACK_PORT', 'CALLBACK_GROUP_ID', 'CALLBACK_GROUP_TOKEN')})
+
+    def test_group_required(self):
+        Config.CALLBACK_PORT = 8080
+        Config.CALLBACK_GROUP_ID = None
+        with self.assertRaises(ConfigError):
+            Bot(vk_api=self.vk)
+
+        Config.CALLBACK_GROUP_ID = 2
+        Config.CALLBACK_GROUP_TOKEN = 'token'
+        bot = Bot(vk_api=self.vk)
+        try:
+            self.assertEqual(bot.vk_id, -2)
+            self.assertEqual(bot._mention, '[club2|')
+
+            # Commands mention the community
+            bot.new_chat(15)
+            self.vk.calls.clear()
+            bot.check_for_commands(Update.from_raw([4, 1, 0, peer_id(15), 0, '[club2|Bot] help', {'from': '5'}]))
+            self.assertEqual(self.vk.calls['messages.send'], 1)
+        finally:
+            bot.shutdown(timeout=1)
+
+
+class TestEviction(BotTestCase):
+    def setUp(self):
+        super().setUp()
+        self.saved['CHAT_IDLE_TTL'] = Config.CHAT_IDLE_TTL
+        self.saved['MEMORY_BUDGET'] = Config.MEMORY_BUDGET
+        Config.CHAT_IDLE_TTL = 5000
+
+        # Chat 1 is the least recently active, chat 5 had an update less than EVICT_MIN_IDLE seconds ago
+        self.now = [0]
+        self.bot.activity = ChatActivity(clock=lambda: self.now[0])
+        for chat_id, at in [(1, 0), (2, 100), (3, 8000), (4, 9000), (5, 9950)]:
+            self.now[0] = at
+            self.bot.activity.touch(chat_id)
+        self.now[0] = 10000
+        self.feature = StubFeature({chat_id: MB for chat_id in range(1, 6)})
+        self.bot.features = {'stub': self.feature}
+        self.bot._chats = {1, 2, 3, 4, 5}
+        metrics.reset()
+
+    def test_idle(self):
+        Config.MEMORY_BUDGET = 10
+        self.bot.evict_chats()
+        self.assertListEqual(self.feature.evicted, [1, 2])
+        self.assertEqual(metrics.get('chats.evicted'), 2)
+        self.assertEqual(metrics.get('memory.stub'), 3 * MB)
+        # Evicted chats are forgotten, they still count as idle
+        self.assertListEqual(list(self.bot.activity), [3, 4, 5])
+
+    def test_budget(self):
+        # Least recently active chats are evicted until the rest fits in the budget
+        Config.MEMORY_BUDGET = 2.5
+        self.bot.evict_chats()
+        self.assertListEqual(self.feature.evicted, [1, 2, 3])
+
+    def test_min_idle(self):
+        Config.MEMORY_BUDGET = 0.5
+        with self.assertLogs(level='WARNING') as logs:
+            self.bot.evict_chats()
+        self.assertListEqual(self.feature.evicted, [1, 2, 3, 4])
+        self.assertIn('memory budget is 0.5 MB', logs.output[0])
+
+
+class TestReload(BotTestCase):
+    def setUp(self):
+        super().setUp()
+        self.saved.update({name: getattr(Config, name) for name in config.RELOADABLE})
+        self.saved_file = config.CONFIG_FILE
+        config.CONFIG_FILE = os.path.join(self.workdir, 'config.json')
+
+    def tearDown(self):
+        config.CONFIG_FILE = self.saved_file
+        super().tearDown()
+
+    def reload(self, **settings):
+        conf = {'login': Config.LOGIN, 'password': Config.PASSWORD, 'maintainer_vk_id': Config.MAINTAINER_VK_ID,
+                'installed_features': list(Config.INSTALLED_FEATURES), 'on_by_default': list(Config.DEFAULT_FEATURES)}
+        conf.update(settings)
+        with open(config.CONFIG_FILE, 'w') as file:
+            json.dump(conf, file)
+        return config.reload()
+
+    def test_limits(self):
+        flood = self.bot.dispatcher.flood_control
+        flood.allow(1, 10)
+
+        # Flood buckets are kept when other limits change
+        self.assertIn('DEDUP_TTL', self.reload(dedup_ttl=10))
+        self.assertEqual(self.bot.dedup.ttl, 10)
+        self.assertEqual(len(flood), 2)
+
+        self.reload(dedup_ttl=10, flood_chat_burst=5)
+        self.assertEqual(flood.chat_burst, 5)
+        self.assertEqual(len(flood), 0)
+
+    def test_jobs(self):
+        self.assertIsNotNone(self.bot.scheduler._scheduler.get_job('bot.report_metrics'))
+        self.reload(metrics_interval=0)
+        self.assertIsNone(self.bot.scheduler._scheduler.get_job('bot.report_metrics'))
+
+    def test_command(self):
+        self.bot.handle_command(['reload'], 15, from_id=Config.MAINTAINER_VK_ID + 1)
+        self.assertEqual(self.vk.calls['messages.send'], 0)
+
+        self.bot.handle_command(['reload'], 15, from_id=Config.MAINTAINER_VK_ID)
+        self.assertEqual(self.vk.calls['messages.send'], 1)
+
+
+class TestDefaultFeatures(BotTestCase):
+    def restore(self, from_snapshot):
+        self.bot.save_snapshot()
+        if not from_snapshot:
+            os.remove(Config.SNAPSHOT_FILE)
+        bot = Bot(vk_api=self.vk)
+        try:
+            return {feature: set(chats) for feature, chats in bot.dict_feature_chats.items()}
+        finally:
+            bot.shutdown(timeout=1)
+
+    def test_removed(self):
+        self.bot.new_chat(15)
+        self.bot.new_chat(16)
+        self.bot.handle_command(['off', 'hardbass'], 15)
+        expected = {'hardbass': {16}}
+
+        self.assertDictEqual(self.restore(from_snapshot=True), expected)
+        self.assertDictEqual(self.restore(from_snapshot=False), expected)
+
+        # Changes made by another process
+        self.bot._db_version = 0
+        self.bot.dict_feature_chats['hardbass'].add(15)
+        self.bot.sync_changes(exclude_source=None)
+        self.assertDictEqual(self.bot.dict_feature_chats, expected)
+
+        self.bot.handle_command(['on', 'hardbass'], 15)
+        expected = {'hardbass': {15, 16}}
+        self.assertDictEqual(self.restore(from_snapshot=True), expected)
+        self.assertDictEqual(self.restore(from_snapshot=False), expected)
+
+
+class TestShutdown(BotTestCase):
+    def setUp(self):
+        super().setUp()
+        self.release = threading.Event()
+        self.handled = []
+
+    def tearDown(self):
+        self.release.set()
+        super().tearDown()
+
+    def handle(self, update):
+        self.handled.append(update.message_id)
+        if update.message_id == 2:
+            self.release.wait(5)
+
+    def long_poll(self, server, key, ts):
+        # Each response has one message, the bot stops after the second one
+        message_id = ts - 10
+        yield [4, message_id, 1, peer_id(1), 0, 'text', {'from': '1'}, {}]
+        self.bot.ts = ts + 1
+        if message_id == 2:
+            self.bot.request_stop()
+
+    def test_timeout(self):
+        Config.DEDUP_PERSIST = True
+        self.bot.ts = 11
+        self.bot.dispatcher.handler = self.handle
+        self.bot.long_poll = self.long_poll
+        self.bot.start_loop()
+        while self.handled != [1, 2]:
+            time.sleep(0.01)
+
+        self.bot.shutdown(timeout=0.1)
+        # The second update is still handled, so the snapshot and ts after it are not saved
+        self.assertFalse(os.path.exists(Config.SNAPSHOT_FILE))
+        self.assertEqual(self.bot.db.pop_state('long_poll')['ts'], 12)
+        dedup = self.bot.db.pop_state('dedup')
+        self.assertEqual(len(dedup), 1)
+
+    def test_drained(self):
+        self.bot.ts = 11
+        self.bot.long_poll = self.long_poll
+        self.bot.start_loop()
+
+        self.bot.shutdown(timeout=5)
+        self.assertTrue(os.path.exists(Config.SNAPSHOT_FILE))
+        self.assertEqual(self.bot.db.pop_state('long_poll')['ts'], 13)
+
+
+if __name__ == '__main__':
+    unittest.main()
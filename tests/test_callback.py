@@ -0,0 +1,62 @@
+import unittest
+
+from ubotvk.callback import CallbackServer, CallbackClient
+from ubotvk.update import peer_id
+
+
+class TestCallback(unittest.TestCase):
+    def setUp(self):
+        self.server = CallbackServer(host='127.0.0.1', port=0, confirmation='a1b2c3', secret='s3cret', queue_size=2)
+        self.server.start()
+        self.client = CallbackClient(self.server.url, secret='s3cret')
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_confirmation(self):
+        self.assertEqual(self.client.confirm(), 'a1b2c3')
+
+    def test_secret(self):
+        response = CallbackClient(self.server.url, secret='wrong').message(peer_id(1), 'test')
+        self.assertEqual(response.status_code, 403)
+        self.assertListEqual(self.server.get_batch(timeout=0.1), [])
+
+    def test_message(self):
+        response = self.client.message(peer_id(15), ' [id1|Bot] help ', from_id=212771532, message_id=10,
+                                       attachments=[{'type': 'audio', 'audio': {'owner_id': 1, 'id': 2}}])
+        self.assertEqual(response.text, 'ok')
+        self.client.message(peer_id(15), '', from_id=212771532, message_id=11,
+                            action={'type': 'chat_invite_user', 'member_id': 123})
+
+        first, second = self.server.get_batch(timeout=1)
+        self.assertEqual(first.code, 4)
+        self.assertEqual(first.chat_id, 15)
+        self.assertEqual(first.message_id, 10)
+        self.assertEqual(first.from_id, 212771532)
+        self.assertEqual(first.text, '[id1|Bot] help')
+        self.assertTrue(first.is_inbox)
+        self.assertDictEqual(first.attachments, {'attach1_type': 'audio', 'attach1': '1_2'})
+
+        self.assertEqual(second.action, 'chat_invite_user')
+        self.assertEqual(second.action_member_id, 123)
+
+    def test_full_queue(self):
+        for message_id in range(2):
+            self.assertEqual(self.client.message(peer_id(1), 'test', message_id=message_id).status_code, 200)
+        self.assertEqual(self.client.message(peer_id(1), 'test', message_id=3).status_code, 503)
+        self.assertEqual(len(self.server.get_batch(timeout=1)), 2)
+
+    def test_group(self):
+        self.server.group_id = 2
+        self.assertEqual(self.client.message(peer_id(1), 'test').status_code, 403)
+        self.assertEqual(CallbackClient(self.server.url, secret='s3cret', group_id=2).message(peer_id(1), 'test').text,
+                         'ok')
+        self.assertEqual(len(self.server.get_batch(timeout=1)), 1)
+
+    def test_other_events(self):
+        self.assertEqual(self.client.send('group_join', {'user_id': 1}).text, 'ok')
+        self.assertListEqual(self.server.get_batch(timeout=0.1), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
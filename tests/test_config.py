@@ -0,0 +1,90 @@
+import json
+import os
+import tempfile
+import unittest
+
+from ubotvk import config
+from ubotvk.config import Config, ConfigError
+
+
+class TestConfig(unittest.TestCase):
+    def setUp(self):
+        self.saved = dict(vars(Config))
+        self.saved_file = config.CONFIG_FILE
+        fd, config.CONFIG_FILE = tempfile.mkstemp(suffix='.json')
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(config.CONFIG_FILE)
+        config.CONFIG_FILE = self.saved_file
+        for name, value in self.saved.items():
+            if name.isupper():
+                setattr(Config, name, value)
+
+    def write(self, **settings):
+        conf = {'login': 'login', 'password': 'password', 'maintainer_vk_id': 1}
+        conf.update(settings)
+        with open(config.CONFIG_FILE, 'w') as file:
+            json.dump(conf, file)
+
+    def test_reload(self):
+        calls = []
+        callback = calls.append
+        config.subscribe(callback, 'FLOOD_CHAT_RATE')
+        try:
+            self.write(flood_chat_rate=Config.FLOOD_CHAT_RATE + 1, log_level=Config.LOG_LEVEL)
+            changes = config.reload()
+        finally:
+            config.unsubscribe(callback)
+
+        self.assertEqual(changes['FLOOD_CHAT_RATE'], self.saved['FLOOD_CHAT_RATE'] + 1)
+        self.assertEqual(Config.FLOOD_CHAT_RATE, self.saved['FLOOD_CHAT_RATE'] + 1)
+        self.assertListEqual(calls, [{'FLOOD_CHAT_RATE': self.saved['FLOOD_CHAT_RATE'] + 1}])
+        # Settings that need a restart are not changed
+        self.assertEqual(Config.LOGIN, self.saved['LOGIN'])
+        self.assertFalse(config.file_changed())
+
+        config.subscribe(callback, 'FLOOD_CHAT_RATE')
+        try:
+            self.assertNotIn('FLOOD_CHAT_RATE', config.reload())
+        finally:
+            config.unsubscribe(callback)
+        self.assertEqual(len(calls), 1)
+
+    def test_invalid(self):
+        self.write(flood_chat_rate=0)
+        with self.assertRaises(ConfigError):
+            config.reload()
+
+        self.write(pidors_send_hour=24, log_level='LOUD')
+        with self.assertRaises(ConfigError):
+            config.reload()
+
+        with open(config.CONFIG_FILE, 'w') as file:
+            file.write('{"login": ')
+        with self.assertRaises(ConfigError):
+            config.reload()
+
+        self.assertEqual(Config.FLOOD_CHAT_RATE, self.saved['FLOOD_CHAT_RATE'])
+        self.assertEqual(Config.PIDORS_SEND_HOUR, self.saved['PIDORS_SEND_HOUR'])
+
+    def test_invalid_on_start(self):
+        self.write(dedup_size=0)
+        with self.assertRaises(ConfigError):
+            config.load()
+        self.assertEqual(Config.DEDUP_SIZE, self.saved['DEDUP_SIZE'])
+
+        # Without config.json settings are read from the environment
+        os.remove(config.CONFIG_FILE)
+        os.environ['UBOTVK_DEDUP_SIZE'] = '0'
+        try:
+            with self.assertRaises(ConfigError):
+                config.load()
+        finally:
+            del os.environ['UBOTVK_DEDUP_SIZE']
+            self.write()
+        self.assertEqual(Config.DEDUP_SIZE, self.saved['DEDUP_SIZE'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -5,6 +5,7 @@ import sqlite3
 import json
 
 from ubotvk.bot import Database
+from ubotvk.config import Config
 
 
 class TestDatabase(unittest.TestCase):
@@ -172,6 +173,85 @@ class TestDatabase(unittest.TestCase):
         self.assertTrue(len(chats) == 4)
         self.assertListEqual(chats, [self.test_id, self.test_id + 1, self.test_id + 2, self.test_id + 3])
 
+    def test_set_feature(self):
+        self.db.add_chat(self.test_id + 1)
+        self.db.add_feature(self.test_id + 1, self.test_feature)
+
+        # Chat test_id + 1 already has the feature, test_id + 2 is not in the database yet
+        changed = self.db.set_feature([self.test_id, self.test_id + 1, self.test_id + 2], self.test_feature)
+        self.assertEqual(changed, 2)
+        for chat_id in [self.test_id, self.test_id + 1, self.test_id + 2]:
+            self.assertListEqual(self.db.get_chat_features(chat_id), [self.test_feature])
+
+        changed = self.db.set_feature([self.test_id, self.test_id + 3], self.test_feature, enabled=False)
+        self.assertEqual(changed, 1)
+        self.assertListEqual(self.db.get_chat_features(self.test_id), [])
+        self.assertIsNone(self.db.get_chat_features(self.test_id + 3))
+
+    def test_get_chats_features(self):
+        saved = Config.DEFAULT_FEATURES
+        Config.DEFAULT_FEATURES = ('default',)
+        try:
+            self.db.set_feature(range(self.test_id, self.test_id + 1000), self.test_feature)
+            self.db.disable_default(self.test_id + 1, 'default')
+            features = self.db.get_chats_features(range(self.test_id, self.test_id + 1001))
+        finally:
+            Config.DEFAULT_FEATURES = saved
+
+        # Chats are read in several queries, the one that is not in the database is left out
+        self.assertEqual(len(features), 1000)
+        self.assertSetEqual(features[self.test_id], {self.test_feature, 'default'})
+        self.assertSetEqual(features[self.test_id + 1], {self.test_feature})
+
+    def test_export_import(self):
+        self.db.add_feature(self.test_id, self.test_feature)
+        self.assertListEqual(list(self.db.iter_features()), [(self.test_id, [self.test_feature])])
+
+        rows = [(self.test_id, [self.test_feature + '1']), (self.test_id + 1, [self.test_feature])]
+        self.assertEqual(self.db.import_features(rows), 2)
+        self.assertListEqual(list(self.db.iter_features()),
+                             [(self.test_id, [self.test_feature, self.test_feature + '1']),
+                              (self.test_id + 1, [self.test_feature])])
+
+        self.db.import_features([(self.test_id, [self.test_feature + '1'])], replace=True)
+        self.assertListEqual(self.db.get_chat_features(self.test_id), [self.test_feature + '1'])
+
+    def test_get_changes_since(self):
+        version = self.db.get_version()
+        admin_db = Database(self.db_file, source='admin')
+
+        self.db.add_feature(self.test_id, self.test_feature)
+        admin_db.set_feature([self.test_id + 1, self.test_id + 2], self.test_feature)
+
+        new_version, chats = self.db.get_changes_since(version, exclude_source='bot')
+        self.assertSetEqual(chats, {self.test_id + 1, self.test_id + 2})
+        self.assertEqual(new_version, self.db.get_version())
+
+        _, chats = self.db.get_changes_since(version)
+        self.assertSetEqual(chats, {self.test_id, self.test_id + 1, self.test_id + 2})
+
+        self.assertEqual(self.db.get_changes_since(new_version), (new_version, set()))
+
+    def test_prune_changelog(self):
+        self.db.set_feature([self.test_id], self.test_feature)
+        version = self.db.get_version()
+        self.db.set_feature([self.test_id + 1], self.test_feature)
+
+        self.assertGreater(self.db.prune_changelog(version), 0)
+        self.assertEqual(self.db.prune_changelog(version), 0)
+        self.assertEqual(self.db.get_changes_since(version), (version + 1, {self.test_id + 1}))
+
+        # The last change is kept, so the version doesn't go back
+        self.db.prune_changelog(self.db.get_version())
+        self.assertEqual(self.db.get_version(), version + 1)
+
+    def test_state(self):
+        self.assertIsNone(self.db.pop_state('long_poll'))
+        self.db.set_state('long_poll', {'ts': 1})
+        self.db.set_state('long_poll', {'ts': 2})
+        self.assertDictEqual(Database(self.db_file).pop_state('long_poll'), {'ts': 2})
+        self.assertIsNone(self.db.pop_state('long_poll'))
+
 
 if __name__ == '__main__':
     unittest.main()
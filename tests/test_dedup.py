@@ -0,0 +1,65 @@
+import unittest
+
+from ubotvk.dedup import DedupWindow
+from ubotvk.metrics import metrics
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestDedupWindow(unittest.TestCase):
+    def setUp(self):
+        metrics.reset()
+        self.clock = Clock()
+        self.dedup = DedupWindow(capacity=3, ttl=60, clock=self.clock)
+
+    def test_seen(self):
+        self.assertFalse(self.dedup.seen(2000000001, 1))
+        self.assertFalse(self.dedup.seen(2000000002, 1))
+        self.assertFalse(self.dedup.seen(-1, 1))
+        self.assertTrue(self.dedup.seen(2000000001, 1))
+        self.assertEqual(metrics.get('dedup.duplicates'), 1)
+
+        # Expired messages are forgotten
+        self.clock.now += 61
+        self.assertFalse(self.dedup.seen(2000000001, 1))
+
+    def test_capacity(self):
+        for i in range(10):
+            self.assertFalse(self.dedup.seen(2000000001, i))
+        self.assertEqual(len(self.dedup), 3)
+
+        self.assertTrue(self.dedup.seen(2000000001, 9))
+        self.assertFalse(self.dedup.seen(2000000001, 0))
+
+    def test_memory(self):
+        dedup = DedupWindow(capacity=1000, ttl=60, clock=self.clock)
+        for i in range(1000):
+            dedup.seen(2000000001, i)
+        memory = dedup.memory_usage()
+        for i in range(1000, 20000):
+            dedup.seen(2000000001, i)
+        # Only the dict of slots may be resized, arrays are allocated once
+        self.assertLess(dedup.memory_usage(), 2 * memory)
+
+    def test_dump_load(self):
+        self.dedup.seen(2000000001, 1)
+        self.clock.now += 50
+        self.dedup.seen(2000000001, 2)
+        self.dedup.seen(2000000001, 3)
+        self.clock.now += 20
+
+        restored = DedupWindow(capacity=3, ttl=60, clock=self.clock)
+        restored.load(self.dedup.dump())
+        self.assertEqual(len(restored), 2)
+        self.assertTrue(restored.seen(2000000001, 2))
+        self.assertFalse(restored.seen(2000000001, 1))
+
+
+if __name__ == '__main__':
+    unittest.main()
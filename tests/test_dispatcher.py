@@ -0,0 +1,93 @@
+import unittest
+
+import time
+
+from ubotvk.dispatcher import FairQueue, Dispatcher
+from ubotvk.flood import FloodControl
+from ubotvk.update import Update, peer_id
+
+
+def message(chat_id, message_id, from_id=1, action=None):
+    extra = {'from': str(from_id)}
+    if action:
+        extra['source_act'] = action
+    return Update.from_raw([4, message_id, 1, peer_id(chat_id), 0, '', extra, {}])
+
+
+class TestFairQueue(unittest.TestCase):
+    def test_round_robin(self):
+        queue = FairQueue()
+        for i in range(4):
+            queue.put('spam', 'spam{}'.format(i))
+        queue.put('a', 'a0')
+        queue.put('b', 'b0')
+        queue.put('a', 'a1')
+
+        order = [queue.get() for _ in range(len(queue))]
+        self.assertListEqual(order, ['spam0', 'a0', 'b0', 'spam1', 'a1', 'spam2', 'spam3'])
+        self.assertIsNone(queue.get())
+
+    def test_weights(self):
+        queue = FairQueue(weights={'a': 2})
+        for i in range(3):
+            queue.put('a', 'a{}'.format(i))
+            queue.put('b', 'b{}'.format(i))
+        self.assertListEqual([queue.get() for _ in range(6)], ['a0', 'a1', 'b0', 'a2', 'b1', 'b2'])
+
+    def test_load_shedding(self):
+        queue = FairQueue(max_backlog=4)
+        for i in range(4):
+            self.assertTrue(queue.put('spam', i))
+
+        # Over the backlog only chats below their fair share are accepted
+        self.assertFalse(queue.put('spam', 4))
+        self.assertTrue(queue.put('quiet', 0))
+        self.assertTrue(queue.put('spam', 5, priority=True))
+        self.assertEqual(len(queue), 6)
+
+
+class TestDispatcher(unittest.TestCase):
+    def test_dispatch(self):
+        handled = []
+        dispatcher = Dispatcher(handled.append, flood_control=FloodControl(chat_rate=0.001, chat_burst=2),
+                                is_priority=lambda update: update.action is not None)
+        dispatcher.start()
+
+        accepted = [dispatcher.submit(message(1, i, from_id=i)) for i in range(3)]
+        self.assertListEqual(accepted, [True, True, False])
+        # Service messages are not limited
+        self.assertTrue(dispatcher.submit(message(1, 3, action='chat_invite_user')))
+        self.assertTrue(dispatcher.submit(message(2, 4)))
+
+        dispatcher.call(handled.append, 'call')
+        self.assertTrue(dispatcher.wait_idle(timeout=5))
+        dispatcher.stop(timeout=5)
+
+        self.assertListEqual(sorted(u.message_id for u in handled if u != 'call'), [0, 1, 3, 4])
+        self.assertIn('call', handled)
+
+    def test_stop_drains(self):
+        handled = []
+        dispatcher = Dispatcher(lambda update: (time.sleep(0.01), handled.append(update)))
+        dispatcher.start()
+        for i in range(20):
+            dispatcher.submit(message(i % 3, i))
+        dispatcher.stop(timeout=5)
+
+        self.assertFalse(dispatcher.is_alive())
+        self.assertEqual(len(handled), 20)
+
+    def test_handler_error(self):
+        def handler(update):
+            raise RuntimeError('test')
+
+        dispatcher = Dispatcher(handler)
+        dispatcher.start()
+        dispatcher.submit(message(1, 1))
+        self.assertTrue(dispatcher.wait_idle(timeout=5))
+        with self.assertRaises(RuntimeError):
+            dispatcher.submit(message(1, 2))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,50 @@
+import unittest
+
+from ubotvk.flood import TokenBucket, FloodControl
+
+
+class TestFlood(unittest.TestCase):
+    def test_token_bucket(self):
+        bucket = TokenBucket(rate=1, capacity=3, now=0)
+        self.assertListEqual([bucket.consume(0) for _ in range(4)], [True, True, True, False])
+        self.assertTrue(bucket.consume(1))
+        self.assertFalse(bucket.consume(1))
+
+        # Bucket is never refilled over capacity
+        self.assertListEqual([bucket.consume(100) for _ in range(4)], [True, True, True, False])
+
+    def test_flood_control(self):
+        now = [0]
+        flood = FloodControl(chat_rate=1, chat_burst=3, user_rate=1, user_burst=2, clock=lambda: now[0])
+
+        # User limit
+        self.assertListEqual([flood.allow(1, 10) for _ in range(3)], [True, True, False])
+        # Chat limit, another user in the same chat
+        self.assertListEqual([flood.allow(1, 11) for _ in range(2)], [True, False])
+        # Other chats are not affected
+        self.assertTrue(flood.allow(2, 12))
+
+        now[0] = 2
+        self.assertTrue(flood.allow(1, 10))
+
+    def test_prune(self):
+        now = [0]
+        flood = FloodControl(chat_rate=1, chat_burst=2, user_rate=1, user_burst=2, clock=lambda: now[0])
+        flood.allow(1, 10)
+        flood.allow(2, 20)
+        self.assertEqual(len(flood), 4)
+
+        now[0] = 10
+        flood.prune()
+        self.assertEqual(len(flood), 0)
+
+    def test_configure(self):
+        flood = FloodControl(chat_rate=1, chat_burst=1, user_rate=1, user_burst=1, clock=lambda: 0)
+        self.assertListEqual([flood.allow(1, 10) for _ in range(2)], [True, False])
+
+        flood.configure(chat_rate=1, chat_burst=3, user_rate=1, user_burst=3)
+        self.assertListEqual([flood.allow(1, 10) for _ in range(4)], [True, True, True, False])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,103 @@
+import threading
+import unittest
+
+import requests
+
+from ubotvk.bot_features.forward_messages import ForwardMessages
+from ubotvk.config import Config
+from ubotvk.update import Update, peer_id
+
+
+class StubVkApi:
+    """
+    Records sent messages. Calls take items of self.errors first: an exception is raised, None is a successful call
+    """
+
+    def __init__(self):
+        self.sent = []
+        self.errors = []
+        self.called = threading.Event()
+        self.messages = self
+
+    def send(self, peer_id, message):
+        self.called.set()
+        error = self.errors.pop(0) if self.errors else None
+        if error is not None:
+            raise error
+        self.sent.append(message)
+
+
+class TestForwardMessages(unittest.TestCase):
+    settings = {'FORWARD_DIGEST': True, 'FORWARD_DIGEST_SIZE': 3, 'FORWARD_DIGEST_INTERVAL': 60,
+                'FORWARD_BUFFER_LIMIT': 5, 'FORWARD_CHATS': None, 'FORWARD_IGNORE_CHATS': (), 'MAINTAINER_VK_ID': 1}
+
+    def setUp(self):
+        self.saved = {name: getattr(Config, name) for name in self.settings}
+        for name, value in self.settings.items():
+            setattr(Config, name, value)
+        self.vk = StubVkApi()
+        self.forward = ForwardMessages(self.vk)
+
+    def tearDown(self):
+        self.forward.shutdown()
+        for name, value in self.saved.items():
+            setattr(Config, name, value)
+
+    def test_digest(self):
+        self.forward(Update.from_raw([4, 1, 0, peer_id(15), 0, 'hello', {'from': '5'}]))
+        self.forward.add('b')
+        self.assertListEqual(self.vk.sent, [])
+
+        # Digest is sent when it's full
+        self.forward.add('c')
+        self.assertEqual(len(self.vk.sent), 1)
+        self.assertTrue(self.vk.sent[0].endswith('\nb\nc'))
+
+        self.forward.add('d')
+        self.forward.flush()
+        self.assertListEqual(self.vk.sent[1:], ['d'])
+        self.forward.flush()
+        self.assertEqual(len(self.vk.sent), 2)
+
+    def test_interval(self):
+        Config.FORWARD_DIGEST_INTERVAL = 0.01
+        self.forward.add('a')
+        self.assertTrue(self.vk.called.wait(5))
+        self.forward.shutdown()
+        self.assertListEqual(self.vk.sent, ['a'])
+
+    def test_buffer_limit(self):
+        self.vk.errors = [requests.ConnectionError()]
+        for message in 'abc':
+            self.forward.add(message)
+        self.assertListEqual(self.vk.sent, [])
+
+        # While digests are failing messages wait for the timer, messages over the limit are dropped
+        for message in 'defghij':
+            self.forward.add(message)
+        self.assertEqual(self.forward.dropped, 2)
+
+        self.forward.shutdown()
+        self.assertListEqual(self.vk.sent, ['a\nb\nc', 'd\ne\nf\n\nDropped 2 messages, buffer was full', 'g\nh'])
+
+    def test_partial_failure(self):
+        Config.FORWARD_DIGEST_SIZE = 2
+        long_message = 'x' * 4000
+        self.vk.errors = [None, requests.ConnectionError()]
+        self.forward.add(long_message)
+        self.forward.add(long_message)
+        self.assertEqual(len(self.vk.sent), 1)
+
+        # Only the part that was not sent is sent again
+        self.forward.flush()
+        self.assertListEqual(self.vk.sent, [long_message, long_message])
+
+    def test_shutdown(self):
+        self.forward.add('a')
+        self.forward.shutdown()
+        self.assertListEqual(self.vk.sent, ['a'])
+        self.assertIsNone(self.forward._timer)
+
+
+if __name__ == '__main__':
+    unittest.main()
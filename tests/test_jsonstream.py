@@ -0,0 +1,60 @@
+import unittest
+
+import json
+
+from ubotvk.jsonstream import LongPollStream
+
+
+RESPONSE = {
+    'ts': 1820350874,
+    'updates': [
+        [4, 1010, 1, 2000000015, 1539000000, 'Привет, "мир" [] {} \\ ', {'from': '212771532', 'title': ' ... '}, {}],
+        [4, 1011, 1, 2000000015, 1539000001, '', {'source_act': 'chat_invite_user', 'source_mid': '123'},
+         {'attach1_type': 'audio'}],
+        [8, -212771532, 1, 1539000002],
+    ]
+}
+
+
+def chunked(text, size):
+    data = text.encode('utf-8')
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+class TestLongPollStream(unittest.TestCase):
+    def test_whole_response(self):
+        stream = LongPollStream([json.dumps(RESPONSE)])
+        self.assertListEqual(list(stream), RESPONSE['updates'])
+        self.assertDictEqual(stream.fields, {'ts': RESPONSE['ts']})
+
+    def test_chunked_response(self):
+        # Chunk boundaries fall inside strings, escape sequences, multibyte characters and numbers
+        for text in [json.dumps(RESPONSE), json.dumps(RESPONSE, ensure_ascii=False, indent=2)]:
+            for size in [1, 2, 3, 7, 64]:
+                stream = LongPollStream(chunked(text, size))
+                self.assertListEqual(list(stream), RESPONSE['updates'])
+                self.assertDictEqual(stream.fields, {'ts': RESPONSE['ts']})
+
+    def test_updates_are_yielded_before_response_is_read(self):
+        text = json.dumps({'ts': 1, 'updates': [[4, 1], [4, 2]]})
+        chunks = iter(chunked(text, 5))
+        stream = iter(LongPollStream(chunks))
+        self.assertListEqual(next(stream), [4, 1])
+        self.assertTrue(len(list(chunks)) > 0)
+
+    def test_failed_response(self):
+        stream = LongPollStream(chunked('{"failed":1,"ts":30}', 4))
+        self.assertListEqual(list(stream), [])
+        self.assertDictEqual(stream.fields, {'failed': 1, 'ts': 30})
+
+        stream = LongPollStream(['{"failed":2}'])
+        self.assertListEqual(list(stream), [])
+        self.assertDictEqual(stream.fields, {'failed': 2})
+
+    def test_truncated_response(self):
+        with self.assertRaises(ValueError):
+            list(LongPollStream(['{"ts": 1, "updates": [[4, 1']))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,45 @@
+import unittest
+
+import logging
+import queue
+
+from ubotvk import log
+
+
+class TestLog(unittest.TestCase):
+    def test_event(self):
+        self.assertEqual(str(log.Event('chat_added', chat_id=123, feature='pidors')),
+                         'chat_added chat_id=123 feature=pidors')
+        self.assertEqual(str(log.Event('started')), 'started')
+
+    def test_sampling_filter(self):
+        log_filter = log.SamplingFilter(every=3)
+
+        sampled = [log_filter.filter(self.make_record(sample='update')) for _ in range(7)]
+        self.assertListEqual(sampled, [True, False, False, True, False, False, True])
+
+        # Records of different events are counted separately
+        self.assertTrue(log_filter.filter(self.make_record(sample='feature_call')))
+
+        # Records without "sample" are never dropped
+        self.assertTrue(all(log_filter.filter(self.make_record()) for _ in range(5)))
+
+    def test_deferred_args(self):
+        log_queue = queue.Queue()
+        handler = log.DeferredQueueHandler(log_queue)
+        chats = [1]
+        record = logging.LogRecord('test', logging.INFO, __file__, 0, 'chats %s, %s', (chats, log.Event('e')), None)
+        handler.handle(record)
+        chats.append(2)
+
+        self.assertEqual(log_queue.get_nowait().getMessage(), 'chats [1], e')
+
+    @staticmethod
+    def make_record(**extra):
+        record = logging.LogRecord('test', logging.DEBUG, __file__, 0, 'msg', None, None)
+        record.__dict__.update(extra)
+        return record
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,209 @@
+import unittest
+
+import os
+import shutil
+import tempfile
+from datetime import date, datetime
+from pytz import utc
+
+from ubotvk.bot_features.pidors.pidors import Database, Pidors, period_key
+from ubotvk.replay import StubVkApi
+from ubotvk.update import Update, peer_id
+
+
+class TestPidorsDatabase(unittest.TestCase):
+    db_file = 'test_pidors.sqlite'
+    chat_id = 15
+
+    def setUp(self):
+        try:
+            os.remove(self.db_file)
+        except OSError:
+            pass
+
+        self.db = Database(self.db_file)
+
+    def tearDown(self):
+        os.remove(self.db_file)
+
+    def test_period_key(self):
+        day = date(2018, 12, 31)
+        self.assertEqual(period_key('day', day), '2018-12-31')
+        self.assertEqual(period_key('week', day), '2019-W01')
+        self.assertEqual(period_key('month', day), '2018-12')
+        self.assertEqual(period_key('all', day), 'all')
+
+    def test_add_selection(self):
+        self.assertTrue(self.db.add_selection(self.chat_id, date(2018, 10, 1), 1))
+        self.assertTrue(self.db.add_selection(self.chat_id, date(2018, 10, 2), 1))
+        self.assertTrue(self.db.add_selection(self.chat_id, date(2018, 11, 1), 2))
+        self.assertTrue(self.db.add_selection(self.chat_id + 1, date(2018, 10, 1), 1))
+
+        # One selection per chat per day
+        self.assertFalse(self.db.add_selection(self.chat_id, date(2018, 10, 1), 2))
+
+        self.assertDictEqual(self.db.get_leaderboard(self.chat_id), {1: 2, 2: 1})
+        self.assertDictEqual(self.db.get_leaderboard(self.chat_id, 'month', '2018-10'), {1: 2})
+        self.assertDictEqual(self.db.get_leaderboard(self.chat_id, 'month', '2018-11'), {2: 1})
+        self.assertDictEqual(self.db.get_leaderboard(self.chat_id, 'week', '2018-W40'), {1: 2})
+        self.assertDictEqual(self.db.get_leaderboard(self.chat_id + 1), {1: 1})
+
+        self.assertEqual(self.db.get_count(self.chat_id, 1), 2)
+        self.assertEqual(self.db.get_count(self.chat_id, 3), 0)
+
+        self.assertListEqual(self.db.get_history(self.chat_id, since=date(2018, 10, 2)),
+                             [('2018-10-02', 1), ('2018-11-01', 2)])
+
+    def test_staged(self):
+        day = date(2018, 10, 1)
+        self.db.add_chat(self.chat_id)
+        self.db.stage(self.chat_id, day, 1, 'message')
+        self.db.stage(self.chat_id + 1, day, 2, 'message')
+        self.assertTrue(self.db.is_staged(self.chat_id, day))
+        self.assertFalse(self.db.is_staged(self.chat_id, date(2018, 10, 2)))
+
+        # Staged selection is not counted until it's sent
+        self.assertDictEqual(self.db.get_leaderboard(self.chat_id), {})
+        self.assertListEqual(self.db.get_unsent(), [(self.chat_id, day, 1, 'message'),
+                                                    (self.chat_id + 1, day, 2, 'message')])
+
+        self.db.mark_sent(self.chat_id, day, 1)
+        self.db.mark_expired(self.chat_id + 1, day)
+        self.assertListEqual(self.db.get_unsent(), [])
+        self.assertDictEqual(self.db.get_leaderboard(self.chat_id), {1: 1})
+        self.assertDictEqual(self.db.get_leaderboard(self.chat_id + 1), {})
+        self.assertEqual(self.db.get_last_pidor(self.chat_id), 1)
+
+    def test_timezone(self):
+        self.assertEqual(self.db.get_timezone(self.chat_id).zone, 'Europe/Moscow')
+        self.db.set_timezone(self.chat_id, 'Asia/Yekaterinburg')
+        self.assertEqual(self.db.get_timezone(self.chat_id).zone, 'Asia/Yekaterinburg')
+
+
+class TestPidorsCommands(unittest.TestCase):
+    chat_id = 15
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.workdir = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.workdir, 'data'))
+        os.chdir(self.workdir)
+        self.vk = StubVkApi()
+        self.pidors = Pidors(self.vk)
+
+    def tearDown(self):
+        self.pidors.shutdown()
+        os.chdir(self.cwd)
+        shutil.rmtree(self.workdir)
+
+    def send(self, text):
+        self.pidors(Update.from_raw([4, 1, 0, peer_id(self.chat_id), 0, text, {'from': '5'}]))
+
+    def test_set_timezone(self):
+        self.send('/pidortz Asia/Yekaterinburg')
+        self.assertEqual(self.pidors._chats_database.get_timezone(self.chat_id).zone, 'Asia/Yekaterinburg')
+        self.assertEqual(self.vk.calls['messages.send'], 1)
+
+        # Unknown zone is reported and the old one is kept
+        self.send('пидортз Mars/Olympus')
+        self.assertEqual(self.pidors._chats_database.get_timezone(self.chat_id).zone, 'Asia/Yekaterinburg')
+        self.assertEqual(self.vk.calls['messages.send'], 2)
+
+        self.send('/pidortz')
+        self.assertEqual(self.vk.calls['messages.send'], 3)
+
+    def test_chat_on_again(self):
+        database = self.pidors._chats_database
+        self.assertFalse(database.has_chat(self.chat_id))
+        self.pidors.new_chat(self.chat_id)
+        self.pidors.remove_chat(self.chat_id)
+        self.assertTrue(database.has_chat(self.chat_id))
+        self.assertSetEqual(database.chats, set())
+
+        self.pidors.new_chat(self.chat_id)
+        self.assertSetEqual(database.chats, {self.chat_id})
+        self.assertListEqual(database.get_all_chats(), [self.chat_id])
+
+    def test_legacy_count(self):
+        messages = []
+        call = self.vk.call
+        self.vk.call = lambda method, params: messages.append(params.get('message')) or call(method, params)
+
+        # Selected before Rollups were added, the count is only in Pidors_2
+        database = self.pidors._chats_database
+        database.add_chat(self.chat_id)
+        database.add_user(7)
+        for _ in range(3):
+            database.increment_pidor_count(7)
+        database.set_last_pidor(self.chat_id, 7)
+        self.pidors.pidor(self.chat_id)
+        self.assertIn('в 3 раз', messages[-1])
+
+        database.add_selection(self.chat_id, date(2018, 10, 1), 7)
+        self.pidors.pidor(self.chat_id)
+        self.assertIn('в 1 раз', messages[-1])
+
+    def set_now(self, *args):
+        now = datetime(*args, tzinfo=utc)
+        self.pidors._now = lambda tz: now.astimezone(tz)
+
+    def test_jobs(self):
+        database = self.pidors._chats_database
+        for chat_id in (1, 2, 3):
+            self.pidors.new_chat(chat_id)
+        database.set_timezone(2, 'Asia/Yekaterinburg')
+        database.set_timezone(3, 'America/New_York')
+
+        # 3:00 in Moscow, it's already past send hour in New York, so its pidor is for the next day
+        self.set_now(2018, 10, 1, 0)
+        self.pidors.stage_job()
+        self.assertListEqual([(chat, day) for chat, day, _, _ in database.get_unsent()],
+                             [(1, date(2018, 10, 1)), (2, date(2018, 10, 1)), (3, date(2018, 10, 1))])
+        self.pidors.stage_job()
+        self.assertEqual(len(database.get_unsent()), 3)
+
+        # 8:00 in Yekaterinburg, 6:00 in Moscow
+        self.set_now(2018, 10, 1, 3)
+        self.pidors.send_job()
+        self.assertEqual(self.vk.calls['messages.send'], 1)
+        self.assertListEqual([chat for chat, _, _, _ in database.get_unsent()], [1, 3])
+
+        self.set_now(2018, 10, 1, 5)
+        self.pidors.send_job()
+        self.assertEqual(self.vk.calls['messages.send'], 2)
+        self.assertEqual(sum(database.get_leaderboard(1).values()), 1)
+
+        # Chat that turned the feature off doesn't get its staged pidor
+        self.pidors.remove_chat(3)
+        self.set_now(2018, 10, 1, 13)
+        self.pidors.send_job()
+        self.assertEqual(self.vk.calls['messages.send'], 2)
+        self.assertDictEqual(database.get_leaderboard(3), {})
+        self.assertListEqual(database.get_unsent(), [])
+
+    def test_disabled_after_staging(self):
+        database = self.pidors._chats_database
+        self.pidors.new_chat(1)
+        self.set_now(2018, 10, 1, 0)
+        self.pidors.stage_job()
+
+        # Removed directly, without remove_chat hook
+        database.remove_chat(1)
+        self.set_now(2018, 10, 1, 5)
+        self.pidors.send_job()
+        self.assertEqual(self.vk.calls['messages.send'], 0)
+        self.assertDictEqual(database.get_leaderboard(1), {})
+        self.assertListEqual(database.get_unsent(), [])
+
+    def test_expired(self):
+        self.pidors.new_chat(1)
+        self.set_now(2018, 10, 1, 0)
+        self.pidors.stage_job()
+        self.set_now(2018, 10, 2, 10)
+        self.pidors.send_job()
+        self.assertEqual(self.vk.calls['messages.send'], 0)
+        self.assertListEqual(self.pidors._chats_database.get_unsent(), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,143 @@
+import unittest
+
+import os
+
+from ubotvk import recorder
+from ubotvk.config import Config
+from ubotvk.recorder import Anonymizer, Recorder
+from ubotvk.replay import StubVkApi, replay
+from ubotvk.update import Update
+
+
+BOT_ID = 100
+
+
+def message(chat_id, text, from_id=1, message_id=1, **extra):
+    extra['from'] = str(from_id)
+    return [4, message_id, 0, 2000000000 + chat_id, 0, text, extra, {}]
+
+
+class TestAnonymizer(unittest.TestCase):
+    def test_update(self):
+        anonymizer = Anonymizer(salt=b'test')
+        raw = message(15, 'secret text', from_id=42, title='Chat title', source_act='chat_invite_user',
+                      source_mid='43')
+        raw[7] = {'attach1_type': 'audio', 'attach1': '1_2'}
+        update = Update.from_raw(anonymizer.update(raw))
+
+        self.assertNotEqual(update.chat_id, 15)
+        self.assertGreater(update.chat_id, 0)
+        self.assertEqual(update.chat_id, Update.from_raw(anonymizer.update(message(15, ''))).chat_id)
+        self.assertEqual(update.from_id, anonymizer.user_id(42))
+        self.assertEqual(update.action_member_id, anonymizer.user_id(43))
+        self.assertEqual(update.action, 'chat_invite_user')
+        self.assertNotIn('title', update.extra)
+        self.assertDictEqual(update.attachments, {'attach1_type': 'audio'})
+        self.assertEqual(update.text, 'xxxxxx xxxx')
+
+        # Commands are kept, mentioned ids are replaced the same way as other ids
+        self.assertEqual(anonymizer.text('[id{}|Bot] on pidors'.format(BOT_ID)),
+                         '[id{}|user] on pidors'.format(anonymizer.user_id(BOT_ID)))
+        self.assertEqual(anonymizer.text('[club2|Bot] help'), '[club{}|group] help'.format(-anonymizer.user_id(-2)))
+        self.assertEqual(anonymizer.text('/pidor'), '/pidor')
+        self.assertEqual(anonymizer.text('pidor'), 'xxxxx')
+
+        # Commands without a prefix are kept if features accept them
+        anonymizer = Anonymizer(salt=b'test', commands=['pidor', 'топпидор'])
+        self.assertEqual(anonymizer.text('Топпидор неделя'), 'Топпидор неделя')
+        self.assertEqual(anonymizer.text('pidor'), 'pidor')
+        self.assertEqual(anonymizer.text('pidors are here'), 'xxxxxx xxx xxxx')
+        self.assertListEqual(anonymizer.update([8, -42, 1]), [8])
+
+
+class TestRecorder(unittest.TestCase):
+    path = 'test_updates.jsonl.gz'
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def test_read_write(self):
+        rec = Recorder(self.path, BOT_ID)
+        rec.write(message(1, 'hello'))
+        rec.write([8, -42, 1])
+        rec.close()
+
+        header, *updates = recorder.read(self.path)
+        self.assertDictEqual(header, {'version': recorder.FORMAT_VERSION, 'anonymized': False, 'vk_id': BOT_ID})
+        self.assertListEqual([raw for _, raw in updates], [message(1, 'hello'), [8, -42, 1]])
+
+    def test_truncated(self):
+        rec = Recorder(self.path, BOT_ID)
+        for i in range(100):
+            rec.write(message(1, 'hello', message_id=i))
+        rec.close()
+        with open(self.path, 'rb') as file:
+            data = file.read()
+        with open(self.path, 'wb') as file:
+            file.write(data[:-10])
+
+        updates = list(recorder.read(self.path))[1:]
+        self.assertEqual(len(updates), 100)
+
+
+class TestReplay(unittest.TestCase):
+    path = 'test_replay.jsonl.gz'
+
+    def setUp(self):
+        self.installed_features = Config.INSTALLED_FEATURES
+        self.default_features = Config.DEFAULT_FEATURES
+        Config.INSTALLED_FEATURES = ('hardbass',)
+        Config.DEFAULT_FEATURES = ('hardbass',)
+
+    def tearDown(self):
+        Config.INSTALLED_FEATURES = self.installed_features
+        Config.DEFAULT_FEATURES = self.default_features
+        os.remove(self.path)
+
+    def test_replay(self):
+        rec = Recorder(self.path, BOT_ID, anonymize=True)
+        for i in range(20):
+            raw = message(i % 2, 'hello', from_id=i, message_id=i)
+            raw[7] = {'attach1_type': 'photo'}
+            rec.write(raw)
+        rec.write([8, -42, 1])
+        rec.close()
+
+        report = replay(self.path, speed=None)
+        self.assertEqual(report['updates'], 21)
+        self.assertEqual(report['handler']['count'], 21)
+        self.assertEqual(report['features']['hardbass']['count'], 20)
+        # Two new chats got a greeting and help
+        self.assertEqual(report['vk_calls']['messages.send'], 4)
+
+    def test_replay_flood_control(self):
+        saved = Config.FLOOD_CHAT_RATE, Config.FLOOD_CHAT_BURST
+        Config.FLOOD_CHAT_RATE, Config.FLOOD_CHAT_BURST = 1.0, 5
+        try:
+            # One message per second is within the limits when the recording is replayed at any speed
+            rec = Recorder(self.path, BOT_ID)
+            for i in range(20):
+                rec._write([1000.0 + i, message(1, 'hello', from_id=i, message_id=i)])
+            rec.close()
+            self.assertEqual(replay(self.path, speed=None)['flood_dropped'], 0)
+
+            rec = Recorder(self.path, BOT_ID)
+            for i in range(20):
+                rec._write([1000.0, message(1, 'hello', from_id=i, message_id=i)])
+            rec.close()
+            self.assertEqual(replay(self.path, speed=None)['flood_dropped'], 15)
+        finally:
+            Config.FLOOD_CHAT_RATE, Config.FLOOD_CHAT_BURST = saved
+
+
+class TestStubVkApi(unittest.TestCase):
+    def test_stub(self):
+        vk_api = StubVkApi(vk_id=BOT_ID, members=3)
+        self.assertEqual(vk_api.users.get()[0]['id'], BOT_ID)
+        self.assertEqual(len(vk_api.messages.getConversationMembers(peer_id=2000000001)['profiles']), 3)
+        self.assertEqual(vk_api.messages.send(peer_id=1, message='a'), 1)
+        self.assertEqual(vk_api.calls['messages.send'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,62 @@
+import unittest
+
+import threading
+import time
+
+from ubotvk.retry import Backoff, CircuitBreaker, CircuitOpenError
+
+
+class TestRetry(unittest.TestCase):
+    def test_backoff(self):
+        backoff = Backoff(base=1, cap=8)
+        delays = [backoff.next_delay() for _ in range(10)]
+        for attempt, delay in enumerate(delays):
+            self.assertTrue(0 <= delay <= min(8, 2 ** attempt))
+
+        backoff.reset()
+        self.assertTrue(backoff.next_delay() <= 1)
+
+    def test_backoff_long_outage(self):
+        backoff = Backoff(base=1, cap=60)
+        backoff.attempt = 5000
+        self.assertTrue(0 <= backoff.next_delay() <= 60)
+
+    def test_backoff_stop(self):
+        backoff = Backoff(base=60, cap=60)
+        backoff.attempt = 10
+        stop = threading.Event()
+        stop.set()
+        started = time.monotonic()
+        backoff.sleep(stop)
+        self.assertLess(time.monotonic() - started, 1)
+
+    def test_circuit_breaker(self):
+        now = [0]
+        breaker = CircuitBreaker(failure_threshold=2, reset_timeout=10, clock=lambda: now[0])
+
+        def fail():
+            raise ConnectionError
+
+        for _ in range(2):
+            with self.assertRaises(ConnectionError):
+                breaker.call(fail)
+        self.assertTrue(breaker.is_open)
+
+        # Function is not called while the circuit is open
+        with self.assertRaises(CircuitOpenError):
+            breaker.call(lambda: self.fail('Called while the circuit is open'))
+
+        # One failed call after the timeout opens the circuit again
+        now[0] = 11
+        with self.assertRaises(ConnectionError):
+            breaker.call(fail)
+        self.assertTrue(breaker.is_open)
+
+        now[0] = 22
+        self.assertEqual(breaker.call(lambda: 'ok'), 'ok')
+        self.assertFalse(breaker.is_open)
+        self.assertEqual(breaker.failures, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
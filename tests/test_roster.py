@@ -0,0 +1,92 @@
+import unittest
+
+import os
+import sqlite3
+import time
+
+from ubotvk.bot_features.pidors.pidors import Database
+from ubotvk.bot_features.pidors.roster import RESYNC_AFTER, Roster
+from ubotvk.replay import StubVkApi
+
+
+class TestRoster(unittest.TestCase):
+    db_file = 'test_roster.sqlite'
+    chat_id = 15
+    bot_id = 1
+
+    def setUp(self):
+        try:
+            os.remove(self.db_file)
+        except OSError:
+            pass
+
+        self.db = Database(self.db_file)
+        self.vk = StubVkApi(vk_id=self.bot_id, members=5)
+        self.roster = Roster(self.vk, self.db, self.bot_id)
+
+    def tearDown(self):
+        os.remove(self.db_file)
+
+    def set_synced(self, chat_id, synced_at):
+        conn = sqlite3.connect(self.db_file)
+        conn.execute("""UPDATE Rosters SET synced_at=? WHERE chat_id=?""", (synced_at, chat_id))
+        conn.commit()
+        conn.close()
+
+    def test_members(self):
+        # Never synced roster is fetched from VK, without the bot itself
+        self.assertListEqual(sorted(self.roster.members(self.chat_id)), [2, 3, 4, 5])
+        self.assertEqual(self.vk.calls['messages.getConversationMembers'], 1)
+        self.assertIsNotNone(self.db.get_roster_synced(self.chat_id))
+
+        # Cached and synced rosters are not fetched again
+        self.roster.members(self.chat_id)
+        self.roster.forget(self.chat_id)
+        self.assertListEqual(sorted(self.roster.members(self.chat_id)), [2, 3, 4, 5])
+        self.assertEqual(self.vk.calls['messages.getConversationMembers'], 1)
+
+        self.roster.invalidate(self.chat_id)
+        self.assertIsNone(self.db.get_roster_synced(self.chat_id))
+        self.roster.members(self.chat_id)
+        self.assertEqual(self.vk.calls['messages.getConversationMembers'], 2)
+
+    def test_add_remove(self):
+        self.roster.members(self.chat_id)
+        self.roster.add(self.chat_id, 10)
+        self.roster.remove(self.chat_id, 2)
+        self.assertListEqual(sorted(self.roster.members(self.chat_id)), [3, 4, 5, 10])
+        self.assertListEqual(sorted(self.db.get_members(self.chat_id)), [3, 4, 5, 10])
+
+        # Communities and the bot are not members
+        self.roster.add(self.chat_id, -20)
+        self.roster.add(self.chat_id, self.bot_id)
+        self.assertListEqual(sorted(self.roster.members(self.chat_id)), [3, 4, 5, 10])
+        self.assertListEqual(sorted(self.db.get_members(self.chat_id)), [3, 4, 5, 10])
+
+        # Changes of rosters that are not in memory go only to the database
+        self.roster.forget(self.chat_id)
+        self.roster.add(self.chat_id, 11)
+        self.assertListEqual(sorted(self.roster.members(self.chat_id)), [3, 4, 5, 10, 11])
+
+    def test_resync_stale(self):
+        self.roster.members(self.chat_id)
+        self.roster.members(self.chat_id + 1)
+        self.roster.add(self.chat_id, 10)
+        self.set_synced(self.chat_id, int(time.time()) - RESYNC_AFTER - 1)
+
+        self.roster.resync_stale([self.chat_id, self.chat_id + 1], interval=0)
+        self.assertEqual(self.vk.calls['messages.getConversationMembers'], 3)
+        # Members that VK doesn't return are removed
+        self.assertListEqual(sorted(self.roster.members(self.chat_id)), [2, 3, 4, 5])
+
+    def test_forget(self):
+        self.assertEqual(self.roster.forget(self.chat_id), 0)
+        self.roster.members(self.chat_id)
+        usage = self.roster.memory_usage()
+        freed = self.roster.forget(self.chat_id)
+        self.assertGreater(freed, 0)
+        self.assertLess(self.roster.memory_usage(), usage)
+
+
+if __name__ == '__main__':
+    unittest.main()
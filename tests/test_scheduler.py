@@ -0,0 +1,70 @@
+import unittest
+
+import os
+import threading
+import time
+
+from ubotvk.database import Database
+from ubotvk.metrics import metrics
+from ubotvk.scheduler import Scheduler
+
+
+class TestScheduler(unittest.TestCase):
+    db_file = 'test_scheduler.sqlite'
+
+    def setUp(self):
+        try:
+            os.remove(self.db_file)
+        except OSError:
+            pass
+        self.db = Database(self.db_file)
+        self.scheduler = Scheduler(self.db, max_workers=2)
+        metrics.reset()
+
+    def tearDown(self):
+        self.scheduler.shutdown()
+        os.remove(self.db_file)
+
+    def test_job(self):
+        done = threading.Event()
+        self.scheduler.add_job(done.set, 'interval', job_id='test.job', seconds=0.1)
+        self.scheduler.start()
+        self.assertTrue(done.wait(5))
+        time.sleep(0.1)
+
+        state = self.db.get_job_state('test.job')
+        self.assertIsNone(state['error'])
+        self.assertAlmostEqual(state['last_run'], time.time(), delta=5)
+        self.assertGreaterEqual(metrics.get('scheduler.test.job.duration')[0], 1)
+
+    def test_error(self):
+        done = threading.Event()
+
+        def job():
+            done.set()
+            raise RuntimeError('test')
+
+        self.scheduler.add_job(job, 'interval', job_id='test.error', seconds=0.1)
+        self.scheduler.start()
+        self.assertTrue(done.wait(5))
+        time.sleep(0.1)
+        self.assertEqual(self.db.get_job_state('test.error')['error'], "RuntimeError('test')")
+        self.assertGreaterEqual(metrics.get('scheduler.test.error.errors'), 1)
+
+    def test_catch_up(self):
+        ran = []
+        # New jobs and jobs that ran on time don't catch up
+        self.scheduler.add_job(lambda: ran.append('new'), 'cron', job_id='test.new', catch_up=True, hour=0)
+        self.db.save_job_state('test.on_time', time.time(), 1.0)
+        self.scheduler.add_job(lambda: ran.append('on_time'), 'cron', job_id='test.on_time', catch_up=True, hour=0)
+        # Last run was two days ago, the daily run was missed
+        self.db.save_job_state('test.missed', time.time() - 2 * 24 * 60 * 60, 1.0)
+        self.scheduler.add_job(lambda: ran.append('missed'), 'cron', job_id='test.missed', catch_up=True, hour=0)
+
+        self.scheduler.start()
+        time.sleep(0.5)
+        self.assertListEqual(ran, ['missed'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,95 @@
+import unittest
+
+import os
+import sqlite3
+
+from ubotvk import snapshot
+from ubotvk.bot_features.pidors.pidors import Database
+
+
+class TestSnapshot(unittest.TestCase):
+    path = 'test.snapshot'
+
+    def tearDown(self):
+        for path in (self.path, self.path + '.tmp'):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def test_write_read(self):
+        snapshot.write(self.path, {'db_version': 42},
+                       {'chats': [1, 2, 2000000000], 'feature:pidors': {2}, 'feature:x': []})
+
+        with snapshot.read(self.path) as state:
+            self.assertDictEqual(state.meta, {'db_version': 42})
+            self.assertListEqual(state.get('chats').tolist(), [1, 2, 2000000000])
+            self.assertSetEqual(set(state.get('feature:pidors')), {2})
+            self.assertEqual(len(state.get('feature:x')), 0)
+            self.assertIsNone(state.get('feature:y'))
+
+    def test_missing(self):
+        self.assertIsNone(snapshot.read(self.path))
+
+    def test_broken(self):
+        snapshot.write(self.path, {}, {'chats': range(100), 'feature:pidors': range(10)})
+        with open(self.path, 'r+b') as file:
+            file.seek(-3, os.SEEK_END)
+            file.write(b'\xff')
+
+        # Sections are checked when they are accessed
+        with snapshot.read(self.path) as state:
+            self.assertEqual(len(state.get('chats')), 100)
+            with self.assertRaises(ValueError):
+                state.get('feature:pidors')
+
+        snapshot.write(self.path, {'db_version': 1}, {})
+        with open(self.path, 'r+b') as file:
+            file.seek(-3, os.SEEK_END)
+            file.write(b'\xff')
+        self.assertIsNone(snapshot.read(self.path))
+
+        snapshot.write(self.path, {}, {'chats': range(100)})
+        with open(self.path, 'r+b') as file:
+            file.truncate(100)
+        self.assertIsNone(snapshot.read(self.path))
+
+        with open(self.path, 'wb') as file:
+            file.write(b'UBSN')
+        self.assertIsNone(snapshot.read(self.path))
+
+        open(self.path, 'wb').close()
+        self.assertIsNone(snapshot.read(self.path))
+
+
+class TestPidorsSnapshot(unittest.TestCase):
+    db_file = 'test_pidors_snapshot.sqlite'
+    path = 'test_pidors.snapshot'
+
+    def tearDown(self):
+        for path in (self.db_file, self.path):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def test_version(self):
+        db = Database(self.db_file, snapshot_file=self.path)
+        db.add_chat(1)
+        db.add_chat(2)
+        db.save_snapshot()
+
+        # Chats are read from the snapshot, not from the table
+        conn = sqlite3.connect(self.db_file)
+        conn.execute("""DELETE FROM Chats""")
+        conn.commit()
+        conn.close()
+        self.assertSetEqual(Database(self.db_file, snapshot_file=self.path).chats, {1, 2})
+
+        # Changes after the snapshot make it outdated
+        db.add_chat(3)
+        self.assertSetEqual(Database(self.db_file, snapshot_file=self.path).chats, {3})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,53 @@
+import unittest
+
+from ubotvk.update import Update, peer_id
+
+
+class TestUpdate(unittest.TestCase):
+    def test_message(self):
+        raw = [4, 1010, 8227, 2000000015, 1539000000, ' [id1|Bot] help ', {'title': ' ... ', 'from': '212771532'},
+               {'attach1_type': 'audio', 'attach1': '436295874_456239021'}]
+        update = Update.from_raw(raw)
+
+        self.assertEqual(update.code, 4)
+        self.assertEqual(update.message_id, 1010)
+        self.assertEqual(update.chat_id, 15)
+        self.assertIsInstance(update.chat_id, int)
+        self.assertEqual(update.peer_id, peer_id(update.chat_id))
+        self.assertEqual(update.from_id, 212771532)
+        self.assertEqual(update.text, '[id1|Bot] help')
+        self.assertEqual(update.attachments['attach1_type'], 'audio')
+        self.assertFalse(update.is_inbox)
+        self.assertIsNone(update.action)
+        self.assertIs(update.raw, raw)
+
+    def test_service_message(self):
+        raw = [4, 1011, 1, 2000000015, 1539000000, '',
+               {'source_act': 'chat_invite_user', 'source_mid': '123', 'from': '456'}, {}]
+        update = Update.from_raw(raw)
+
+        self.assertTrue(update.is_inbox)
+        self.assertEqual(update.action, 'chat_invite_user')
+        self.assertEqual(update.action_member_id, 123)
+        self.assertEqual(update.from_id, 456)
+
+    def test_private_dialog(self):
+        update = Update.from_raw([4, 1012, 17, 212771532, 1539000000, 'hi', {}, {}])
+        self.assertEqual(update.from_id, 212771532)
+        self.assertTrue(update.chat_id < 0)
+
+    def test_other_codes(self):
+        update = Update.from_raw([8, -212771532, 1, 1539000000])
+        self.assertEqual(update.code, 8)
+        self.assertIsNone(update.chat_id)
+        self.assertEqual(update.text, '')
+        self.assertDictEqual(update.attachments, {})
+
+    def test_slots(self):
+        update = Update.from_raw([4, 1, 0, 2000000001, 0, '', {}, {}])
+        with self.assertRaises(AttributeError):
+            update.something = 1
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -33,6 +33,26 @@ class TestUtils(unittest.TestCase):
         commands = ['cmd', 'cmd2']
         self.assertListEqual(utils.command_in_string(string, commands), ['cmd', 'cmd2'])
 
+        string = '[club13515|Test] cmd test'
+        commands = ['cmd', 'cmd2']
+        self.assertListEqual(utils.command_in_string(string, commands), ['cmd', 'test'])
+
+    def test_split_message(self):
+        self.assertListEqual(utils.split_message('short', limit=10), ['short'])
+        self.assertListEqual(utils.split_message('', limit=10), [])
+
+        # Lines are joined while they fit
+        self.assertListEqual(utils.split_message('aaa\nbbb\nccc\nddd', limit=7), ['aaa\nbbb', 'ccc\nddd'])
+
+        # Lines longer than limit are split
+        self.assertListEqual(utils.split_message('aa\n' + 'b' * 12 + '\ncc', limit=5),
+                             ['aa', 'bbbbb', 'bbbbb', 'bb\ncc'])
+
+        text = '\n'.join(str(i) * i for i in range(1, 100))
+        parts = utils.split_message(text, limit=50)
+        self.assertTrue(all(len(part) <= 50 for part in parts))
+        self.assertEqual(''.join(parts).replace('\n', ''), text.replace('\n', ''))
+
 
 if __name__ == '__main__':
     unittest.main()
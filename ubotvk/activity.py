@@ -0,0 +1,78 @@
+from collections import OrderedDict
+import sys
+import time
+
+
+def deep_size(obj) -> int:
+    """
+    Approximate size in bytes of an object and everything it contains,
+    follows only dicts, lists, tuples and sets, objects shared between containers are counted once
+    """
+    seen = set()
+    size = 0
+    stack = [obj]
+    while stack:
+        item = stack.pop()
+        if id(item) in seen:
+            continue
+        seen.add(id(item))
+        size += sys.getsizeof(item)
+        if isinstance(item, dict):
+            stack.extend(item.keys())
+            stack.extend(item.values())
+        elif isinstance(item, (list, tuple, set, frozenset)):
+            stack.extend(item)
+    return size
+
+
+class ChatActivity:
+    """
+    Time of the last update in every chat, least recently active chats first.
+    Chats that had no updates since the bot started count as active at start.
+    Not thread-safe, it's used only in the dispatcher thread
+    """
+
+    def __init__(self, clock=time.monotonic):
+        self._clock = clock
+        self._started = clock()
+        self._last = OrderedDict()  # {chat_id: time of the last update}
+
+    def touch(self, chat_id):
+        self._last[chat_id] = self._clock()
+        self._last.move_to_end(chat_id)
+
+    def idle_for(self, chat_id) -> float:
+        """
+        :return: float: Seconds since the last update in the chat
+        """
+        return self._clock() - self._last.get(chat_id, self._started)
+
+    def coldest(self, chats) -> list:
+        """
+        :param chats: iterable of chat ids
+        :return: list of the chats, least recently active first
+        """
+        return sorted(chats, key=lambda chat_id: self._last.get(chat_id, self._started))
+
+    def prune(self, max_idle):
+        """
+        Forgets chats that were idle for more than max_idle seconds, they still count as idle after that
+        """
+        now = self._clock()
+        while self._last:
+            chat_id, last = next(iter(self._last.items()))
+            if now - last <= max_idle:
+                break
+            del self._last[chat_id]
+
+    def memory_usage(self) -> int:
+        """
+        :return: int: Approximate size in bytes
+        """
+        return deep_size(self._last)
+
+    def __iter__(self):
+        return iter(self._last)
+
+    def __len__(self):
+        return len(self._last)
@@ -1,68 +1,208 @@
 #!/usr/bin/env python
 
+from collections import deque
 from importlib import import_module
 import logging
-import pathlib
+import os
+import threading
+import time
 
 import requests
 import vk_requests
 from vk_requests.exceptions import VkAPIError
 
-from ubotvk import utils
+from ubotvk import config, log, snapshot, utils
+from ubotvk.activity import ChatActivity, deep_size
 from ubotvk.database import Database
-from ubotvk.config import Config
+from ubotvk.dedup import DedupWindow
+from ubotvk.callback import CallbackServer
+from ubotvk.dispatcher import Dispatcher
+from ubotvk.flood import FloodControl
+from ubotvk.jsonstream import LongPollStream
+from ubotvk.metrics import metrics
+from ubotvk.recorder import Recorder
+from ubotvk.retry import Backoff, CircuitBreaker, CircuitOpenError
+from ubotvk.scheduler import Scheduler
+from ubotvk.config import Config, ConfigError
+from ubotvk.update import Update, peer_id
+
+
+LONG_POLL_CHUNK_SIZE = 16384
+LONG_POLL_CONNECT_TIMEOUT = 5
+LONG_POLL_READ_MARGIN = 10     # Seconds to wait for a response on top of "wait"
+CALLBACK_IDLE_TIMEOUT = 5
+CONFIG_WATCH_INTERVAL = 10  # Seconds between checks of config.json modification time
+EVICT_INTERVAL = 300    # Seconds between evictions of inactive chats
+EVICT_MIN_IDLE = 300    # Chats active more recently are not evicted even if memory budget is exceeded
+HANDOFF_MAX_AGE = 600   # Seconds, Long Poll state saved by the previous process is not used after that
+
+SAMPLE_UPDATE = {'sample': 'update'}
+SAMPLE_FEATURE_CALL = {'sample': 'feature_call'}
+
+
+class Shutdown(BaseException):
+    """
+    Raised by the signal handler to interrupt a Long Poll request, not caught by `except Exception`
+    """
 
 
-if Config.LOG_DIR:  # Write to file if specified
-    pathlib.Path(Config.LOG_DIR).mkdir(parents=True, exist_ok=True)
-    logging.basicConfig(
-        format='%(asctime)s - %(levelname)s - %(funcName)s - %(message)s',
-        level=logging.getLevelName(Config.LOG_LEVEL),
-        filename=Config.LOG_DIR+'ubotvk.log',
-        filemode='a'
-    )
-else:   # Write to stderr if not
-    logging.basicConfig(
-        format='%(asctime)s - %(levelname)s - %(funcName)s - %(message)s',
-        level=logging.getLevelName(Config.LOG_LEVEL),
-    )
+log.setup(log_dir=Config.LOG_DIR, level=Config.LOG_LEVEL,
+          async_file=Config.LOG_ASYNC, sample_every=Config.LOG_SAMPLE)
+config.subscribe(lambda changes: log.configure(level=Config.LOG_LEVEL, sample_every=Config.LOG_SAMPLE),
+                 'LOG_LEVEL', 'LOG_SAMPLE')
 
 
 class Bot:
     """
     Creates vk-requests.API instance with credentials from config.json,
     Gets Long Poll server,
-    Continuously gets updates from VK,
+    Continuously gets updates from VK (from Long Poll or Callback API if Config.CALLBACK_PORT is set),
     Calls features from config.INSTALLED_FEATURES on update
     """
 
-    def __init__(self):
+    def __init__(self, vk_api=None):
+        """
+        :param vk_api: API to use instead of a session created with credentials from config, e.g. a stub for replay
+        """
         print('Bot instance was initialized.')
-        self.vk_api = vk_requests.create_api(login=Config.LOGIN, password=Config.PASSWORD,
-                                             app_id=Config.APP_ID, api_version='5.80', scope='messages,offline')
-        self.vk_id = self.vk_api.users.get()[0]['id']
-        logging.info('Created VK API session. Bot`s ID = {}'.format(self.vk_id))
+        if Config.CALLBACK_PORT and not (Config.CALLBACK_GROUP_ID and Config.CALLBACK_GROUP_TOKEN):
+            raise ConfigError('Callback API is available only to communities, set UBOTVK_CALLBACK_GROUP_ID and '
+                              'UBOTVK_CALLBACK_GROUP_TOKEN or unset UBOTVK_CALLBACK_PORT to use Long Poll')
+        if vk_api is None and Config.CALLBACK_PORT:
+            vk_api = vk_requests.create_api(service_token=Config.CALLBACK_GROUP_TOKEN, api_version='5.80')
+        elif vk_api is None:
+            vk_api = vk_requests.create_api(login=Config.LOGIN, password=Config.PASSWORD,
+                                            app_id=Config.APP_ID, api_version='5.80', scope='messages,offline')
+        self.vk_api = vk_api
+        self.vk_id = utils.own_id(self.vk_api)
+        if self.vk_id < 0:
+            self._mention = '[club{}|'.format(-self.vk_id)
+        else:
+            self._mention = '[id{}|'.format(self.vk_id)
+        logging.info('Created VK API session. Bot`s ID = %s', self.vk_id)
         print('Created VK API session. Bot`s ID = {}'.format(self.vk_id))
 
         self.db = Database('data/bot_db.sqlite3')
-        self.dict_feature_chats = self.db.get_feature_chats_dict()
-        self._chats = self.db.get_chats()
-        print('Database loaded.')
-        logging.debug('Database loaded. chats = {chats}; dict_feature_chats = {d_f_c}'.
-                      format(chats=self._chats, d_f_c=self.dict_feature_chats))
-
         self.logger = logging
 
+        from_snapshot = self.load_snapshot()
         self.features = self.import_features()
+        if from_snapshot and not set(self.features) <= set(self.dict_feature_chats):
+            logging.info('Snapshot has no state of some features, loading state from the database')
+            from_snapshot = False
+        if from_snapshot:
+            self.dict_feature_chats = {feature: self.dict_feature_chats[feature] for feature in self.features}
+            # Changes made after the snapshot, including the bot's own if it wasn't stopped cleanly
+            self.sync_changes(exclude_source=None)
+        else:
+            self.load_database()
+        print('Database loaded.')
+        logging.debug('Database loaded. chats = %s; dict_feature_chats = %s', self._chats, self.dict_feature_chats)
+
+        self.activity = ChatActivity()
+        self.dedup = DedupWindow(capacity=Config.DEDUP_SIZE, ttl=Config.DEDUP_TTL)
+        if Config.DEDUP_PERSIST:
+            self.dedup.load(self.db.pop_state('dedup') or [])
+        self.dispatcher = Dispatcher(
+            self.handle_update,
+            flood_control=FloodControl(chat_rate=Config.FLOOD_CHAT_RATE, chat_burst=Config.FLOOD_CHAT_BURST,
+                                       user_rate=Config.FLOOD_USER_RATE, user_burst=Config.FLOOD_USER_BURST),
+            max_backlog=Config.DISPATCH_BACKLOG,
+            weights=Config.CHAT_WEIGHTS,
+            is_priority=lambda update: update.action is not None,   # Service messages change chat state
+            dedup=self.dedup
+        )
 
-        self.key, self.server, self.ts = self.get_long_poll_server()
+        self._poll_backoff = Backoff(base=1, cap=60)
+        self._lps_breaker = CircuitBreaker(failure_threshold=5, reset_timeout=60)
+        self.scheduler = self.create_scheduler()
+        self._stopping = False
+        self._stop_event = threading.Event()   # Set with _stopping, ends the reconnect backoff early
+        self._interruptible = False     # Waiting for a Long Poll response, no updates were taken from it yet
+        self._reload_requested = False
+        config.subscribe(self.apply_flood_limits, 'FLOOD_CHAT_RATE', 'FLOOD_CHAT_BURST', 'FLOOD_USER_RATE',
+                         'FLOOD_USER_BURST')
+        config.subscribe(self.apply_limits, 'DISPATCH_BACKLOG', 'CHAT_WEIGHTS', 'DEDUP_TTL')
+        config.subscribe(self.apply_default_features, 'DEFAULT_FEATURES')
+        config.subscribe(self.apply_jobs, 'METRICS_INTERVAL', 'SNAPSHOT_INTERVAL')
+        self.recorder = None
+        if Config.RECORD_DIR:
+            commands = [command for feature in self.features.values() for command in getattr(feature, 'commands', [])]
+            self.recorder = Recorder(os.path.join(Config.RECORD_DIR, time.strftime('updates-%Y%m%d-%H%M%S.jsonl.gz')),
+                                     self.vk_id, anonymize=Config.RECORD_ANONYMIZE, commands=commands)
+        if Config.CALLBACK_PORT:
+            self.key, self.server, self.ts = None, None, None
+        else:
+            self.key, self.server, self.ts = self.take_handoff() or self.get_long_poll_server()
+        self._handled_ts = self.ts
+        self._checkpoints = deque()     # (dispatcher.accepted(), ts) after each Long Poll response
 
     def start_loop(self):
-        while True:
-            response = self.long_poll(self.server, self.key, self.ts)
-            self.ts = response['ts']
-            for update in response['updates']:
-                self.handle_update(update)
+        """
+        Handles updates until request_stop() is called
+        """
+        self.dispatcher.start()
+        self.scheduler.start()
+        if Config.CALLBACK_PORT:
+            return self.callback_loop()
+
+        try:
+            while not self._stopping:
+                self.dispatcher.raise_error()
+                self.check_reload_request()
+                for update in self.long_poll(self.server, self.key, self.ts):
+                    if self.recorder is not None:
+                        self.recorder.write(update)
+                    self.dispatcher.submit(Update.from_raw(update))
+                self._checkpoints.append((self.dispatcher.accepted(), self.ts))
+                self.handled_ts()
+                self.dispatcher.call(self.sync_changes)
+        except Shutdown:
+            logging.info('Long Poll request was interrupted, ts = %s', self.ts)
+
+    def request_stop(self, signum=None, frame=None):
+        """
+        Signal handler. Stops the loop after the current Long Poll response,
+        a request that is still waiting for the response is interrupted
+        """
+        logging.info('Got signal %s, stopping', signum)
+        self._stopping = True
+        self._stop_event.set()
+        if self._interruptible:
+            self._interruptible = False
+            raise Shutdown()
+
+    def request_reload(self, signum=None, frame=None):
+        """
+        Signal handler. Config is reloaded in the dispatcher thread after the current Long Poll response
+        """
+        self._reload_requested = True
+
+    def check_reload_request(self):
+        if self._reload_requested:
+            self._reload_requested = False
+            self.dispatcher.call(self.reload_config)
+
+    def callback_loop(self):
+        """
+        Gets updates from VK Callback API instead of Long Poll
+        """
+        server = CallbackServer(port=Config.CALLBACK_PORT, confirmation=Config.CALLBACK_CONFIRMATION,
+                                secret=Config.CALLBACK_SECRET, group_id=Config.CALLBACK_GROUP_ID)
+        server.start()
+        try:
+            while not self._stopping:
+                self.check_reload_request()
+                for update in server.get_batch(timeout=CALLBACK_IDLE_TIMEOUT):
+                    if self.recorder is not None:
+                        self.recorder.write(update.to_raw())
+                    self.dispatcher.submit(update)
+                self.dispatcher.raise_error()
+                self.dispatcher.call(self.sync_changes)
+        finally:
+            server.stop()
+            for update in server.get_batch(timeout=0):  # VK won't resend events that were answered
+                self.dispatcher.submit(update)
 
     def get_long_poll_server(self):
         lps = self.vk_api.messages.getLongPollServer(need_pts=0, lp_version=3)
@@ -70,61 +210,410 @@ class Bot:
 
     def long_poll(self, server, key, ts, wait=25, mode=2, version=3):
         """
-        Gets updates from VK Long Poll server
+        Gets updates from VK Long Poll server.
+        Updates are yielded while the response is still being read, self.ts is updated after the last one.
+        Network errors and "failed" responses are not raised, they update the Long Poll state
+        (with backoff if needed) and end the generator, so the caller simply polls again
         :param server: str: VK Long Poll server URI returned by messages.getLongPollServer()
         :param key: str: Secret session key returned by messages.getLongPollServer()
         :param ts: int: Last event id
         :param wait: int: Seconds to wait before returning empty updates list
         :param mode: int: Additional options for request. More info: https://vk.com/dev/using_longpoll
         :param version: int: Long Poll version. More info: https://vk.com/dev/using_longpoll
-        :return: dict: {'ts': 00000000, 'updates': [list of updates]}
+        :return: generator of updates as lists
         """
 
         payload = {'act': 'a_check', 'key': key, 'ts': ts, 'wait': wait, 'mode': mode, 'version': version}
-        request = requests.get('https://{server}?'.format(server=server), params=payload)
-        res = request.json()
+        metrics.incr('long_poll.requests')
+        self._interruptible = not self._stopping
+        try:
+            with requests.get('https://{server}?'.format(server=server), params=payload, stream=True,
+                              timeout=(LONG_POLL_CONNECT_TIMEOUT, wait + LONG_POLL_READ_MARGIN)) as request:
+                request.raise_for_status()
+                response = LongPollStream(request.iter_content(chunk_size=LONG_POLL_CHUNK_SIZE))
+                for update in response:
+                    # Updates are submitted from here on, so the response must be read to the end to update ts
+                    self._interruptible = False
+                    yield update
+                self._interruptible = False
+        except (requests.RequestException, ValueError) as err:
+            self._interruptible = False
+            metrics.incr('long_poll.errors')
+            delay = self._poll_backoff.sleep(self._stop_event)
+            logging.warning('Long Poll request failed, retried after %.1f seconds: %r', delay, err)
+            return
+
+        res = response.fields
+        self._poll_backoff.reset()
 
         if 'failed' not in res:
-            return res
+            self.ts = res['ts']
 
         elif res['failed'] == 1:
             self.ts = res['ts']
+            metrics.incr('long_poll.failed_1')
             logging.info('VK returned lp response with "failed" == 1, updated self.ts value')
-            return self.long_poll(self.server, self.key, self.ts)
         elif res['failed'] in [2, 3]:
-            self.key, self.server, self.ts = self.get_long_poll_server()
-            logging.info(f'VK returned lp response with "failed" == {res["failed"]}, updated Long Poll server')
-            return self.long_poll(self.server, self.key, self.ts)
+            metrics.incr('long_poll.reconnects')
+            try:
+                new_key, new_server, new_ts = self._lps_breaker.call(self.get_long_poll_server)
+            except (CircuitOpenError, VkAPIError, requests.RequestException) as err:
+                metrics.incr('long_poll.reconnect_errors')
+                delay = self._poll_backoff.sleep(self._stop_event)
+                logging.warning('Could not get Long Poll server, retried after %.1f seconds: %r', delay, err)
+                return
+
+            self.key, self.server = new_key, new_server
+            if res['failed'] == 3:  # With "failed" == 2 only the key has expired, events since self.ts are kept
+                self.ts = new_ts
+            logging.info('VK returned lp response with "failed" == %s, updated Long Poll server', res['failed'])
         elif res['failed'] == 4:
             raise ValueError('Wrong Long Poll version')
         else:
             raise Exception('VK returned lp response with unexpected "failed" value. Response: {}'.format(res))
 
-    def handle_update(self, update):
-        logging.debug('Got new update: {}'.format(update))
+    def sync_changes(self, exclude_source='bot'):
+        """
+        Applies changes made to the database by other processes (e.g. admin.py) since the last call
+        :param exclude_source: str: Changes made by this source are already applied
+        """
+        self._db_version, chats = self.db.get_changes_since(self._db_version, exclude_source=exclude_source)
+        for chat_id, enabled in self.db.get_chats_features(chats).items():
+            self._chats.add(chat_id)
+
+            for feature in self.dict_feature_chats:
+                if feature in enabled and chat_id not in self.dict_feature_chats[feature]:
+                    self.dict_feature_chats[feature].add(chat_id)
+                    try:
+                        self.features[feature].new_chat(chat_id)
+                    except AttributeError:
+                        logging.debug('%s has no new_chat method', feature)
+
+                elif feature not in enabled and chat_id in self.dict_feature_chats[feature]:
+                    self.dict_feature_chats[feature].discard(chat_id)
+                    try:
+                        self.features[feature].remove_chat(chat_id)
+                    except AttributeError:
+                        logging.debug('%s has no remove_chat method', feature)
+
+        if chats:
+            logging.info('Applied database changes for %s chats, database version %s', len(chats), self._db_version)
+
+    def load_database(self):
+        self._db_version = self.db.get_version()
+        self.dict_feature_chats = {feature: set(chats)
+                                   for feature, chats in self.db.get_feature_chats_dict(self.features).items()}
+        self._chats = set(self.db.get_chats())
+
+    def load_snapshot(self) -> bool:
+        """
+        Loads chats and features from Config.SNAPSHOT_FILE instead of reading the whole database
+        :return: bool: False if there is no snapshot or it doesn't match the database and config
+        """
+        state = snapshot.read(Config.SNAPSHOT_FILE)
+        if state is None:
+            return False
+
+        with state:
+            version = state.meta.get('db_version', 0)
+            if version > self.db.get_version() or \
+                    state.meta.get('default_features') != list(Config.DEFAULT_FEATURES) or \
+                    any('feature:' + feature not in state for feature in Config.INSTALLED_FEATURES or ()):
+                logging.info('Snapshot %s is outdated, loading state from the database', Config.SNAPSHOT_FILE)
+                return False
+
+            try:
+                chats = set(state.get('chats'))
+                feature_chats = {name[len('feature:'):]: set(state.get(name)) for name in state.names()
+                                 if name.startswith('feature:')}
+            except ValueError:
+                logging.warning('Snapshot %s is broken, loading state from the database', Config.SNAPSHOT_FILE,
+                                exc_info=True)
+                return False
+            self._db_version = version
+            self._chats = chats
+            self.dict_feature_chats = feature_chats
+        logging.info('Loaded snapshot %s, database version %s', Config.SNAPSHOT_FILE, version)
+        return True
+
+    def save_snapshot(self):
+        """
+        Writes chats and features to Config.SNAPSHOT_FILE and calls save_snapshot() of features.
+        Must be called from the dispatcher thread or when the dispatcher is stopped
+        """
+        self.sync_changes()     # So that the snapshot includes everything up to self._db_version
+        sections = {'feature:' + feature: chats for feature, chats in self.dict_feature_chats.items()}
+        sections['chats'] = self._chats
+        try:
+            with metrics.timer('snapshot.save'):
+                snapshot.write(Config.SNAPSHOT_FILE,
+                               {'db_version': self._db_version, 'default_features': list(Config.DEFAULT_FEATURES)},
+                               sections)
+        except OSError:
+            logging.warning('Could not save snapshot %s', Config.SNAPSHOT_FILE, exc_info=True)
+        else:
+            # A restart reads changes since the snapshot's version, older ones are not needed anymore
+            pruned = self.db.prune_changelog(self._db_version)
+            logging.debug('Pruned %s changes older than database version %s', pruned, self._db_version)
+
+        for feature in self.features:
+            try:
+                save = self.features[feature].save_snapshot
+            except AttributeError:
+                continue
+            try:
+                save()
+            except OSError:
+                logging.warning('Could not save snapshot of %s', feature, exc_info=True)
+
+    def create_scheduler(self) -> Scheduler:
+        """
+        Creates the scheduler with the bot's own jobs and jobs of features that have register_jobs(scheduler) method
+        """
+        scheduler = Scheduler(self.db, max_workers=Config.SCHEDULER_WORKERS)
+        self.add_jobs(scheduler)
+        for feature in self.features:
+            try:
+                self.features[feature].register_jobs(scheduler)
+                logging.debug('Registered jobs of %s', feature)
+            except AttributeError:
+                logging.debug('%s has no register_jobs method', feature)
+        return scheduler
+
+    def add_jobs(self, scheduler):
+        """
+        Adds the bot's own jobs to the scheduler, jobs with intervals set to 0 are removed
+        """
+        if Config.METRICS_INTERVAL:
+            scheduler.add_job(self.report_metrics, 'interval', job_id='bot.report_metrics',
+                              seconds=Config.METRICS_INTERVAL)
+        else:
+            scheduler.remove_job('bot.report_metrics')
+        if Config.SNAPSHOT_INTERVAL:
+            # Snapshot is saved in the dispatcher thread, so that features don't change while it's written
+            scheduler.add_job(lambda: self.dispatcher.call(self.save_snapshot), 'interval', job_id='bot.save_snapshot',
+                              seconds=Config.SNAPSHOT_INTERVAL)
+        else:
+            scheduler.remove_job('bot.save_snapshot')
+        scheduler.add_job(self.watch_config, 'interval', job_id='bot.watch_config', seconds=CONFIG_WATCH_INTERVAL)
+        scheduler.add_job(lambda: self.dispatcher.call(self.evict_chats), 'interval', job_id='bot.evict_chats',
+                          seconds=EVICT_INTERVAL)
+
+    def watch_config(self):
+        if config.file_changed():
+            self.dispatcher.call(self.reload_config)
+
+    def reload_config(self) -> str:
+        """
+        Reloads config and applies the changes. Must be called from the dispatcher thread
+        :return: str: Result for the maintainer
+        """
+        try:
+            changes = config.reload()
+        except config.ConfigError as err:
+            logging.error('Config was not reloaded: %s', err)
+            return 'Конфиг не перезагружен: {}'.format(err)
+
+        logging.info('Config was reloaded, changes: %s', changes)
+        if not changes:
+            return 'Конфиг перезагружен, ничего не изменилось'
+        return 'Конфиг перезагружен: ' + ', '.join('{}={}'.format(name, value)
+                                                   for name, value in changes.items())
+
+    def apply_flood_limits(self, changes):
+        """
+        Flood control starts with full buckets, so it is reconfigured only when its own limits change
+        """
+        self.dispatcher.flood_control.configure(Config.FLOOD_CHAT_RATE, Config.FLOOD_CHAT_BURST,
+                                                Config.FLOOD_USER_RATE, Config.FLOOD_USER_BURST)
+
+    def apply_limits(self, changes):
+        self.dispatcher.configure(max_backlog=Config.DISPATCH_BACKLOG, weights=Config.CHAT_WEIGHTS)
+        self.dedup.ttl = Config.DEDUP_TTL
+
+    def apply_jobs(self, changes):
+        self.add_jobs(self.scheduler)
+
+    def apply_default_features(self, changes):
+        """
+        Reloads chats and features from the database and calls hooks of features that were turned on or off
+        """
+        old = self.dict_feature_chats
+        self.load_database()
+        for feature, chats in self.dict_feature_chats.items():
+            for chat_id in chats - old.get(feature, set()):
+                try:
+                    self.features[feature].new_chat(chat_id)
+                except AttributeError:
+                    logging.debug('%s has no new_chat method', feature)
+            for chat_id in old.get(feature, set()) - chats:
+                try:
+                    self.features[feature].remove_chat(chat_id)
+                except AttributeError:
+                    logging.debug('%s has no remove_chat method', feature)
+
+    def shutdown(self, timeout=None):
+        """
+        Handles queued updates, stops features, saves a snapshot and Long Poll state for the next process.
+        If queued updates are not handled in time, the snapshot is not saved and the next process
+        resumes Long Poll from the last response that was handled completely
+        :param timeout: float: Seconds to wait for queued updates, Config.SHUTDOWN_TIMEOUT by default
+        """
+        self._stopping = True
+        self._stop_event.set()
+        self._interruptible = False
+        for callback in (self.apply_flood_limits, self.apply_limits, self.apply_default_features, self.apply_jobs):
+            config.unsubscribe(callback)
+        self.dispatcher.stop(Config.SHUTDOWN_TIMEOUT if timeout is None else timeout)
+        pending = self.dispatcher.pending()
+        if pending:
+            logging.warning('%s updates were not handled before shutdown', len(pending))
+
+        for feature in self.features:
+            try:
+                stop = self.features[feature].shutdown
+            except AttributeError:
+                continue
+            try:
+                stop()
+            except Exception:
+                logging.exception('Could not stop %s', feature)
+        self.scheduler.shutdown(wait=True)
+
+        if self.dispatcher.is_alive():
+            # Features may still be changed by the dispatcher thread
+            logging.warning('Dispatcher is still running, snapshot is not saved')
+        else:
+            self.save_snapshot()
+        if Config.DEDUP_PERSIST:
+            for update in pending:  # The next process gets them again
+                if update.code == 4 and update.message_id is not None:
+                    self.dedup.forget(update.peer_id, update.message_id)
+            self.db.set_state('dedup', self.dedup.dump())
+        if self.recorder is not None:
+            self.recorder.close()
+        ts = self.handled_ts() if pending else self.ts
+        if ts is not None:
+            self.db.set_state('long_poll', {'key': self.key, 'server': self.server, 'ts': ts, 'saved_at': time.time()})
+            logging.info('Saved Long Poll state for the next process, ts = %s', ts)
+
+    def handled_ts(self):
+        """
+        :return: int: Long Poll ts of the last response whose updates are all handled by the dispatcher
+        """
+        handled = self.dispatcher.handled()
+        while self._checkpoints and self._checkpoints[0][0] <= handled:
+            self._handled_ts = self._checkpoints.popleft()[1]
+        return self._handled_ts
+
+    def take_handoff(self):
+        """
+        :return: tuple(key, server, ts) saved by the previous process on shutdown, or None
+        """
+        state = self.db.pop_state('long_poll')
+        if state is None or time.time() - state['saved_at'] > HANDOFF_MAX_AGE:
+            return None
+        # If the key has expired, VK answers with "failed" == 2 and long_poll() gets a new one keeping ts
+        logging.info('Resuming Long Poll from ts = %s', state['ts'])
+        return state['key'], state['server'], state['ts']
+
+    def memory_usage(self) -> dict:
+        """
+        Must be called from the dispatcher thread
+        :return: dict: {subsystem: approximate size in bytes}, features report their own usage with memory_usage()
+        """
+        usage = {
+            'chats': deep_size(self._chats) + deep_size(self.dict_feature_chats),
+            'activity': self.activity.memory_usage(),
+            'dedup': self.dedup.memory_usage(),
+            'flood': self.dispatcher.flood_control.memory_usage(),
+        }
+        for feature in self.features:
+            try:
+                usage[feature] = self.features[feature].memory_usage()
+            except AttributeError:
+                pass
+        return usage
+
+    def evict_chats(self):
+        """
+        Evicts state of chats that had no updates for Config.CHAT_IDLE_TTL seconds, then of the least recently active
+        chats while features take more than Config.MEMORY_BUDGET megabytes. Features read evicted state
+        from the database on the chat's next update. Runs in the dispatcher thread every EVICT_INTERVAL seconds
+        """
+        usage = self.memory_usage()
+        resident = sum(usage.get(feature, 0) for feature in self.features)
+        budget = Config.MEMORY_BUDGET * 1024 * 1024
+
+        evicted = 0
+        for chat_id in self.activity.coldest(self._chats.union(self.activity)):
+            idle = self.activity.idle_for(chat_id)
+            if idle < EVICT_MIN_IDLE or (idle < Config.CHAT_IDLE_TTL and resident <= budget):
+                break   # Other chats were active even more recently
+            freed = self.evict_chat(chat_id)
+            if freed:
+                evicted += 1
+                resident -= freed
+        self.activity.prune(Config.CHAT_IDLE_TTL)
+
+        if evicted:
+            metrics.incr('chats.evicted', evicted)
+            logging.info('Evicted %s inactive chats, features take %s bytes', evicted, resident)
+        if resident > budget:
+            logging.warning('Features take %s bytes after eviction, memory budget is %s MB',
+                            resident, Config.MEMORY_BUDGET)
+        metrics.gauge('chats.active', len(self.activity))
+        for name, size in self.memory_usage().items():
+            metrics.gauge('memory.' + name, size)
+
+    def evict_chat(self, chat_id) -> int:
+        """
+        Calls evict_chat hooks of features
+        :return: int: Bytes freed
+        """
+        freed = 0
+        for feature in self.features:
+            try:
+                freed += self.features[feature].evict_chat(chat_id) or 0
+            except AttributeError:
+                pass
+        return freed
+
+    def report_metrics(self):
+        """
+        Logs all metrics, runs every Config.METRICS_INTERVAL seconds
+        """
+        metrics.gauge('dedup.size', len(self.dedup))
+        metrics.gauge('dedup.bytes', self.dedup.memory_usage())
+        logging.info(log.Event('metrics', **metrics.snapshot()))
+
+    def handle_update(self, update: Update):
+        logging.debug('Got new update: %s', update, extra=SAMPLE_UPDATE)
+        if update.code == 4 and update.chat_id is not None:
+            self.activity.touch(update.chat_id)
 
         if not Config.DEBUG:
             self.check_for_commands(update)
             self.check_for_service_message(update)
             for feature in self.features:
                 try:
-                    if update[0] in self.features[feature].triggered_by:
-                        if int(update[3] - 2e9) in self.dict_feature_chats[feature]:
+                    if update.code in self.features[feature].triggered_by:
+                        if update.chat_id in self.dict_feature_chats[feature]:
                             self.features[feature](update)
-                            logging.debug('Called {f} with {u}'.format(f=feature, u=update))
+                            logging.debug('Called %s with %s', feature, update, extra=SAMPLE_FEATURE_CALL)
 
                 except VkAPIError as api_err:
                     logging.error('VkAPIError occurred, was caught, but not handled.', exc_info=True)
                     # if api_err.code == TODO: Proper handling of VK API errors
 
-        elif update[0] == 4 and int(update[3] - 2e9) in Config.DEBUG_ALLOWED_CHATS:
+        elif update.code == 4 and update.chat_id in Config.DEBUG_ALLOWED_CHATS:
             self.check_for_commands(update)
             self.check_for_service_message(update)
             for feature in self.features:
-                if update[0] in self.features[feature].triggered_by:
-                    if int(update[3] - 2e9) in self.dict_feature_chats[feature]:
+                if update.code in self.features[feature].triggered_by:
+                    if update.chat_id in self.dict_feature_chats[feature]:
                         self.features[feature](update)
-                        logging.debug('Called {f} with {u}'.format(f=feature, u=update))
+                        logging.debug('Called %s with %s', feature, update, extra=SAMPLE_FEATURE_CALL)
 
     def import_features(self) -> dict:
         """
@@ -141,21 +630,22 @@ class Bot:
 
         for feature in Config.INSTALLED_FEATURES:
             features[feature] = (import_module('ubotvk.bot_features.' + feature).__init__(self.vk_api))
-            logging.debug('Initialized {}'.format(feature))
-        logging.info('Initialized all {} features'.format(len(features)))
+            logging.debug('Initialized %s', feature)
+        logging.info('Initialized all %s features', len(features))
         return features
 
-    def check_for_commands(self, update):
-        if update[0] == 4 and (update[2] & 2) == 0:
-            if int(update[3] - 2e9) not in self._chats:
-                self.new_chat(int(update[3] - 2e9))
+    def check_for_commands(self, update: Update):
+        if update.code == 4 and update.is_inbox:
+            if update.chat_id not in self._chats:
+                self.new_chat(update.chat_id)
 
-            if update[5].strip()[:len(str(self.vk_id))+4] == '[id{}|'.format(self.vk_id):
-                command = utils.command_in_string(update[5].strip(), ['add', 'on', 'remove', 'off', 'help', 'хелп'])
+            if update.text.startswith(self._mention):
+                command = utils.command_in_string(update.text, ['add', 'on', 'remove', 'off', 'help', 'хелп',
+                                                                'reload'])
                 if command:
-                    self.handle_command(command, int(update[3] - 2e9))
+                    self.handle_command(command, update.chat_id, update.from_id)
 
-    def handle_command(self, command, chat_id):
+    def handle_command(self, command, chat_id, from_id=None):
         if command[0] in ['add', 'on']:
             self.command_add(command[1:], chat_id)
 
@@ -165,30 +655,36 @@ class Bot:
         elif command[0] in ['help', 'хелп']:
             self.command_help(chat_id)
 
+        elif command[0] == 'reload' and from_id == Config.MAINTAINER_VK_ID:
+            self.vk_api.messages.send(peer_id=peer_id(chat_id), message=self.reload_config())
+
     def command_add(self, command, chat_id):
         feature = command[0]
         if feature in Config.INSTALLED_FEATURES:
             if chat_id not in self.dict_feature_chats[feature]:
-                self.db.add_feature(chat_id, feature)
-                self.dict_feature_chats[feature].append(chat_id)
+                if feature in Config.DEFAULT_FEATURES:
+                    self.db.enable_default(chat_id, feature)
+                else:
+                    self.db.add_feature(chat_id, feature)
+                self.dict_feature_chats[feature].add(chat_id)
                 try:
                     self.features[feature].new_chat(chat_id)
-                    logging.debug('{}.new_chat() was called'.format(feature))
+                    logging.debug('%s.new_chat() was called', feature)
                 except AttributeError:
-                    logging.debug('{} has no new_chat method'.format(feature))
+                    logging.debug('%s has no new_chat method', feature)
 
-                self.vk_api.messages.send(peer_id=int(chat_id+2e9), message='Включил {} для этого чата'.format(feature))
-                logging.info('Added new feature {f} to chat {c}'.format(f=command[0], c=str(chat_id)))
+                self.vk_api.messages.send(peer_id=peer_id(chat_id), message='Включил {} для этого чата'.format(feature))
+                logging.info('Added new feature %s to chat %s', command[0], chat_id)
 
             else:
                 self.vk_api.messages.send(
-                    peer_id=int(chat_id+2e9),
+                    peer_id=peer_id(chat_id),
                     message=f'Функция уже включена.\n'
                             f'Доступные функции: {", ".join([f for f in Config.INSTALLED_FEATURES])}.'
                 )
         else:
             self.vk_api.messages.send(
-                peer_id=int(chat_id+2e9),
+                peer_id=peer_id(chat_id),
                 message=f'Нет такой функции.\n'
                 f'Доступные функции: {", ".join([f for f in Config.INSTALLED_FEATURES])}.'
             )
@@ -197,21 +693,23 @@ class Bot:
         feature = command[0]
         if feature in Config.INSTALLED_FEATURES:
             if chat_id in self.dict_feature_chats[feature]:
-                if feature not in Config.DEFAULT_FEATURES:
+                if feature in Config.DEFAULT_FEATURES:
+                    self.db.disable_default(chat_id, feature)
+                else:
                     self.db.remove_feature(chat_id, feature)
 
-                self.dict_feature_chats[feature].remove(chat_id)
+                self.dict_feature_chats[feature].discard(chat_id)
                 try:
                     self.features[feature].remove_chat(chat_id)
-                    logging.debug('{}.remove_chat() was called'.format(feature))
+                    logging.debug('%s.remove_chat() was called', feature)
                 except AttributeError:
-                    logging.debug('{} has no remove_chat method'.format(feature))
+                    logging.debug('%s has no remove_chat method', feature)
 
-                self.vk_api.messages.send(peer_id=int(chat_id+2e9), message='Отключил {} для этого чата'.format(feature))
-                logging.info('Removed feature {f} from chat {c}'.format(f=command[0], c=str(chat_id)))
+                self.vk_api.messages.send(peer_id=peer_id(chat_id), message='Отключил {} для этого чата'.format(feature))
+                logging.info('Removed feature %s from chat %s', command[0], chat_id)
             else:
                 self.vk_api.messages.send(
-                    peer_id=int(chat_id + 2e9),
+                    peer_id=peer_id(chat_id),
                     message=
                     f'Функция уже отключена.\n'
                     f'Включенные функции: '
@@ -219,7 +717,7 @@ class Bot:
                 )
         else:
             self.vk_api.messages.send(
-                peer_id=int(chat_id+2e9),
+                peer_id=peer_id(chat_id),
                 message=f'Нет такой функции.\n'
                 f'Включенные функции: '
                 f'{", ".join([f for f in self.dict_feature_chats if chat_id in self.dict_feature_chats[f]])}.'
@@ -227,68 +725,64 @@ class Bot:
 
     def command_help(self, chat_id):
         self.vk_api.messages.send(
-            peer_id=int(chat_id + 2e9),
-            message=f'Включить функцию: @[id{self.vk_id}|bot] on <название функции>\n'
-                    f'Отключить функцию: @[id{self.vk_id}|bot] off <название функции>\n'
-                    f'Отправить это сообщение еще раз: @[id{self.vk_id}|bot] help\n\n'
+            peer_id=peer_id(chat_id),
+            message=f'Включить функцию: @{self._mention}bot] on <название функции>\n'
+                    f'Отключить функцию: @{self._mention}bot] off <название функции>\n'
+                    f'Отправить это сообщение еще раз: @{self._mention}bot] help\n\n'
                     f'Список доступных функций: {", ".join([f for f in Config.INSTALLED_FEATURES])}.'
         )
 
     def new_chat(self, chat_id):
         self.db.add_chat(chat_id)
-        self._chats.append(chat_id)
+        self._chats.add(chat_id)
 
         for feature in Config.DEFAULT_FEATURES:
-            self.dict_feature_chats[feature].append(chat_id)
+            self.dict_feature_chats[feature].add(chat_id)
 
         self.vk_api.messages.send(
-            peer_id=int(chat_id+2e9),
+            peer_id=peer_id(chat_id),
             message='а'
         )
         self.command_help(chat_id)
 
-        logging.info('Added new chat {}'.format(chat_id))
+        logging.info('Added new chat %s', chat_id)
 
-    def check_for_service_message(self, update):
-        try:
-            if update[0] == 4 and 'source_act' in update[6]:
-                if update[6]['source_act'] == 'chat_invite_user' and not update[6]['source_mid'] == str(self.vk_id):
-                    logging.info('User was invited in update {}'.format(update))
-                    self.new_member(int(update[3]-2e9), int(update[6]['source_mid']))
-
-                if update[6]['source_act'] == 'chat_kick_user' and not update[6]['source_mid'] == str(self.vk_id):
-                    logging.info('User was kicked in update {}'.format(update))
-                    self.remove_member(int(update[3]-2e9), int(update[6]['source_mid']))
-
-                if update[6]['source_act'] == 'chat_invite_user_by_link':
-                    if update[6]['from'] == str(self.vk_id):
-                        logging.info('Bot joined the conversation in update {}'.format(update))
-                        if int(update[3] - 2e9) not in self._chats:
-                            self.new_chat(int(update[3]-2e9))
-                    else:
-                        logging.info('User joined the conversation in update {}'.format(update))
-                        self.new_member(int(update[3]-2e9), int(update[6]['from']))
-
-        except IndexError as er:
-            logging.warning('VK returned Long Poll update with code 4, but update[6] raised IndexError: {}'.format(er))
+    def check_for_service_message(self, update: Update):
+        if update.code == 4 and update.action:
+            if update.action == 'chat_invite_user' and not update.action_member_id == self.vk_id:
+                logging.info('User was invited in update %s', update)
+                self.new_member(update.chat_id, update.action_member_id)
+
+            if update.action == 'chat_kick_user' and not update.action_member_id == self.vk_id:
+                logging.info('User was kicked in update %s', update)
+                self.remove_member(update.chat_id, update.action_member_id)
+
+            if update.action == 'chat_invite_user_by_link':
+                if update.from_id == self.vk_id:
+                    logging.info('Bot joined the conversation in update %s', update)
+                    if update.chat_id not in self._chats:
+                        self.new_chat(update.chat_id)
+                else:
+                    logging.info('User joined the conversation in update %s', update)
+                    self.new_member(update.chat_id, update.from_id)
 
     def new_member(self, chat_id, user_id):
         for feature in Config.INSTALLED_FEATURES:
             try:
                 self.features[feature].new_member(chat_id, user_id)
-                logging.debug('Called new_member method of {}'.format(feature))
+                logging.debug('Called new_member method of %s', feature)
 
             except AttributeError:
-                logging.debug('{} has no new_member method'.format(feature))
+                logging.debug('%s has no new_member method', feature)
 
     def remove_member(self, chat_id, user_id):
         for feature in Config.INSTALLED_FEATURES:
             try:
                 self.features[feature].remove_member(chat_id, user_id)
-                logging.debug('Called remove_member method of {}'.format(feature))
+                logging.debug('Called remove_member method of %s', feature)
 
             except AttributeError:
-                logging.debug('{} has no remove_member method'.format(feature))
+                logging.debug('%s has no remove_member method', feature)
 
     def crash_handler(self, exc=None):
         try:
@@ -1,5 +1,9 @@
+import logging
+import threading
 
+from ubotvk import utils
 from ubotvk.config import Config
+from ubotvk.metrics import metrics
 
 
 def __init__(vk_api):
@@ -7,12 +11,115 @@ def __init__(vk_api):
 
 
 class ForwardMessages(object):
+    """
+    Forwards inbox messages to Config.MAINTAINER_VK_ID.
+    With Config.FORWARD_DIGEST messages are buffered and sent as digests of up to FORWARD_DIGEST_SIZE messages,
+    at least every FORWARD_DIGEST_INTERVAL seconds. If digests can't be sent, buffer grows up to
+    FORWARD_BUFFER_LIMIT messages, messages over the limit are dropped and counted.
+    A digest that failed partway is continued from the first part that was not sent
+    """
+
     def __init__(self, vk_api):
         self.vk = vk_api
 
         # Long Poll codes that should trigger this feature. More info: https://vk.com/dev/using_longpoll
         self.triggered_by = [4]
 
+        self._buffer = []
+        self._unsent = []   # Parts of the last digest that were not sent
+        self._lock = threading.Lock()
+        self._timer = None
+        self._failing = False   # Last digest was not sent, wait for the timer instead of retrying on every message
+        self.dropped = 0
+
     def __call__(self, update):
-        if (update[2] & 2) == 0:    # Check if message is inbox
-            self.vk.messages.send(peer_id=Config.MAINTAINER_VK_ID, message=str(update))
+        if update.is_inbox and self.is_forwarded(update.chat_id):
+            if Config.FORWARD_DIGEST:
+                self.add(str(update.raw))
+            else:
+                self.vk.messages.send(peer_id=Config.MAINTAINER_VK_ID, message=str(update.raw))
+
+    @staticmethod
+    def is_forwarded(chat_id) -> bool:
+        if Config.FORWARD_CHATS and chat_id not in Config.FORWARD_CHATS:
+            return False
+        return chat_id not in Config.FORWARD_IGNORE_CHATS
+
+    def add(self, message: str):
+        with self._lock:
+            if len(self._buffer) >= Config.FORWARD_BUFFER_LIMIT:
+                self.dropped += 1
+                metrics.incr('forward_messages.dropped')
+                return
+
+            self._buffer.append(message)
+            full = len(self._buffer) >= Config.FORWARD_DIGEST_SIZE and not self._failing
+            if not full:
+                self._schedule_flush()
+
+        if full:
+            self.flush()
+
+    def flush(self):
+        """
+        Sends the next digest. If VK or the network fails, parts of the digest that were not sent are kept
+        and sent first by the next flush, so messages are neither lost nor sent twice
+        """
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            parts, self._unsent = self._unsent, []
+            if not parts:
+                messages = self._buffer[:Config.FORWARD_DIGEST_SIZE]
+                self._buffer = self._buffer[Config.FORWARD_DIGEST_SIZE:]
+                dropped, self.dropped = self.dropped, 0
+                if messages or dropped:
+                    digest = '\n'.join(messages)
+                    if dropped:
+                        digest += '\n\nDropped {} messages, buffer was full'.format(dropped)
+                    parts = utils.split_message(digest)
+
+        if not parts:
+            return
+
+        sent = 0
+        try:
+            for part in parts:
+                self.vk.messages.send(peer_id=Config.MAINTAINER_VK_ID, message=part)
+                sent += 1
+            metrics.incr('forward_messages.digests')
+            self._failing = False
+        except Exception:
+            logging.warning('Could not send %s of %s parts of a digest, will retry', len(parts) - sent, len(parts),
+                            exc_info=True)
+            with self._lock:
+                self._failing = True
+                self._unsent = parts[sent:]
+
+        with self._lock:    # Messages that didn't fit in this digest go to the next one
+            if self._buffer or self._unsent:
+                self._schedule_flush()
+
+    def shutdown(self):
+        """
+        Sends the buffered messages before exit
+        """
+        while self._buffer or self._unsent or self.dropped:
+            self.flush()
+            if self._failing:
+                logging.warning('Lost %s forwarded messages on shutdown', len(self._buffer) + self.dropped)
+                break
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+
+    def _schedule_flush(self):
+        """
+        Starts the timer of the next digest if it is not running. Must be called with self._lock held
+        """
+        if self._timer is None:
+            self._timer = threading.Timer(Config.FORWARD_DIGEST_INTERVAL, self.flush)
+            self._timer.daemon = True
+            self._timer.start()
@@ -20,11 +20,11 @@ class HardBass(object):
         self.triggered_by = [4]
 
     def __call__(self, update):
-        if (update[2] & 2) == 0:    # Check if message is inbox
-            if update[7] and 'attach1_type' in update[7] and update[7]['attach1_type'] == 'audio':
-                self.vk.messages.send(peer_id=update[3], message=random.choice(RESPONSES),
-                                      forward_messages=update[1])
+        if update.is_inbox:
+            if update.attachments.get('attach1_type') == 'audio':
+                self.vk.messages.send(peer_id=update.peer_id, message=random.choice(RESPONSES),
+                                      forward_messages=update.message_id)
                 time.sleep(0.5)
-                self.vk.messages.send(peer_id=update[3], message='Вот это нормальная музыка',
+                self.vk.messages.send(peer_id=update.peer_id, message='Вот это нормальная музыка',
                                       attachment='audio{}'.format(random.choice(AUDIO_LIST)))
 
@@ -1,63 +1,85 @@
 import sqlite3
 import random
+import threading
 import time
 import logging
+from datetime import datetime, timedelta
 
-from pytz import timezone
-from apscheduler.schedulers.background import BackgroundScheduler
+from pytz import timezone, UnknownTimeZoneError
 from vk_requests.exceptions import VkAPIError
 
-from ubotvk import utils
+from ubotvk import config, snapshot, utils
+from ubotvk.activity import deep_size
 from ubotvk.config import Config
+from ubotvk.update import peer_id
+from .roster import Roster
 
 DATABASE_FILE = 'data/pidors.sqlite3'
+SNAPSHOT_FILE = 'data/pidors.snapshot'
 TOP_EMOJI = {1: '🏳‍🌈️🔥', 2: '🍑🍌', 3: '👬💖', 4: '🌚🌝', 5: '🐔💞'}
+TIMEZONE = timezone(Config.PIDORS_TIMEZONE)    # Default time zone of chats
+SEND_RATE = 3   # Messages per second, VK allows 3 requests per second for user tokens
+
+# Leaderboard windows: {period: strftime format of the period key}
+PERIODS = {'day': '%Y-%m-%d', 'week': '%G-W%V', 'month': '%Y-%m', 'all': 'all'}
+PERIOD_TITLES = {'week': 'за неделю', 'month': 'за месяц', 'all': 'за все время'}
+PERIOD_COMMANDS = {'неделя': 'week', 'week': 'week', 'месяц': 'month', 'month': 'month'}
 
 
 class Pidors:
     def __init__(self, vk_api):
         self._vk = vk_api
-        self._vk_id = self._vk.users.get()[0]['id']
-        self._chats_database = Database()
+        self._vk_id = utils.own_id(self._vk)
+        self._chats_database = Database(snapshot_file=SNAPSHOT_FILE)
+        self._roster = Roster(self._vk, self._chats_database, self._vk_id)
 
-        scheduler = BackgroundScheduler(timezone=timezone('Europe/Moscow'))
-        if Config.DEBUG:
-            scheduler.add_job(self.pidors_job, 'cron', minute='*')
-        else:
-            scheduler.add_job(self.pidors_job, 'cron', hour='8')
-        scheduler.start()
+        self._stop = threading.Event()  # Set on shutdown, long jobs stop before their next chat
+        self._now = datetime.now        # Current time in a time zone, replaced in tests
+        self._scheduler = None
+        config.subscribe(self.reschedule, 'DEBUG', 'PIDORS_STAGE_HOUR')
 
         # Long Poll codes that should trigger this feature. More info: https://vk.com/dev/using_longpoll
         self.triggered_by = [4]
+        # Words that start commands of this feature, the recorder keeps messages that start with them
+        self.commands = ['toppidor', 'топпидор', 'njggbljh', 'ещззшвщк', 'пидор', 'pidor', 'зшвщк', 'gbljh',
+                         'pidortz', 'пидортз']
 
     def __call__(self, update):
-        if (update[2] & 2) == 0:  # Check if message is inbox
-            command = utils.command_in_string(update[5], ['toppidor', 'топпидор', 'njggbljh', 'ещззшвщк',
-                                                          'пидор', 'pidor', 'зшвщк', 'gbljh'])
+        if update.is_inbox:
+            command = utils.command_in_string(update.text, self.commands)
             if command:
                 if command[0] in ['toppidor', 'топпидор', 'njggbljh', 'ещззшвщк']:
-                    self.top_pidor(int(update[3]-2e9))
+                    period = PERIOD_COMMANDS.get(command[1], 'all') if len(command) > 1 else 'all'
+                    self.top_pidor(update.chat_id, period)
 
                 if command[0] in ['пидор', 'pidor', 'зшвщк', 'gbljh']:
-                    self.pidor(int(update[3]-2e9))
+                    self.pidor(update.chat_id)
 
-    def top_pidor(self, chat_id):
-        pidors = self._vk.messages.getConversationMembers(peer_id=int(chat_id+2e9), fields='id')['profiles']
-        pidors = list(filter(lambda x: not x['id'] == self._vk_id, pidors))
+                if command[0] in ['pidortz', 'пидортз']:
+                    if len(command) > 1:
+                        self.set_timezone(update.chat_id, command[1])
+                    else:
+                        self._vk.messages.send(peer_id=peer_id(update.chat_id),
+                                               message='Укажи часовой пояс, пример: /pidortz Europe/Moscow')
+
+    def top_pidor(self, chat_id, period='all'):
+        day = today(self._chats_database.get_timezone(chat_id))
+        counts = self._chats_database.get_leaderboard(chat_id, period, period_key(period, day))
+        pidors = [dict(member) for member in self._roster.members(chat_id).values()]
 
         for pidor in pidors:
-            pidor['pidor_count'] = self._chats_database.get_user_count(pidor['id'])
+            pidor['pidor_count'] = counts.get(pidor['id'], 0)
 
         pidors = sorted(pidors, key=lambda x: x['pidor_count'], reverse=True)
 
-        response = 'Рейтинг пидоров за все время:\n'
+        response = f'Рейтинг пидоров {PERIOD_TITLES[period]}:\n'
         count = 1
         for p in pidors:
             response += \
                 f'{TOP_EMOJI.get(count, str(count)+".")} {p["first_name"]} {p["last_name"]} - {p["pidor_count"]}\n'
             count += 1
 
-        self._vk.messages.send(peer_id=int(chat_id + 2e9), message=response)
+        self._vk.messages.send(peer_id=peer_id(chat_id), message=response)
 
         # pidors = self._chats_database.get_pidors(chat_id)   # TODO get list from vk
         # if pidors:
@@ -69,9 +91,9 @@ class Pidors:
         #         count += 1
         #         total_pidor_count += pidor[3]
         #     # response += '\nСредний показатель пидорства: ' + str(total_pidor_count / (count - 1))
-        #     self._vk.messages.send(peer_id=int(chat_id+2e9), message=response)
+        #     self._vk.messages.send(peer_id=peer_id(chat_id), message=response)
         # else:
-        #     self._vk.messages.send(peer_id=int(chat_id+2e9), message='Случилась какая-то хуйня, в базе данных пидоров '
+        #     self._vk.messages.send(peer_id=peer_id(chat_id), message='Случилась какая-то хуйня, в базе данных пидоров '
         #                                                              'не было найдено ни одного пидора из этого чата.\n'
         #                                                              'Скорее всего в этом виноват [id{}|он], '
         #                                                              'если его нет в чате - напишите ему в ЛС, что он '
@@ -86,84 +108,250 @@ class Pidors:
     def pidor(self, chat_id):
         pidor_id = self._chats_database.get_last_pidor(chat_id)
         if pidor_id is not None:
-            count = self._chats_database.get_user_count(pidor_id)
-            user = self._vk.users.get(user_ids=pidor_id)[0]
+            # Selections made before Rollups were added are only counted in Pidors_2
+            count = self._chats_database.get_count(chat_id, pidor_id) or self._chats_database.get_user_count(pidor_id)
+            user = self._roster.members(chat_id).get(pidor_id) or self._vk.users.get(user_ids=pidor_id)[0]
             response = """Сегодня пидором в {c} раз был избран {f_name} {l_name}."""\
                        .format(c=count, f_name=user['first_name'], l_name=user['last_name'])
         else:
             response = "В этом чате еще никто не был избран пидором"
 
-        self._vk.messages.send(peer_id=int(chat_id+2e9), message=response)
+        self._vk.messages.send(peer_id=peer_id(chat_id), message=response)
 
     def pidors_job(self):   # TODO use VK execute
         if Config.DEBUG:
             chats = Config.DEBUG_ALLOWED_CHATS
         else:
-            chats = self._chats_database.chats
-        logging.debug(f'Contents of chats list: {chats}')
+            chats = list(self._chats_database.chats)
+        logging.debug('Contents of chats list: %s', chats)
         start_time, end_time = 0, 1
         for chat in chats:
             time_delta = end_time - start_time
             if time_delta < 1:
-                logging.debug('Sleeping for {} seconds'.format(1-time_delta))
+                logging.debug('Sleeping for %s seconds', 1-time_delta)
                 time.sleep(1-time_delta)
             start_time = time.time()
             try:
-                logging.debug(f'Choosing pidor for chat {chat}')
+                logging.debug('Choosing pidor for chat %s', chat)
                 self.choose_pidor(chat)
             except VkAPIError as err:
-                logging.info(f'choose_pidor() for chat {chat} resulted in VkAPIError: {err}')
+                logging.info('choose_pidor() for chat %s resulted in VkAPIError: %s', chat, err)
             end_time = time.time()
                 
-    def choose_pidor(self, chat):
-        members = self._vk.messages.getConversationMembers(peer_id=int(chat + 2e9), fields='id')['profiles']
-        members = list(filter(lambda x: not x['id'] == self._vk_id, members))
-        logging.debug(f'Got conversation members for chat {chat}: {members}')
+    def set_timezone(self, chat_id, name):
+        try:
+            tz = timezone(name)
+        except UnknownTimeZoneError:
+            self._vk.messages.send(peer_id=peer_id(chat_id),
+                                   message='Не знаю такого часового пояса, пример: Europe/Moscow')
+            return
+        self._chats_database.set_timezone(chat_id, tz.zone)
+        self._vk.messages.send(peer_id=peer_id(chat_id),
+                               message=f'Пидор дня будет объявляться в {Config.PIDORS_SEND_HOUR}:00 по {tz.zone}')
+
+    def stage_job(self):
+        """
+        Chooses pidors for the next announcement in every chat and saves rendered messages for send_job
+        """
+        staged = 0
+        for chat in list(self._chats_database.chats):
+            if self._stop.is_set():
+                break
+            tz = self._chats_database.get_timezone(chat)
+            now = self._now(tz)
+            day = now.date() if now.hour < Config.PIDORS_SEND_HOUR else now.date() + timedelta(days=1)
+            if self._chats_database.is_staged(chat, day):
+                continue
+
+            try:
+                pidor = self.select(chat)
+            except VkAPIError as err:
+                logging.info('Could not choose pidor for chat %s: %s', chat, err)
+                continue
+            if pidor is not None:
+                self._chats_database.stage(chat, day, pidor['id'], self.render(pidor))
+                staged += 1
+        logging.info('Staged pidors for %s chats', staged)
+
+    def send_job(self):
+        """
+        Sends staged messages of chats where it's already PIDORS_SEND_HOUR, SEND_RATE messages per second
+        """
+        for chat, day, user_id, message in self._chats_database.get_unsent():
+            if self._stop.is_set():     # Unsent messages are left for the next process
+                break
+            if chat not in self._chats_database.chats:  # Turned off after the pidor was staged
+                self._chats_database.mark_expired(chat, day)
+                continue
+            now = self._now(self._chats_database.get_timezone(chat))
+            if day < now.date():
+                logging.info('Staged pidor for chat %s on %s was not sent in time', chat, day)
+                self._chats_database.mark_expired(chat, day)
+                continue
+            if day > now.date() or now.hour < Config.PIDORS_SEND_HOUR:
+                continue
+
+            start = time.monotonic()
+            try:
+                self._vk.messages.send(peer_id=peer_id(chat), message=message)
+            except VkAPIError as err:
+                logging.info('Could not send pidor to chat %s: %s', chat, err)
+                self._chats_database.mark_expired(chat, day)
+            else:
+                self._chats_database.mark_sent(chat, day, user_id)
+            self._stop.wait(max(1 / SEND_RATE - (time.monotonic() - start), 0))
+
+    def roster_job(self):
+        chats = Config.DEBUG_ALLOWED_CHATS if Config.DEBUG else self._chats_database.chats
+        self._roster.resync_stale(chats, stop=self._stop)
+
+    def select(self, chat):
+        """
+        :return: dict: Profile of a random chat member or None if there are no members
+        """
+        members = list(self._roster.members(chat).values())
+        if not members:
+            logging.info('Chat %s has no members to choose from', chat)
+            return None
         random.seed()
         pidor = random.choice(members)
-        if pidor['id'] not in self._chats_database.users:
-            self._chats_database.add_user(pidor['id'])
-        self._chats_database.increment_pidor_count(pidor['id'])
-        self._chats_database.set_last_pidor(chat, pidor['id'])
-        message = """Пидор сегодняшнего дня: [id{id}|{f_name} {l_name}]. Поздравляем!"""\
-                  .format(id=pidor['id'], f_name=pidor['first_name'], l_name=pidor['last_name'])
-        logging.info(f'Chose new pidor for chat {chat}: {pidor["id"]} {pidor["first_name"]} {pidor["last_name"]}')
-        res = self._vk.messages.send(peer_id=int(2e9+chat), message=message)
-        logging.debug(f'Sent a message with new pidor, response: {res}')
+        logging.info('Chose new pidor for chat %s: %s %s %s', chat, pidor['id'], pidor['first_name'], pidor['last_name'])
+        return pidor
+
+    @staticmethod
+    def render(pidor):
+        return """Пидор сегодняшнего дня: [id{id}|{f_name} {l_name}]. Поздравляем!"""\
+               .format(id=pidor['id'], f_name=pidor['first_name'], l_name=pidor['last_name'])
+
+    def choose_pidor(self, chat):
+        """
+        Chooses and announces pidor right away, without staging
+        """
+        pidor = self.select(chat)
+        if pidor is None:
+            return
+        if not self._chats_database.add_selection(chat, today(), pidor['id']) and not Config.DEBUG:
+            logging.info('Pidor for chat %s was already chosen today', chat)
+            return
+        res = self._vk.messages.send(peer_id=peer_id(chat), message=self.render(pidor))
+        logging.debug('Sent a message with new pidor, response: %s', res)
 
     def new_chat(self, chat_id):
         if chat_id not in self._chats_database.chats:
-            if chat_id not in self._chats_database.get_all_chats():
-                # members = self._vk.messages.getConversationMembers(peer_id=int(chat_id + 2e9))['profiles']
-                # for member in members:
-                #     self._chats_database.add_member(chat_id, member)
-                self._chats_database.add_chat(chat_id)
-            else:
+            if self._chats_database.has_chat(chat_id):
                 self._chats_database.chat_on_again(chat_id)
+            else:
+                self._chats_database.add_chat(chat_id)
+            self._roster.invalidate(chat_id)    # Members were not tracked while the feature was off
 
     def remove_chat(self, chat_id):
         if chat_id in self._chats_database.chats:
             self._chats_database.remove_chat(chat_id)
+            self._chats_database.remove_staged(chat_id)
+            self._roster.forget(chat_id)
 
-    # def new_member(self, chat_id, user_id):
-    #     members = self._chats_database.get_all_members(chat_id)
-    #     if user_id in members:
-    #         self._chats_database.member_came_back(chat_id, user_id)
-    #         logging.debug('Member {} came back to chat {}'.format(user_id, chat_id))
-    #     elif int(user_id) > 0:
-    #         member = self._vk.users.get(user_ids=user_id)[0]
-    #         self._chats_database.add_member(chat_id, member)
-    #         logging.debug('New member {} in chat {}'.format(user_id, chat_id))
-    #
-    # def remove_member(self, chat_id, user_id):
-    #     self._chats_database.member_left(chat_id, user_id)
+    def new_member(self, chat_id, user_id):
+        if chat_id in self._chats_database.chats:
+            self._roster.add(chat_id, user_id)
+
+    def remove_member(self, chat_id, user_id):
+        if chat_id in self._chats_database.chats:
+            self._roster.remove(chat_id, user_id)
+
+    def evict_chat(self, chat_id) -> int:
+        return self._roster.forget(chat_id)
+
+    def memory_usage(self) -> int:
+        return self._roster.memory_usage() + deep_size(self._chats_database.chats)
+
+    def save_snapshot(self):
+        self._chats_database.save_snapshot()
+
+    def register_jobs(self, scheduler):
+        self._scheduler = scheduler
+        if Config.DEBUG:
+            scheduler.add_job(self.pidors_job, 'cron', job_id='pidors.pidors_job', minute='*')
+        else:
+            # Results are chosen in advance, the sender only sends them when it is PIDORS_SEND_HOUR in the chat
+            scheduler.add_job(self.stage_job, 'cron', job_id='pidors.stage_job', catch_up=True,
+                              timezone=TIMEZONE, hour=Config.PIDORS_STAGE_HOUR)
+            scheduler.add_job(self.send_job, 'cron', job_id='pidors.send_job', minute='*/15')
+        scheduler.add_job(self.roster_job, 'cron', job_id='pidors.roster_job', jitter=600, timezone=TIMEZONE, hour=4)
+
+    def reschedule(self, changes):
+        """
+        Registers jobs again after DEBUG or PIDORS_STAGE_HOUR was reloaded
+        """
+        if self._scheduler is None:
+            return
+        for job_id in ('pidors.pidors_job', 'pidors.stage_job', 'pidors.send_job'):
+            self._scheduler.remove_job(job_id)
+        self.register_jobs(self._scheduler)
+
+    def shutdown(self):
+        """
+        Makes running jobs stop after their current chat
+        """
+        self._stop.set()
+        config.unsubscribe(self.reschedule)
+
+
+def today(tz=TIMEZONE):
+    return datetime.now(tz).date()
+
+
+def period_key(period, day):
+    """
+    :param period: str: One of PERIODS
+    :param day: datetime.date
+    :return: str: Key of the period that contains the day, e.g. '2018-10' for 'month'
+    """
+    return day.strftime(PERIODS[period])
 
 
 class Database:
-    def __init__(self, db_file=DATABASE_FILE):
+    def __init__(self, db_file=DATABASE_FILE, snapshot_file=None):
+        """
+        :param snapshot_file: str: Chats are loaded from this snapshot if it was saved at the current version of Chats
+        """
         self.db_file = db_file
+        self.snapshot_file = snapshot_file
         self.create_if_not_exists()
-        self.chats = self.get_chats()
+        self.chats = self.load_chats()
+
+    def load_chats(self):
+        if self.snapshot_file is not None:
+            state = snapshot.read(self.snapshot_file)
+            if state is not None:
+                with state:
+                    if state.meta.get('version') == self.get_version():
+                        try:
+                            return set(state.get('chats'))
+                        except ValueError:
+                            logging.warning('Snapshot %s is broken, loading chats from the database',
+                                            self.snapshot_file, exc_info=True)
+                    else:
+                        logging.info('Snapshot %s is outdated, loading chats from the database', self.snapshot_file)
+        return set(self.get_chats())
+
+    def save_snapshot(self):
+        snapshot.write(self.snapshot_file, {'version': self.get_version()}, {'chats': self.chats})
+
+    def get_version(self) -> int:
+        """
+        :return: int: Number of changes made to Chats
+        """
+        conn = sqlite3.connect(self.db_file)
+        cursor = conn.cursor()
+        cursor.execute("""SELECT value FROM Meta WHERE key='chats_version'""")
+        version = cursor.fetchone()
+        conn.close()
+        return version[0] if version else 0
+
+    @staticmethod
+    def _bump_version(cursor):
+        cursor.execute("""INSERT OR IGNORE INTO Meta (key, value) VALUES ('chats_version', 0)""")
+        cursor.execute("""UPDATE Meta SET value = value + 1 WHERE key='chats_version'""")
 
     def create_if_not_exists(self):
         conn = sqlite3.connect(self.db_file)
@@ -174,6 +362,22 @@ class Database:
                           (user_id, pidor_count)""")
         cursor.execute("""CREATE TABLE IF NOT EXISTS Chats 
                       (chat_id integer, feature_is_on integer, last_pidor_id integer)""")
+        cursor.execute("""CREATE INDEX IF NOT EXISTS Chats_chat_id ON Chats (chat_id)""")
+        cursor.execute("""CREATE TABLE IF NOT EXISTS Members
+                          (chat_id integer, user_id integer, first_name text, last_name text,
+                           PRIMARY KEY (chat_id, user_id))""")
+        cursor.execute("""CREATE TABLE IF NOT EXISTS Rosters (chat_id integer PRIMARY KEY, synced_at integer)""")
+        cursor.execute("""CREATE TABLE IF NOT EXISTS History
+                          (chat_id integer, date text, user_id integer, PRIMARY KEY (chat_id, date))""")
+        cursor.execute("""CREATE TABLE IF NOT EXISTS Rollups
+                          (chat_id integer, period text, period_key text, user_id integer, count integer,
+                           PRIMARY KEY (chat_id, period, period_key, user_id))""")
+        cursor.execute("""CREATE TABLE IF NOT EXISTS Staged
+                          (chat_id integer, date text, user_id integer, message text, sent integer DEFAULT 0,
+                           PRIMARY KEY (chat_id, date))""")
+        cursor.execute("""CREATE INDEX IF NOT EXISTS Staged_sent ON Staged (sent)""")
+        cursor.execute("""CREATE TABLE IF NOT EXISTS Timezones (chat_id integer PRIMARY KEY, timezone text)""")
+        cursor.execute("""CREATE TABLE IF NOT EXISTS Meta (key text PRIMARY KEY, value integer)""")
         conn.commit()
         conn.close()
 
@@ -186,38 +390,58 @@ class Database:
         conn.close()
         return (x[0] for x in users)
 
-    # def add_member(self, chat_id, member):
-    #     _id = member['id']
-    #     _full_name = member['first_name'] + ' ' + member['last_name']
-    #
-    #     conn = sqlite3.connect(self.db_file)
-    #     cursor = conn.cursor()
-    #     cursor.execute("""INSERT INTO Pidors (chat_id, user_id, user_name, user_pidor_count, user_is_in_chat)
-    #                       VALUES (?, ?, ?, ?, 1)""", (chat_id, _id, _full_name, 0))
-    #     conn.commit()
-    #     conn.close()
-    #
-    # def member_came_back(self, chat_id, user_id):
-    #     conn = sqlite3.connect(self.db_file)
-    #     cursor = conn.cursor()
-    #     cursor.execute("""UPDATE Pidors SET user_is_in_chat=1 WHERE chat_id=? AND user_id=?""", (chat_id, user_id))
-    #     conn.commit()
-    #     conn.close()
-    #
-    # def member_left(self, chat_id, user_id):
-    #     conn = sqlite3.connect(self.db_file)
-    #     cursor = conn.cursor()
-    #     cursor.execute("""UPDATE Pidors SET user_is_in_chat=0 WHERE chat_id=? AND user_id=?""", (chat_id, user_id))
-    #     conn.commit()
-    #     conn.close()
-    #
-    # def get_all_members(self, chat_id):
-    #     conn = sqlite3.connect(self.db_file)
-    #     cursor = conn.cursor()
-    #     cursor.execute("""SELECT user_id FROM Pidors WHERE Pidors.chat_id=?""", (chat_id,))
-    #     members = cursor.fetchall()
-    #     conn.close()
-    #     return [member[0] for member in members]
+    def get_members(self, chat_id):
+        conn = sqlite3.connect(self.db_file)
+        cursor = conn.cursor()
+        cursor.execute("""SELECT user_id, first_name, last_name FROM Members WHERE chat_id=?""", (chat_id,))
+        members = {user_id: {'id': user_id, 'first_name': first_name, 'last_name': last_name}
+                   for user_id, first_name, last_name in cursor.fetchall()}
+        conn.close()
+        return members
+
+    def add_member(self, chat_id, member):
+        conn = sqlite3.connect(self.db_file)
+        cursor = conn.cursor()
+        cursor.execute("""INSERT OR REPLACE INTO Members (chat_id, user_id, first_name, last_name)
+                          VALUES (?, ?, ?, ?)""", (chat_id, member['id'], member['first_name'], member['last_name']))
+        conn.commit()
+        conn.close()
+
+    def remove_member(self, chat_id, user_id):
+        conn = sqlite3.connect(self.db_file)
+        cursor = conn.cursor()
+        cursor.execute("""DELETE FROM Members WHERE chat_id=? AND user_id=?""", (chat_id, user_id))
+        conn.commit()
+        conn.close()
+
+    def replace_members(self, chat_id, members):
+        conn = sqlite3.connect(self.db_file)
+        cursor = conn.cursor()
+        cursor.execute("""DELETE FROM Members WHERE chat_id=?""", (chat_id,))
+        cursor.executemany("""INSERT INTO Members (chat_id, user_id, first_name, last_name) VALUES (?, ?, ?, ?)""",
+                           [(chat_id, m['id'], m['first_name'], m['last_name']) for m in members])
+        cursor.execute("""INSERT OR REPLACE INTO Rosters (chat_id, synced_at) VALUES (?, ?)""",
+                       (chat_id, int(time.time())))
+        conn.commit()
+        conn.close()
+
+    def reset_roster(self, chat_id):
+        conn = sqlite3.connect(self.db_file)
+        cursor = conn.cursor()
+        cursor.execute("""DELETE FROM Rosters WHERE chat_id=?""", (chat_id,))
+        conn.commit()
+        conn.close()
+
+    def get_roster_synced(self, chat_id):
+        """
+        :return: unix time of the last full fetch of the chat's members or None if it was never fetched
+        """
+        conn = sqlite3.connect(self.db_file)
+        cursor = conn.cursor()
+        cursor.execute("""SELECT synced_at FROM Rosters WHERE chat_id=?""", (chat_id,))
+        synced = cursor.fetchone()
+        conn.close()
+        return synced[0] if synced else None
 
     def add_user(self, user_id):
         conn = sqlite3.connect(self.db_file)
@@ -252,6 +476,154 @@ class Database:
     #     conn.close()
     #     return pidor_count[0] if pidor_count is not None else None
 
+    def add_selection(self, chat_id, day, user_id) -> bool:
+        """
+        Appends the selection to History, increments its counters in Rollups for every period,
+        the global count in Pidors_2 and sets Chats.last_pidor_id
+        :param day: datetime.date
+        :return: bool: False if there already was a selection in this chat on this day
+        """
+        conn = sqlite3.connect(self.db_file)
+        cursor = conn.cursor()
+        try:
+            self._add_selection(cursor, chat_id, day, user_id)
+        except sqlite3.IntegrityError:
+            conn.close()
+            return False
+        conn.commit()
+        conn.close()
+        return True
+
+    @staticmethod
+    def _add_selection(cursor, chat_id, day, user_id):
+        cursor.execute("""INSERT INTO History (chat_id, date, user_id) VALUES (?, ?, ?)""",
+                       (chat_id, day.isoformat(), user_id))
+
+        for period in PERIODS:
+            key = period_key(period, day)
+            cursor.execute("""INSERT OR IGNORE INTO Rollups (chat_id, period, period_key, user_id, count)
+                              VALUES (?, ?, ?, ?, 0)""", (chat_id, period, key, user_id))
+            cursor.execute("""UPDATE Rollups SET count = count + 1
+                              WHERE chat_id=? AND period=? AND period_key=? AND user_id=?""",
+                           (chat_id, period, key, user_id))
+
+        cursor.execute("""SELECT user_id FROM Pidors_2 WHERE user_id=?""", (user_id,))
+        if cursor.fetchone() is None:
+            cursor.execute("""INSERT INTO Pidors_2 (user_id, pidor_count) VALUES (?, 0)""", (user_id,))
+        cursor.execute("""UPDATE Pidors_2 SET pidor_count = pidor_count + 1 WHERE user_id=?""", (user_id,))
+        cursor.execute("""UPDATE Chats SET last_pidor_id=? WHERE chat_id=?""", (user_id, chat_id))
+
+    def stage(self, chat_id, day, user_id, message):
+        conn = sqlite3.connect(self.db_file)
+        cursor = conn.cursor()
+        cursor.execute("""INSERT OR IGNORE INTO Staged (chat_id, date, user_id, message) VALUES (?, ?, ?, ?)""",
+                       (chat_id, day.isoformat(), user_id, message))
+        conn.commit()
+        conn.close()
+
+    def is_staged(self, chat_id, day) -> bool:
+        conn = sqlite3.connect(self.db_file)
+        cursor = conn.cursor()
+        cursor.execute("""SELECT 1 FROM Staged WHERE chat_id=? AND date=?""", (chat_id, day.isoformat()))
+        staged = cursor.fetchone()
+        conn.close()
+        return staged is not None
+
+    def get_unsent(self):
+        """
+        :return: list of (chat_id, datetime.date, user_id, message)
+        """
+        conn = sqlite3.connect(self.db_file)
+        cursor = conn.cursor()
+        cursor.execute("""SELECT chat_id, date, user_id, message FROM Staged WHERE sent=0 ORDER BY date""")
+        unsent = cursor.fetchall()
+        conn.close()
+        return [(chat_id, datetime.strptime(day, '%Y-%m-%d').date(), user_id, message)
+                for chat_id, day, user_id, message in unsent]
+
+    def mark_sent(self, chat_id, day, user_id):
+        """
+        Marks staged message as sent and records the selection, see add_selection()
+        """
+        conn = sqlite3.connect(self.db_file)
+        cursor = conn.cursor()
+        cursor.execute("""UPDATE Staged SET sent=1 WHERE chat_id=? AND date=?""", (chat_id, day.isoformat()))
+        try:
+            self._add_selection(cursor, chat_id, day, user_id)
+        except sqlite3.IntegrityError:
+            logging.warning('Pidor for chat %s on %s was already recorded', chat_id, day)
+        conn.commit()
+        conn.close()
+
+    def mark_expired(self, chat_id, day):
+        conn = sqlite3.connect(self.db_file)
+        cursor = conn.cursor()
+        cursor.execute("""UPDATE Staged SET sent=-1 WHERE chat_id=? AND date=?""", (chat_id, day.isoformat()))
+        conn.commit()
+        conn.close()
+
+    def remove_staged(self, chat_id):
+        """
+        Deletes selections of the chat that were not sent yet
+        """
+        conn = sqlite3.connect(self.db_file)
+        cursor = conn.cursor()
+        cursor.execute("""DELETE FROM Staged WHERE chat_id=? AND sent=0""", (chat_id,))
+        conn.commit()
+        conn.close()
+
+    def get_timezone(self, chat_id):
+        """
+        :return: pytz timezone of the chat, TIMEZONE if it wasn't set
+        """
+        conn = sqlite3.connect(self.db_file)
+        cursor = conn.cursor()
+        cursor.execute("""SELECT timezone FROM Timezones WHERE chat_id=?""", (chat_id,))
+        tz = cursor.fetchone()
+        conn.close()
+        return timezone(tz[0]) if tz else TIMEZONE
+
+    def set_timezone(self, chat_id, name):
+        conn = sqlite3.connect(self.db_file)
+        cursor = conn.cursor()
+        cursor.execute("""INSERT OR REPLACE INTO Timezones (chat_id, timezone) VALUES (?, ?)""", (chat_id, name))
+        conn.commit()
+        conn.close()
+
+    def get_leaderboard(self, chat_id, period='all', key='all') -> dict:
+        """
+        :return: dict: {user_id: number of selections in the chat during the period}
+        """
+        conn = sqlite3.connect(self.db_file)
+        cursor = conn.cursor()
+        cursor.execute("""SELECT user_id, count FROM Rollups WHERE chat_id=? AND period=? AND period_key=?""",
+                       (chat_id, period, key))
+        leaderboard = dict(cursor.fetchall())
+        conn.close()
+        return leaderboard
+
+    def get_count(self, chat_id, user_id, period='all', key='all') -> int:
+        conn = sqlite3.connect(self.db_file)
+        cursor = conn.cursor()
+        cursor.execute("""SELECT count FROM Rollups WHERE chat_id=? AND period=? AND period_key=? AND user_id=?""",
+                       (chat_id, period, key, user_id))
+        count = cursor.fetchone()
+        conn.close()
+        return count[0] if count else 0
+
+    def get_history(self, chat_id, since=None):
+        """
+        :param since: datetime.date: First day to return, all history if None
+        :return: list of (date as str, user_id)
+        """
+        conn = sqlite3.connect(self.db_file)
+        cursor = conn.cursor()
+        cursor.execute("""SELECT date, user_id FROM History WHERE chat_id=? AND date >= ? ORDER BY date""",
+                       (chat_id, since.isoformat() if since else ''))
+        history = cursor.fetchall()
+        conn.close()
+        return history
+
     def get_last_pidor(self, chat_id):
         conn = sqlite3.connect(self.db_file)
         cursor = conn.cursor()
@@ -300,26 +672,40 @@ class Database:
         conn.close()
         return [chat[0] for chat in chats]
 
+    def has_chat(self, chat_id) -> bool:
+        """
+        :return: bool: True if the chat was ever added, even if the feature is off now
+        """
+        conn = sqlite3.connect(self.db_file)
+        cursor = conn.cursor()
+        cursor.execute("""SELECT 1 FROM Chats WHERE chat_id=?""", (chat_id,))
+        row = cursor.fetchone()
+        conn.close()
+        return row is not None
+
     def add_chat(self, chat_id):
         conn = sqlite3.connect(self.db_file)
         cursor = conn.cursor()
         cursor.execute("""INSERT INTO Chats (chat_id, feature_is_on) VALUES (?, ?)""", (chat_id, 1))
+        self._bump_version(cursor)
         conn.commit()
         conn.close()
-        self.chats.append(chat_id)
+        self.chats.add(chat_id)
 
     def chat_on_again(self, chat_id):
         conn = sqlite3.connect(self.db_file)
         cursor = conn.cursor()
         cursor.execute("""UPDATE Chats SET feature_is_on=1 WHERE chat_id=?""", (chat_id,))
+        self._bump_version(cursor)
         conn.commit()
         conn.close()
-        self.chats.append(chat_id)
+        self.chats.add(chat_id)
 
     def remove_chat(self, chat_id):
         conn = sqlite3.connect(self.db_file)
         cursor = conn.cursor()
         cursor.execute("""UPDATE Chats SET feature_is_on=0 WHERE chat_id=?""", (chat_id,))
+        self._bump_version(cursor)
         conn.commit()
         conn.close()
-        self.chats.remove(chat_id)
+        self.chats.discard(chat_id)
@@ -0,0 +1,114 @@
+import logging
+import threading
+import time
+
+from vk_requests.exceptions import VkAPIError
+
+from ubotvk.activity import deep_size
+from ubotvk.update import peer_id
+
+
+RESYNC_AFTER = 7 * 24 * 60 * 60     # Seconds after which a roster is fetched from VK again
+
+
+class Roster:
+    """
+    Members of chats: {chat_id: {user_id: {'id': ..., 'first_name': ..., 'last_name': ...}}}
+    Kept in memory and in the database, updated from invite/kick service messages
+    and fetched from VK with messages.getConversationMembers only if it's missing or older than RESYNC_AFTER
+    """
+
+    def __init__(self, vk_api, database, vk_id):
+        self._vk = vk_api
+        self._db = database
+        self._vk_id = vk_id
+        self._members = {}
+        self._lock = threading.Lock()
+
+    def members(self, chat_id) -> dict:
+        """
+        :return: dict: {user_id: profile} of chat members, without the bot itself
+        """
+        members = self._members.get(chat_id)
+        if members is None:
+            if self._db.get_roster_synced(chat_id) is None:
+                members = self.resync(chat_id)
+            else:
+                members = self._db.get_members(chat_id)
+            with self._lock:
+                members = self._members.setdefault(chat_id, members)
+        return members
+
+    def add(self, chat_id, user_id):
+        if user_id <= 0 or user_id == self._vk_id:  # Communities and the bot itself are not members
+            return
+        user = self._vk.users.get(user_ids=user_id)[0]
+        profile = {'id': user['id'], 'first_name': user['first_name'], 'last_name': user['last_name']}
+        self._db.add_member(chat_id, profile)
+        with self._lock:
+            if chat_id in self._members:
+                self._members[chat_id][user_id] = profile
+        logging.debug('New member %s in chat %s', user_id, chat_id)
+
+    def remove(self, chat_id, user_id):
+        self._db.remove_member(chat_id, user_id)
+        with self._lock:
+            if chat_id in self._members:
+                self._members[chat_id].pop(user_id, None)
+        logging.debug('Member %s left chat %s', user_id, chat_id)
+
+    def resync(self, chat_id) -> dict:
+        """
+        Fetches the whole member list from VK
+        """
+        profiles = self._vk.messages.getConversationMembers(peer_id=peer_id(chat_id), fields='id')['profiles']
+        members = {p['id']: {'id': p['id'], 'first_name': p['first_name'], 'last_name': p['last_name']}
+                   for p in profiles if not p['id'] == self._vk_id}
+        self._db.replace_members(chat_id, members.values())
+        with self._lock:
+            if chat_id in self._members:
+                self._members[chat_id] = members
+        logging.debug('Fetched %s members of chat %s', len(members), chat_id)
+        return members
+
+    def resync_stale(self, chats, max_age=RESYNC_AFTER, interval=1.0, stop=None):
+        """
+        Fetches rosters that are older than max_age, one chat every `interval` seconds
+        :param stop: threading.Event: Returns early when it is set
+        """
+        stop = stop or threading.Event()
+        now = time.time()
+        for chat_id in list(chats):
+            if stop.is_set():
+                return
+            synced = self._db.get_roster_synced(chat_id)
+            if synced is not None and now - synced < max_age:
+                continue
+            try:
+                self.resync(chat_id)
+            except VkAPIError:
+                logging.warning('Could not fetch members of chat %s', chat_id, exc_info=True)
+            stop.wait(interval)
+
+    def forget(self, chat_id) -> int:
+        """
+        Removes the roster from memory, it is read from the database on next use
+        :return: int: Approximate number of bytes freed
+        """
+        with self._lock:
+            members = self._members.pop(chat_id, None)
+        return deep_size(members) if members is not None else 0
+
+    def memory_usage(self) -> int:
+        """
+        :return: int: Approximate size of rosters kept in memory in bytes
+        """
+        with self._lock:
+            return deep_size(self._members)
+
+    def invalidate(self, chat_id):
+        """
+        Marks the roster as outdated, it is fetched from VK on next use
+        """
+        self._db.reset_roster(chat_id)
+        self.forget(chat_id)
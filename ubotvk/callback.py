@@ -0,0 +1,155 @@
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import json
+import logging
+import queue
+import socketserver
+import threading
+
+import requests
+
+from ubotvk.metrics import metrics
+from ubotvk.update import Update
+
+
+# Callback API events that are converted to Updates. More info: https://vk.com/dev/callback_api
+MESSAGE_EVENTS = ('message_new', 'message_reply')
+
+
+class _ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class CallbackServer:
+    """
+    HTTP server for VK Callback API.
+    Answers the confirmation request, checks the secret key and puts message events to a queue as Updates,
+    the bot takes them from the queue in its own thread with get_batch().
+    Callback API is available only to communities, events are messages sent to the community
+    """
+
+    def __init__(self, host='0.0.0.0', port=8080, confirmation='', secret=None, queue_size=10000, group_id=None):
+        """
+        :param host: str: Address to listen on
+        :param port: int: Port to listen on, 0 for any free port
+        :param confirmation: str: String that VK expects in response to "confirmation" event
+        :param secret: str: Secret key from community settings, events with other key are rejected
+        :param queue_size: int: Events over this number are answered with HTTP 503, VK will retry them
+        :param group_id: int: Id of the community, events of other communities are rejected, None to accept all
+        """
+        self.confirmation = confirmation
+        self.secret = secret
+        self.group_id = group_id
+        self.queue = queue.Queue(maxsize=queue_size)
+        self._server = _ThreadingHTTPServer((host, port), self._make_handler())
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return 'http://{}:{}/'.format('127.0.0.1' if host == '0.0.0.0' else host, port)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name='callback-server', daemon=True)
+        self._thread.start()
+        logging.info('Callback API server is listening on %s', self.url)
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def get_batch(self, timeout=1.0) -> list:
+        """
+        Waits for at least one event
+        :param timeout: float: Seconds to wait
+        :return: list of all queued Updates, empty if there were none in `timeout` seconds
+        """
+        try:
+            batch = [self.queue.get(timeout=timeout)]
+        except queue.Empty:
+            return []
+        while True:
+            try:
+                batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                return batch
+
+    def handle_event(self, event: dict):
+        """
+        :return: tuple(int: HTTP status, str: response body)
+        """
+        if self.secret and event.get('secret') != self.secret:
+            metrics.incr('callback.rejected')
+            return 403, 'wrong secret'
+        if self.group_id is not None and event.get('group_id') != self.group_id:
+            metrics.incr('callback.rejected')
+            return 403, 'wrong group'
+
+        if event.get('type') == 'confirmation':
+            return 200, self.confirmation
+
+        if event.get('type') in MESSAGE_EVENTS:
+            try:
+                self.queue.put_nowait(Update.from_callback(event))
+            except queue.Full:
+                metrics.incr('callback.queue_full')
+                return 503, 'busy'
+            metrics.incr('callback.events')
+
+        return 200, 'ok'
+
+    def _make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                try:
+                    length = int(self.headers.get('Content-Length', 0))
+                    event = json.loads(self.rfile.read(length).decode('utf-8'))
+                    status, body = server.handle_event(event)
+                except (ValueError, KeyError, TypeError):
+                    logging.warning('Callback API server got a malformed event', exc_info=True)
+                    status, body = 400, 'bad request'
+
+                body = body.encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'text/plain; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logging.debug('Callback API request: ' + format, *args)
+
+        return Handler
+
+
+class CallbackClient:
+    """
+    Sends events to a Callback API server the way VK does, for local testing
+    """
+
+    def __init__(self, url, secret=None, group_id=1):
+        self.url = url
+        self.secret = secret
+        self.group_id = group_id
+
+    def send(self, event_type, obj=None):
+        """
+        :return: requests.Response
+        """
+        event = {'type': event_type, 'group_id': self.group_id}
+        if obj is not None:
+            event['object'] = obj
+        if self.secret:
+            event['secret'] = self.secret
+        return requests.post(self.url, data=json.dumps(event), timeout=5)
+
+    def confirm(self) -> str:
+        return self.send('confirmation').text
+
+    def message(self, peer_id, text, from_id=None, message_id=1, action=None, attachments=None):
+        obj = {'id': message_id, 'date': 0, 'peer_id': peer_id, 'from_id': from_id or peer_id, 'text': text,
+               'attachments': attachments or []}
+        if action:
+            obj['action'] = action
+        return self.send('message_new', obj)
@@ -1,10 +1,34 @@
 import json
+import logging
 import os
+import threading
 
 
-class Config:
+CONFIG_FILE = os.path.join(os.path.abspath(os.path.dirname(__file__)), 'config.json')
+
+# Settings that reload() applies to the running bot, changes of other settings need a restart
+RELOADABLE = (
+    'DEFAULT_FEATURES', 'DEBUG', 'DEBUG_ALLOWED_CHATS',
+    'LOG_LEVEL', 'LOG_SAMPLE', 'METRICS_INTERVAL', 'SNAPSHOT_INTERVAL',
+    'FORWARD_DIGEST', 'FORWARD_DIGEST_SIZE', 'FORWARD_DIGEST_INTERVAL', 'FORWARD_BUFFER_LIMIT',
+    'FORWARD_CHATS', 'FORWARD_IGNORE_CHATS',
+    'FLOOD_CHAT_RATE', 'FLOOD_CHAT_BURST', 'FLOOD_USER_RATE', 'FLOOD_USER_BURST',
+    'DISPATCH_BACKLOG', 'CHAT_WEIGHTS', 'DEDUP_TTL', 'CHAT_IDLE_TTL', 'MEMORY_BUDGET',
+    'PIDORS_STAGE_HOUR', 'PIDORS_SEND_HOUR',
+)
+
+
+class ConfigError(ValueError):
+    pass
+
+
+def read() -> dict:
+    """
+    Reads settings from config.json, or from environment variables if there is no config.json
+    :return: dict: {setting name: value}
+    """
     try:
-        _conf = json.loads(open(os.path.join(os.path.abspath(os.path.dirname(__file__)), 'config.json'), 'r').read())
+        _conf = json.loads(open(CONFIG_FILE, 'r').read())
 
         LOGIN = str(_conf['login'])
         PASSWORD = str(_conf['password'])
@@ -15,6 +39,44 @@ class Config:
 
         LOG_DIR = _conf.get('log_dir', None)
         LOG_LEVEL = _conf.get('log_level', 'WARNING')
+        LOG_ASYNC = bool(_conf.get('log_async', True))
+        LOG_SAMPLE = int(_conf.get('log_sample', 1))
+        METRICS_INTERVAL = int(_conf.get('metrics_interval', 600))
+        SNAPSHOT_FILE = _conf.get('snapshot_file', 'data/bot.snapshot')
+        SNAPSHOT_INTERVAL = int(_conf.get('snapshot_interval', 600))
+        SHUTDOWN_TIMEOUT = float(_conf.get('shutdown_timeout', 8))
+        SCHEDULER_WORKERS = int(_conf.get('scheduler_workers', 4))
+        RECORD_DIR = _conf.get('record_dir', None)
+        RECORD_ANONYMIZE = bool(_conf.get('record_anonymize', True))
+
+        CALLBACK_PORT = int(_conf['callback_port']) if _conf.get('callback_port', None) else None
+        CALLBACK_CONFIRMATION = _conf.get('callback_confirmation', '')
+        CALLBACK_SECRET = _conf.get('callback_secret', None)
+        CALLBACK_GROUP_ID = int(_conf['callback_group_id']) if _conf.get('callback_group_id', None) else None
+        CALLBACK_GROUP_TOKEN = _conf.get('callback_group_token', None)
+
+        FORWARD_DIGEST = bool(_conf.get('forward_digest', False))
+        FORWARD_DIGEST_SIZE = int(_conf.get('forward_digest_size', 50))
+        FORWARD_DIGEST_INTERVAL = float(_conf.get('forward_digest_interval', 60))
+        FORWARD_BUFFER_LIMIT = int(_conf.get('forward_buffer_limit', 1000))
+        FORWARD_CHATS = tuple(_conf['forward_chats']) if _conf.get('forward_chats', None) else None
+        FORWARD_IGNORE_CHATS = tuple(_conf.get('forward_ignore_chats', []))
+
+        FLOOD_CHAT_RATE = float(_conf.get('flood_chat_rate', 1))
+        FLOOD_CHAT_BURST = int(_conf.get('flood_chat_burst', 20))
+        FLOOD_USER_RATE = float(_conf.get('flood_user_rate', 0.5))
+        FLOOD_USER_BURST = int(_conf.get('flood_user_burst', 10))
+        DISPATCH_BACKLOG = int(_conf.get('dispatch_backlog', 1000))
+        CHAT_WEIGHTS = {int(chat): int(weight) for chat, weight in _conf.get('chat_weights', {}).items()}
+        DEDUP_SIZE = int(_conf.get('dedup_size', 10000))
+        DEDUP_TTL = float(_conf.get('dedup_ttl', 3600))
+        DEDUP_PERSIST = bool(_conf.get('dedup_persist', True))
+        CHAT_IDLE_TTL = int(_conf.get('chat_idle_ttl', 21600))
+        MEMORY_BUDGET = float(_conf.get('memory_budget', 64))
+
+        PIDORS_TIMEZONE = _conf.get('pidors_timezone', 'Europe/Moscow')
+        PIDORS_STAGE_HOUR = int(_conf.get('pidors_stage_hour', 3))
+        PIDORS_SEND_HOUR = int(_conf.get('pidors_send_hour', 8))
         MAINTAINER_VK_ID = int(_conf['maintainer_vk_id'])
         DEBUG = _conf.get('debug', False)
         if DEBUG:
@@ -32,9 +94,175 @@ class Config:
 
         LOG_DIR = os.environ.get('UBOTVK_LOG_DIR', None)
         LOG_LEVEL = os.environ.get('UBOTVK_LOG_LEVEL', 'WARNING')
+        LOG_ASYNC = bool(int(os.environ.get('UBOTVK_LOG_ASYNC', 1)))
+        LOG_SAMPLE = int(os.environ.get('UBOTVK_LOG_SAMPLE', 1))
+        METRICS_INTERVAL = int(os.environ.get('UBOTVK_METRICS_INTERVAL', 600))
+        SNAPSHOT_FILE = os.environ.get('UBOTVK_SNAPSHOT_FILE', 'data/bot.snapshot')
+        SNAPSHOT_INTERVAL = int(os.environ.get('UBOTVK_SNAPSHOT_INTERVAL', 600))
+        SHUTDOWN_TIMEOUT = float(os.environ.get('UBOTVK_SHUTDOWN_TIMEOUT', 8))
+        SCHEDULER_WORKERS = int(os.environ.get('UBOTVK_SCHEDULER_WORKERS', 4))
+        RECORD_DIR = os.environ.get('UBOTVK_RECORD_DIR', None)
+        RECORD_ANONYMIZE = bool(int(os.environ.get('UBOTVK_RECORD_ANONYMIZE', 1)))
+
+        CALLBACK_PORT = \
+            int(os.environ['UBOTVK_CALLBACK_PORT']) if os.environ.get('UBOTVK_CALLBACK_PORT', None) else None
+        CALLBACK_CONFIRMATION = os.environ.get('UBOTVK_CALLBACK_CONFIRMATION', '')
+        CALLBACK_SECRET = os.environ.get('UBOTVK_CALLBACK_SECRET', None)
+        CALLBACK_GROUP_ID = \
+            int(os.environ['UBOTVK_CALLBACK_GROUP_ID']) if os.environ.get('UBOTVK_CALLBACK_GROUP_ID', None) else None
+        CALLBACK_GROUP_TOKEN = os.environ.get('UBOTVK_CALLBACK_GROUP_TOKEN', None)
+
+        FORWARD_DIGEST = bool(int(os.environ.get('UBOTVK_FORWARD_DIGEST', 0)))
+        FORWARD_DIGEST_SIZE = int(os.environ.get('UBOTVK_FORWARD_DIGEST_SIZE', 50))
+        FORWARD_DIGEST_INTERVAL = float(os.environ.get('UBOTVK_FORWARD_DIGEST_INTERVAL', 60))
+        FORWARD_BUFFER_LIMIT = int(os.environ.get('UBOTVK_FORWARD_BUFFER_LIMIT', 1000))
+        FORWARD_CHATS = tuple(int(x) for x in os.environ['UBOTVK_FORWARD_CHATS'].split(',')) \
+            if os.environ.get('UBOTVK_FORWARD_CHATS', None) else None
+        FORWARD_IGNORE_CHATS = tuple(int(x) for x in os.environ['UBOTVK_FORWARD_IGNORE_CHATS'].split(',')) \
+            if os.environ.get('UBOTVK_FORWARD_IGNORE_CHATS', None) else ()
+
+        FLOOD_CHAT_RATE = float(os.environ.get('UBOTVK_FLOOD_CHAT_RATE', 1))
+        FLOOD_CHAT_BURST = int(os.environ.get('UBOTVK_FLOOD_CHAT_BURST', 20))
+        FLOOD_USER_RATE = float(os.environ.get('UBOTVK_FLOOD_USER_RATE', 0.5))
+        FLOOD_USER_BURST = int(os.environ.get('UBOTVK_FLOOD_USER_BURST', 10))
+        DISPATCH_BACKLOG = int(os.environ.get('UBOTVK_DISPATCH_BACKLOG', 1000))
+        CHAT_WEIGHTS = {int(chat): int(weight) for chat, weight in
+                        (item.split(':') for item in os.environ['UBOTVK_CHAT_WEIGHTS'].split(','))} \
+            if os.environ.get('UBOTVK_CHAT_WEIGHTS', None) else {}
+        DEDUP_SIZE = int(os.environ.get('UBOTVK_DEDUP_SIZE', 10000))
+        DEDUP_TTL = float(os.environ.get('UBOTVK_DEDUP_TTL', 3600))
+        DEDUP_PERSIST = bool(int(os.environ.get('UBOTVK_DEDUP_PERSIST', 1)))
+        CHAT_IDLE_TTL = int(os.environ.get('UBOTVK_CHAT_IDLE_TTL', 21600))
+        MEMORY_BUDGET = float(os.environ.get('UBOTVK_MEMORY_BUDGET', 64))
+
+        PIDORS_TIMEZONE = os.environ.get('UBOTVK_PIDORS_TIMEZONE', 'Europe/Moscow')
+        PIDORS_STAGE_HOUR = int(os.environ.get('UBOTVK_PIDORS_STAGE_HOUR', 3))
+        PIDORS_SEND_HOUR = int(os.environ.get('UBOTVK_PIDORS_SEND_HOUR', 8))
         MAINTAINER_VK_ID = int(os.environ.get('UBOTVK_MAINTAINER_ID', 212771532))
         DEBUG = bool(os.environ.get('UBOTVK_DEBUG', False))
         if DEBUG:
             DEBUG_ALLOWED_CHATS = tuple(int(x) for x in os.environ['UBOTVK_DEBUG_CHATS'].split(','))
 
+    return {name: value for name, value in locals().items() if name.isupper()}
+
+
+class Config:
+    """
+    Current settings as class attributes, see read(). reload() replaces them while the bot is running
+    """
+    DEBUG_ALLOWED_CHATS = ()
+
+
+_lock = threading.Lock()
+_subscribers = []
+_mtime = None
+
+
+def _file_mtime():
+    try:
+        return os.stat(CONFIG_FILE).st_mtime
+    except OSError:
+        return None
+
+
+def validate(values: dict):
+    """
+    :raise ConfigError: if the settings can't be used
+    """
+    for name in ('FLOOD_CHAT_RATE', 'FLOOD_USER_RATE', 'FORWARD_DIGEST_INTERVAL', 'DEDUP_TTL', 'CHAT_IDLE_TTL',
+                 'MEMORY_BUDGET'):
+        if values[name] <= 0:
+            raise ConfigError('{} must be positive'.format(name))
+    for name in ('FLOOD_CHAT_BURST', 'FLOOD_USER_BURST', 'DISPATCH_BACKLOG', 'FORWARD_DIGEST_SIZE',
+                 'FORWARD_BUFFER_LIMIT', 'LOG_SAMPLE', 'DEDUP_SIZE', 'SCHEDULER_WORKERS'):
+        if values[name] < 1:
+            raise ConfigError('{} must be at least 1'.format(name))
+    for name in ('METRICS_INTERVAL', 'SNAPSHOT_INTERVAL'):
+        if values[name] < 0:
+            raise ConfigError('{} must not be negative'.format(name))
+    for name in ('PIDORS_STAGE_HOUR', 'PIDORS_SEND_HOUR'):
+        if not 0 <= values[name] <= 23:
+            raise ConfigError('{} must be an hour from 0 to 23'.format(name))
+    if not isinstance(logging.getLevelName(values['LOG_LEVEL']), int):
+        raise ConfigError('Unknown log level {}'.format(values['LOG_LEVEL']))
+    if any(weight < 1 for weight in values['CHAT_WEIGHTS'].values()):
+        raise ConfigError('CHAT_WEIGHTS must be at least 1')
+    installed = values['INSTALLED_FEATURES'] or Config.__dict__.get('INSTALLED_FEATURES')
+    if installed:
+        unknown = set(values['DEFAULT_FEATURES']) - set(installed)
+        if unknown:
+            raise ConfigError('Default features are not installed: {}'.format(', '.join(sorted(unknown))))
+
+
+def load():
+    """
+    Reads settings into Config, called on import
+    :raise ConfigError: if the settings can't be used, Config is not changed then
+    """
+    global _mtime
+    values = read()
+    values.setdefault('DEBUG_ALLOWED_CHATS', ())
+    validate(values)
+    _mtime = _file_mtime()
+    for name, value in values.items():
+        setattr(Config, name, value)
+
+
+def reload() -> dict:
+    """
+    Reads settings again and applies changes of RELOADABLE settings: all of them are set at once
+    after the new settings are validated, then subscribers are notified
+    :return: dict: {setting name: new value} of changed settings
+    :raise ConfigError: if the new settings are invalid, nothing is changed then
+    """
+    global _mtime
+    with _lock:
+        _mtime = _file_mtime()     # A broken file is not read again until it's changed
+        try:
+            values = read()
+        except (ValueError, KeyError, TypeError) as err:
+            raise ConfigError('Could not read config: {!r}'.format(err))
+        values.setdefault('DEBUG_ALLOWED_CHATS', ())
+        validate(values)
+
+        changes = {name: values[name] for name in RELOADABLE if values[name] != getattr(Config, name)}
+        ignored = [name for name in values if name not in RELOADABLE and values[name] != getattr(Config, name, None)
+                   and not (name == 'INSTALLED_FEATURES' and values[name] is None)]   # Discovered by the bot
+        if ignored:
+            logging.warning('Changes of %s need a restart', ', '.join(ignored))
+        for name, value in changes.items():
+            setattr(Config, name, value)
+        subscribers = list(_subscribers)
+
+    for callback, names in subscribers:
+        changed = {name: value for name, value in changes.items() if not names or name in names}
+        if changed:
+            try:
+                callback(changed)
+            except Exception:
+                logging.exception('Could not apply config changes %s with %s', changed, callback)
+    return changes
+
+
+def subscribe(callback, *names):
+    """
+    :param callback: function that takes {setting name: new value}, called after reload() changed the settings
+    :param names: Settings the callback is interested in, all RELOADABLE settings if none
+    """
+    with _lock:
+        _subscribers.append((callback, names))
+
+
+def unsubscribe(callback):
+    with _lock:
+        _subscribers[:] = [(cb, names) for cb, names in _subscribers if cb != callback]
+
+
+def file_changed() -> bool:
+    """
+    :return: bool: True if config.json was changed, created or removed since it was last read
+    """
+    return _file_mtime() != _mtime
+
 
+load()
@@ -3,28 +3,52 @@ import json
 
 from ubotvk.config import Config
 
+QUERY_CHUNK = 500   # Chat ids per "IN (...)" query, SQLite allows 999 parameters by default
+
 
 class Database:
-    def __init__(self, db_file):
+    def __init__(self, db_file, source='bot'):
+        """
+        :param db_file: str: Path to SQLite database
+        :param source: str: Written to the changelog with every change made through this instance
+        """
         self._db_file = db_file
+        self._source = source
         self._create_table_if_not_exists()
 
     def _create_table_if_not_exists(self):
         conn = sqlite3.connect(self._db_file)
         cursor = conn.cursor()
         cursor.execute("""CREATE TABLE IF NOT EXISTS features (chat_id integer, enabled_features text)""")
+        cursor.execute("""CREATE INDEX IF NOT EXISTS features_chat_id ON features (chat_id)""")
+        cursor.execute("""CREATE TABLE IF NOT EXISTS disabled_defaults
+                          (chat_id integer, feature text, PRIMARY KEY (chat_id, feature))""")
+        cursor.execute("""CREATE TABLE IF NOT EXISTS changelog
+                          (version integer PRIMARY KEY AUTOINCREMENT, chat_id integer, source text)""")
+        cursor.execute("""CREATE TABLE IF NOT EXISTS state (key text PRIMARY KEY, value text)""")
+        cursor.execute("""CREATE TABLE IF NOT EXISTS jobs
+                          (id text PRIMARY KEY, last_run real, duration real, error text)""")
         conn.commit()
         conn.close()
 
+    def _log_change(self, cursor, chat_id):
+        cursor.execute("""INSERT INTO changelog (chat_id, source) VALUES (?, ?)""", (chat_id, self._source))
+
     def get_feature_chats_dict(self, installed_features=Config.INSTALLED_FEATURES) -> dict:
         conn = sqlite3.connect(self._db_file)
         cursor = conn.cursor()
         cursor.execute("""SELECT chat_id, enabled_features FROM features""")
         features = cursor.fetchall()
 
+        disabled = {}
+        for chat_id, feature in cursor.execute("""SELECT chat_id, feature FROM disabled_defaults"""):
+            disabled.setdefault(chat_id, set()).add(feature)
+        conn.close()
+
         features_dict = {}
         for item in features:
-            features_dict[item[0]] = list(Config.DEFAULT_FEATURES) + json.loads(item[1])
+            defaults = [feature for feature in Config.DEFAULT_FEATURES if feature not in disabled.get(item[0], ())]
+            features_dict[item[0]] = defaults + json.loads(item[1])
 
         feature_chats_dict = {}
         for feature in installed_features:
@@ -50,6 +74,7 @@ class Database:
         if sel is None:
             cursor.execute("""INSERT INTO features (chat_id, enabled_features) VALUES (?, ?)""",
                            (chat_id, json.dumps([])))
+            self._log_change(cursor, chat_id)
             conn.commit()
             conn.close()
         else:
@@ -74,6 +99,7 @@ class Database:
             features = [feature]
 
         cursor.execute("""UPDATE features SET enabled_features=? WHERE chat_id=?""", (json.dumps(features), chat_id))
+        self._log_change(cursor, chat_id)
         conn.commit()
         conn.close()
 
@@ -92,5 +118,244 @@ class Database:
 
         cursor.execute("""UPDATE features SET enabled_features=? WHERE chat_id=?""",
                        (json.dumps(enabled_features), chat_id))
+        self._log_change(cursor, chat_id)
+        conn.commit()
+        conn.close()
+
+    def disable_default(self, chat_id: int, feature: str):
+        """
+        Turns off a feature from Config.DEFAULT_FEATURES for the chat, it stays off until enable_default() is called
+        """
+        assert isinstance(chat_id, int)
+        assert isinstance(feature, str)
+
+        conn = sqlite3.connect(self._db_file)
+        cursor = conn.cursor()
+        cursor.execute("""INSERT OR IGNORE INTO disabled_defaults (chat_id, feature) VALUES (?, ?)""",
+                       (chat_id, feature))
+        self._log_change(cursor, chat_id)
+        conn.commit()
+        conn.close()
+
+    def enable_default(self, chat_id: int, feature: str):
+        assert isinstance(chat_id, int)
+        assert isinstance(feature, str)
+
+        conn = sqlite3.connect(self._db_file)
+        cursor = conn.cursor()
+        cursor.execute("""DELETE FROM disabled_defaults WHERE chat_id=? AND feature=?""", (chat_id, feature))
+        self._log_change(cursor, chat_id)
+        conn.commit()
+        conn.close()
+
+    def get_chats_features(self, chat_ids) -> dict:
+        """
+        Reads features of many chats at once
+        :param chat_ids: iterable of ints
+        :return: dict: {chat_id: set of enabled features with Config.DEFAULT_FEATURES that were not turned off},
+                       chats that are not in the database are left out
+        """
+        chat_ids = list(chat_ids)
+        conn = sqlite3.connect(self._db_file)
+        cursor = conn.cursor()
+        features = {}
+        disabled = {}
+        for start in range(0, len(chat_ids), QUERY_CHUNK):
+            chunk = chat_ids[start:start + QUERY_CHUNK]
+            placeholders = ','.join('?' * len(chunk))
+            cursor.execute("""SELECT chat_id, enabled_features FROM features WHERE chat_id IN ({})"""
+                           .format(placeholders), chunk)
+            for chat_id, enabled in cursor.fetchall():
+                features[chat_id] = set(json.loads(enabled) if enabled else [])
+            cursor.execute("""SELECT chat_id, feature FROM disabled_defaults WHERE chat_id IN ({})"""
+                           .format(placeholders), chunk)
+            for chat_id, feature in cursor.fetchall():
+                disabled.setdefault(chat_id, set()).add(feature)
+        conn.close()
+
+        for chat_id, enabled in features.items():
+            enabled.update(set(Config.DEFAULT_FEATURES) - disabled.get(chat_id, set()))
+        return features
+
+    def get_chat_features(self, chat_id: int):
+        """
+        :return: list of features enabled for the chat (without Config.DEFAULT_FEATURES) or None if there is no such chat
+        """
+        conn = sqlite3.connect(self._db_file)
+        cursor = conn.cursor()
+        cursor.execute("""SELECT enabled_features FROM features WHERE chat_id=?""", (chat_id,))
+        row = cursor.fetchone()
+        conn.close()
+        if row is None:
+            return None
+        return json.loads(row[0]) if row[0] else []
+
+    def set_feature(self, chat_ids, feature: str, enabled=True) -> int:
+        """
+        Enables or disables a feature for many chats in one transaction.
+        Chats that are not in the database yet are added when a feature is enabled
+        :param chat_ids: iterable of ints
+        :param feature: str: Feature name
+        :param enabled: bool: Enable if True, disable if False
+        :return: int: Number of chats that were changed
+        """
+        assert isinstance(feature, str)
+
+        conn = sqlite3.connect(self._db_file)
+        cursor = conn.cursor()
+        changed = 0
+        try:
+            for chat_id in chat_ids:
+                assert isinstance(chat_id, int)
+                cursor.execute("""SELECT enabled_features FROM features WHERE chat_id=?""", (chat_id,))
+                row = cursor.fetchone()
+                features = json.loads(row[0]) if row and row[0] else []
+                if (feature in features) == enabled or (row is None and not enabled):
+                    continue
+
+                if enabled:
+                    features.append(feature)
+                else:
+                    features.remove(feature)
+
+                if row is None:
+                    cursor.execute("""INSERT INTO features (chat_id, enabled_features) VALUES (?, ?)""",
+                                   (chat_id, json.dumps(features)))
+                else:
+                    cursor.execute("""UPDATE features SET enabled_features=? WHERE chat_id=?""",
+                                   (json.dumps(features), chat_id))
+                self._log_change(cursor, chat_id)
+                changed += 1
+            conn.commit()
+        finally:
+            conn.close()
+        return changed
+
+    def iter_features(self):
+        """
+        Reads the features table row by row
+        :return: generator of (chat_id, list of enabled features)
+        """
+        conn = sqlite3.connect(self._db_file)
+        try:
+            for chat_id, features in conn.execute("""SELECT chat_id, enabled_features FROM features ORDER BY chat_id"""):
+                yield chat_id, json.loads(features) if features else []
+        finally:
+            conn.close()
+
+    def import_features(self, rows, replace=False) -> int:
+        """
+        Adds chats and their features in one transaction
+        :param rows: iterable of (chat_id, list of features)
+        :param replace: bool: Replace features of chats that are already in the database instead of merging them
+        :return: int: Number of imported rows
+        """
+        conn = sqlite3.connect(self._db_file)
+        cursor = conn.cursor()
+        count = 0
+        try:
+            for chat_id, features in rows:
+                assert isinstance(chat_id, int)
+                cursor.execute("""SELECT enabled_features FROM features WHERE chat_id=?""", (chat_id,))
+                row = cursor.fetchone()
+                if row is None:
+                    cursor.execute("""INSERT INTO features (chat_id, enabled_features) VALUES (?, ?)""",
+                                   (chat_id, json.dumps(list(features))))
+                else:
+                    if not replace:
+                        old = json.loads(row[0]) if row[0] else []
+                        features = old + [f for f in features if f not in old]
+                    cursor.execute("""UPDATE features SET enabled_features=? WHERE chat_id=?""",
+                                   (json.dumps(list(features)), chat_id))
+                self._log_change(cursor, chat_id)
+                count += 1
+            conn.commit()
+        finally:
+            conn.close()
+        return count
+
+    def get_version(self) -> int:
+        """
+        :return: int: Version of the last change in the changelog
+        """
+        conn = sqlite3.connect(self._db_file)
+        cursor = conn.cursor()
+        cursor.execute("""SELECT MAX(version) FROM changelog""")
+        version = cursor.fetchone()[0]
+        conn.close()
+        return version or 0
+
+    def get_changes_since(self, version: int, exclude_source=None):
+        """
+        :param version: int: Version returned by get_version() or a previous call
+        :param exclude_source: str: Ignore changes made by this source
+        :return: tuple(int: new version, set of changed chat ids)
+        """
+        conn = sqlite3.connect(self._db_file)
+        cursor = conn.cursor()
+        cursor.execute("""SELECT version, chat_id, source FROM changelog WHERE version > ? ORDER BY version""",
+                       (version,))
+        chats = set()
+        for version, chat_id, source in cursor:
+            if source != exclude_source:
+                chats.add(chat_id)
+        conn.close()
+        return version, chats
+
+    def prune_changelog(self, version: int) -> int:
+        """
+        Deletes changes older than `version`, the change with this version is kept so that get_version() doesn't go back
+        :param version: int: Oldest version that is still read with get_changes_since(), e.g. the snapshot's
+        :return: int: Number of deleted changes
+        """
+        conn = sqlite3.connect(self._db_file)
+        cursor = conn.cursor()
+        cursor.execute("""DELETE FROM changelog WHERE version < ?""", (version,))
+        count = cursor.rowcount
+        conn.commit()
+        conn.close()
+        return count
+
+    def set_state(self, key: str, value):
+        """
+        Saves a JSON-serializable value for the next process, e.g. Long Poll state on shutdown
+        """
+        conn = sqlite3.connect(self._db_file)
+        cursor = conn.cursor()
+        cursor.execute("""INSERT OR REPLACE INTO state (key, value) VALUES (?, ?)""", (key, json.dumps(value)))
+        conn.commit()
+        conn.close()
+
+    def pop_state(self, key: str):
+        """
+        :return: value saved with set_state() or None, the value is removed so it is used only once
+        """
+        conn = sqlite3.connect(self._db_file)
+        cursor = conn.cursor()
+        cursor.execute("""SELECT value FROM state WHERE key=?""", (key,))
+        row = cursor.fetchone()
+        cursor.execute("""DELETE FROM state WHERE key=?""", (key,))
+        conn.commit()
+        conn.close()
+        return json.loads(row[0]) if row else None
+
+    def get_job_state(self, job_id: str):
+        """
+        :return: dict: {'last_run': timestamp, 'duration': seconds, 'error': str or None} or None if the job never ran
+        """
+        conn = sqlite3.connect(self._db_file)
+        cursor = conn.cursor()
+        cursor.execute("""SELECT last_run, duration, error FROM jobs WHERE id=?""", (job_id,))
+        row = cursor.fetchone()
+        conn.close()
+        if row is None:
+            return None
+        return {'last_run': row[0], 'duration': row[1], 'error': row[2]}
+
+    def save_job_state(self, job_id: str, last_run: float, duration: float, error=None):
+        conn = sqlite3.connect(self._db_file)
+        cursor = conn.cursor()
+        cursor.execute("""INSERT OR REPLACE INTO jobs (id, last_run, duration, error) VALUES (?, ?, ?, ?)""",
+                       (job_id, last_run, duration, error))
         conn.commit()
         conn.close()
@@ -0,0 +1,86 @@
+from array import array
+import sys
+import time
+
+from ubotvk.metrics import metrics
+
+
+def _key(peer_id, message_id) -> int:
+    # Fits in a signed 64-bit array item, message ids are below 2 ** 32
+    return ((peer_id << 32) + message_id) % (1 << 63)
+
+
+class DedupWindow:
+    """
+    Remembers the last `capacity` (peer_id, message_id) pairs for `ttl` seconds, to skip messages delivered twice.
+    Keys and times are kept in fixed-size arrays used as a ring buffer, with a dict from key to its slot,
+    so memory doesn't grow past `capacity` entries. Not thread-safe, it's used only in the thread that submits updates
+    """
+
+    def __init__(self, capacity=10000, ttl=3600, clock=time.time):
+        """
+        :param capacity: int: Number of remembered messages
+        :param ttl: float: Seconds a message is remembered
+        :param clock: function that returns current time, wall clock so that dump() can be loaded by another process
+        """
+        self.capacity = capacity
+        self.ttl = ttl
+        self._clock = clock
+        self._keys = array('q', [0]) * capacity
+        self._times = array('d', [0.0]) * capacity
+        self._slots = {}
+        self._next = 0
+
+    def seen(self, peer_id, message_id) -> bool:
+        """
+        Checks the message and remembers it
+        :return: bool: True if the message was seen in the last `ttl` seconds
+        """
+        key = _key(peer_id, message_id)
+        now = self._clock()
+        slot = self._slots.get(key)
+        if slot is not None and now - self._times[slot] < self.ttl:
+            metrics.incr('dedup.duplicates')
+            return True
+        self._remember(key, now)
+        return False
+
+    def forget(self, peer_id, message_id):
+        """
+        Makes the message new again, e.g. when it was submitted but not handled
+        """
+        self._slots.pop(_key(peer_id, message_id), None)
+
+    def _remember(self, key, at):
+        slot = self._next
+        old_key = self._keys[slot]
+        if self._slots.get(old_key) == slot:
+            del self._slots[old_key]
+        self._keys[slot] = key
+        self._times[slot] = at
+        self._slots[key] = slot
+        self._next = (slot + 1) % self.capacity
+
+    def dump(self) -> list:
+        """
+        :return: list of [key, time] of messages that are not expired, oldest first
+        """
+        now = self._clock()
+        order = sorted(self._slots.values(), key=lambda slot: self._times[slot])
+        return [[self._keys[slot], self._times[slot]] for slot in order if now - self._times[slot] < self.ttl]
+
+    def load(self, items):
+        """
+        :param items: list returned by dump()
+        """
+        for key, at in items[-self.capacity:]:
+            self._remember(key, at)
+
+    def memory_usage(self) -> int:
+        """
+        :return: int: Approximate size in bytes
+        """
+        return sys.getsizeof(self._keys) + sys.getsizeof(self._times) + sys.getsizeof(self._slots)
+
+    def __len__(self):
+        return len(self._slots)
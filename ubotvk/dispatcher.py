@@ -0,0 +1,230 @@
+from collections import OrderedDict, deque
+import threading
+import time
+
+from ubotvk.metrics import metrics
+
+
+class FairQueue:
+    """
+    Per-chat queues served in weighted round robin: on its turn a chat gives up to `weight` items (1 by default),
+    so a chat with a long queue can't delay the others by more than one turn.
+
+    When there are `max_backlog` items queued, new items from chats that have more than their fair share
+    of the backlog are rejected. Priority items are never rejected
+    """
+
+    def __init__(self, max_backlog=1000, weights=None):
+        self.max_backlog = max_backlog
+        self.weights = weights or {}
+        self._queues = {}
+        self._active = deque()  # Chats with non-empty queues in serving order
+        self._served = 0        # Items given by the chat at the head of self._active on its current turn
+        self._length = 0
+
+    def put(self, chat_id, item, priority=False) -> bool:
+        """
+        :return: bool: False if the item was rejected
+        """
+        queue = self._queues.get(chat_id)
+        if not priority and self._length >= self.max_backlog:
+            fair_share = self._length / max(len(self._active), 1)
+            if queue is not None and len(queue) >= fair_share or self._length >= 2 * self.max_backlog:
+                return False
+
+        if queue is None:
+            queue = self._queues[chat_id] = deque()
+            self._active.append(chat_id)
+
+        queue.append(item)
+        self._length += 1
+        return True
+
+    def get(self):
+        """
+        :return: next item or None if the queue is empty
+        """
+        if not self._active:
+            return None
+
+        chat_id = self._active[0]
+        queue = self._queues[chat_id]
+        item = queue.popleft()
+        self._length -= 1
+        self._served += 1
+
+        if not queue:
+            del self._queues[chat_id]
+            self._active.popleft()
+            self._served = 0
+        elif self._served >= self.weights.get(chat_id, 1):
+            self._active.rotate(-1)
+            self._served = 0
+        return item
+
+    def __len__(self):
+        return self._length
+
+
+class Dispatcher:
+    """
+    Calls the handler with updates in a separate thread.
+    Updates go through deduplication, flood control and a FairQueue before the handler, so that a spamming chat
+    doesn't delay the others: messages over per-chat and per-user limits are dropped
+    and chats take turns when updates come faster than they are handled.
+
+    All handler calls and functions passed to call() run in the same thread, one at a time.
+    If the handler raises, the exception is raised again by the next submit() in the caller's thread
+    """
+
+    def __init__(self, handler, flood_control=None, max_backlog=1000, weights=None, is_priority=None, dedup=None):
+        """
+        :param handler: function that takes an Update
+        :param flood_control: FloodControl or None to accept all updates
+        :param dedup: DedupWindow to drop new messages that were already submitted, or None
+        :param max_backlog: int: Load shedding starts when this many updates are queued
+        :param weights: dict: {chat_id: number of updates the chat gives on its turn}
+        :param is_priority: function that takes an Update and returns True if it must not be limited or shed
+        """
+        self.handler = handler
+        self.flood_control = flood_control
+        self.dedup = dedup
+        self.is_priority = is_priority or (lambda update: False)
+        self._queue = FairQueue(max_backlog=max_backlog, weights=weights)
+        self._calls = deque()
+        self._condition = threading.Condition()
+        self._thread = None
+        self._running = False
+        self._busy = False
+        self._error = None
+        self._accepted = 0
+        self._pending = OrderedDict()  # {number: update} of accepted updates that are not handled yet
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name='dispatcher', daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        """
+        Handles everything that is queued and stops the thread
+        """
+        with self._condition:
+            self._running = False
+            self._condition.notify_all()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def configure(self, max_backlog=None, weights=None):
+        with self._condition:
+            if max_backlog is not None:
+                self._queue.max_backlog = max_backlog
+            if weights is not None:
+                self._queue.weights = weights
+
+    def is_alive(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def submit(self, update) -> bool:
+        """
+        :return: bool: False if the update was dropped
+        """
+        self.raise_error()
+
+        if update.code == 4 and self.dedup is not None and update.message_id is not None:
+            if self.dedup.seen(update.peer_id, update.message_id):
+                return False
+
+        priority = self.is_priority(update)
+        if update.code == 4 and not priority and self.flood_control is not None:
+            if not self.flood_control.allow(update.chat_id, update.from_id):
+                metrics.incr('dispatch.flood_dropped')
+                return False
+
+        with self._condition:
+            number = self._accepted
+            if not self._queue.put(update.chat_id, (time.perf_counter(), number, update), priority=priority):
+                metrics.incr('dispatch.shed')
+                return False
+            self._pending[number] = update
+            self._accepted += 1
+            metrics.gauge('dispatch.backlog', len(self._queue))
+            self._condition.notify()
+        return True
+
+    def call(self, func, *args):
+        """
+        Runs func in the dispatcher thread before any queued updates
+        """
+        with self._condition:
+            self._calls.append((func, args))
+            self._condition.notify()
+
+    def wait_idle(self, timeout=None) -> bool:
+        """
+        Waits until everything queued is handled
+        :return: bool: False on timeout
+        """
+        with self._condition:
+            return self._condition.wait_for(
+                lambda: not self._queue and not self._calls and not self._busy or self._error is not None, timeout)
+
+    def raise_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def accepted(self) -> int:
+        """
+        :return: int: Number of updates accepted by submit()
+        """
+        with self._condition:
+            return self._accepted
+
+    def handled(self) -> int:
+        """
+        :return: int: All updates before this number (counted as in accepted()) are handled
+        """
+        with self._condition:
+            return next(iter(self._pending)) if self._pending else self._accepted
+
+    def pending(self) -> list:
+        """
+        :return: list of accepted updates that are not handled yet, in order of submission
+        """
+        with self._condition:
+            return list(self._pending.values())
+
+    def __len__(self):
+        return len(self._queue)
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while self._running and not self._calls and not self._queue:
+                    self._condition.wait()
+                number = None
+                if self._calls:
+                    func, args = self._calls.popleft()
+                elif self._queue:
+                    queued_at, number, update = self._queue.get()
+                    func, args = self.handler, (update,)
+                    metrics.timing('dispatch.wait', time.perf_counter() - queued_at)
+                else:
+                    return  # Stopped and nothing left to do
+                self._busy = True
+
+            try:
+                func(*args)
+            except Exception as err:
+                with self._condition:
+                    self._error = err
+                    self._busy = False
+                    self._pending.pop(number, None)
+                    self._condition.notify_all()
+                return
+
+            with self._condition:
+                self._busy = False
+                self._pending.pop(number, None)
+                self._condition.notify_all()
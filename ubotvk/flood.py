@@ -0,0 +1,93 @@
+import sys
+import time
+
+
+class TokenBucket:
+    """
+    Allows `rate` events per second on average and bursts of up to `capacity` events
+    """
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+
+    def __init__(self, rate, capacity, now):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = now
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def consume(self, now, amount=1) -> bool:
+        self.refill(now)
+        if self.tokens >= amount:
+            self.tokens -= amount
+            return True
+        return False
+
+
+class FloodControl:
+    """
+    Per-chat and per-user token buckets. An event is allowed only if both buckets have a token.
+    Buckets that were refilled to capacity are forgotten, so memory is only used by recently active chats and users
+    """
+
+    PRUNE_EVERY = 10000     # Calls of allow() between removals of full buckets
+
+    def __init__(self, chat_rate=1.0, chat_burst=20, user_rate=0.5, user_burst=10, clock=time.monotonic):
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.user_rate = user_rate
+        self.user_burst = user_burst
+        self._clock = clock
+        self._chats = {}
+        self._users = {}
+        self._calls = 0
+
+    def configure(self, chat_rate, chat_burst, user_rate, user_burst):
+        """
+        Changes the limits, all buckets start full with the new limits
+        """
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.user_rate = user_rate
+        self.user_burst = user_burst
+        self._chats, self._users = {}, {}
+
+    def allow(self, chat_id, user_id) -> bool:
+        now = self._clock()
+        self._calls += 1
+        if self._calls % self.PRUNE_EVERY == 0:
+            self.prune(now)
+
+        chat = self._chats.get(chat_id)
+        if chat is None:
+            chat = self._chats[chat_id] = TokenBucket(self.chat_rate, self.chat_burst, now)
+        user = self._users.get(user_id)
+        if user is None:
+            user = self._users[user_id] = TokenBucket(self.user_rate, self.user_burst, now)
+
+        chat.refill(now)
+        user.refill(now)
+        if chat.tokens >= 1 and user.tokens >= 1:
+            chat.tokens -= 1
+            user.tokens -= 1
+            return True
+        return False
+
+    def prune(self, now=None):
+        now = self._clock() if now is None else now
+        for buckets in (self._chats, self._users):
+            for key in [key for key, bucket in buckets.items()
+                        if bucket.tokens + (now - bucket.updated) * bucket.rate >= bucket.capacity]:
+                del buckets[key]
+
+    def memory_usage(self) -> int:
+        """
+        :return: int: Approximate size in bytes, buckets are not iterated so it can be called from any thread
+        """
+        bucket = sys.getsizeof(TokenBucket(0, 0, 0)) + sys.getsizeof(0.0) * 2
+        return sys.getsizeof(self._chats) + sys.getsizeof(self._users) + len(self) * bucket
+
+    def __len__(self):
+        return len(self._chats) + len(self._users)
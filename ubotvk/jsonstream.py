@@ -0,0 +1,131 @@
+import codecs
+import json
+
+try:    # Faster decoder for responses that arrive in a single chunk, stdlib json is used if it's not installed
+    import orjson
+    loads = orjson.loads
+    BACKEND = 'orjson'
+except ImportError:
+    loads = json.loads
+    BACKEND = 'json'
+
+
+_WHITESPACE = ' \t\r\n'
+_raw_decode = json.JSONDecoder().raw_decode
+
+COMPACT_AFTER = 65536
+
+
+class LongPollStream:
+    """
+    Incrementally decodes Long Poll response {"ts": 00000000, "updates": [[...], [...]]}
+    Iterating over it yields every update as soon as it was received,
+    all other keys of the response ("ts", "failed", ...) are available in `fields` once iteration is over.
+
+    A response that fits in a single chunk is decoded at once with `loads`,
+    longer responses are decoded update by update with the C scanner of stdlib json
+    """
+
+    def __init__(self, chunks):
+        """
+        :param chunks: iterable of bytes or str, e.g. requests.Response.iter_content()
+        """
+        self._chunks = iter(chunks)
+        self._decoder = codecs.getincrementaldecoder('utf-8')()
+        self._buf = ''
+        self._pos = 0
+        self.fields = {}
+
+    def __iter__(self):
+        if not self._fill():
+            raise ValueError('Empty Long Poll response')
+        if not self._fill():    # Whole response is already here
+            self.fields = loads(self._buf)
+            yield from self.fields.pop('updates', [])
+            return
+
+        self._expect('{')
+        while True:
+            char = self._next_char()
+            if char == '}':
+                self._pos += 1
+                return
+            if char == ',':
+                self._pos += 1
+                continue
+
+            key = self._decode_value()
+            self._expect(':')
+
+            if key == 'updates' and self._next_char() == '[':
+                self._pos += 1
+                yield from self._iter_array()
+            else:
+                self.fields[key] = self._decode_value()
+
+    def _iter_array(self):
+        while True:
+            char = self._next_char()
+            if char == ']':
+                self._pos += 1
+                return
+            if char == ',':
+                self._pos += 1
+                continue
+            yield self._decode_value()
+
+    def _fill(self) -> bool:
+        """
+        Appends the next chunk to the buffer
+        :return: False if the response is over
+        """
+        for chunk in self._chunks:
+            if isinstance(chunk, bytes):
+                chunk = self._decoder.decode(chunk)
+            if chunk:
+                self._buf += chunk
+                return True
+        return False
+
+    def _next_char(self) -> str:
+        """
+        Skips whitespace
+        :return: str: First non-whitespace character, it is not consumed
+        """
+        while True:
+            while self._pos < len(self._buf) and self._buf[self._pos] in _WHITESPACE:
+                self._pos += 1
+            if self._pos < len(self._buf):
+                return self._buf[self._pos]
+            if not self._fill():
+                raise ValueError('Unexpected end of Long Poll response')
+
+    def _expect(self, char):
+        if self._next_char() != char:
+            raise ValueError('Expected "{}" at position {} of Long Poll response'.format(char, self._pos))
+        self._pos += 1
+
+    def _decode_value(self):
+        """
+        Decodes the JSON value that starts at the current position, reading more chunks until it is complete
+        """
+        first = self._next_char()
+        if self._pos > COMPACT_AFTER:
+            self._buf = self._buf[self._pos:]
+            self._pos = 0
+
+        # A number at the end of the buffer may continue in the next chunk
+        scalar = first not in '[{"'
+        while True:
+            try:
+                value, end = _raw_decode(self._buf, self._pos)
+            except json.JSONDecodeError:
+                if not self._fill():
+                    raise
+                continue
+
+            if scalar and end == len(self._buf) and self._fill():
+                continue
+
+            self._pos = end
+            return value
@@ -0,0 +1,130 @@
+import atexit
+import copy
+import logging
+import logging.handlers
+import pathlib
+import queue
+
+
+FORMAT = '%(asctime)s - %(levelname)s - %(funcName)s - %(message)s'
+
+_listener = None
+
+
+class Event:
+    """
+    Structured log message. Fields are only rendered when a handler actually emits the record,
+    so passing an Event to a disabled log level costs one object allocation.
+
+    logging.info(Event('chat_added', chat_id=123))  ->  "chat_added chat_id=123"
+    """
+    __slots__ = ('name', 'fields')
+
+    def __init__(self, name, **fields):
+        self.name = name
+        self.fields = fields
+
+    def __str__(self):
+        return ' '.join([self.name] + ['{}={}'.format(key, value) for key, value in self.fields.items()])
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Passes only every n-th record of each sampled event.
+    A record is sampled if it was logged with extra={'sample': '<event name>'}, other records always pass.
+    """
+
+    def __init__(self, every=1):
+        super().__init__()
+        self.every = max(int(every), 1)
+        self._counters = {}
+
+    def filter(self, record):
+        key = getattr(record, 'sample', None)
+        if key is None or self.every == 1:
+            return True
+
+        count = self._counters.get(key, 0)
+        self._counters[key] = count + 1
+        return count % self.every == 0
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler that renders only the message in the calling thread, because the caller may change the arguments
+    after logging. The rest of the formatting (time, traceback) is left to the handlers of the QueueListener
+    """
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+
+def setup(log_dir=None, level='WARNING', async_file=True, sample_every=1):
+    """
+    Configures the root logger
+    :param log_dir: str: Directory for ubotvk.log, logs are written to stderr if None
+    :param level: str: Name of the log level
+    :param async_file: bool: Write the log file from a separate thread, so that logging never blocks on disk IO
+    :param sample_every: int: Only every n-th record of high-volume events is written
+    :return: logging.handlers.QueueListener if the file is written asynchronously, else None
+    """
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+        handler.close()
+    for log_filter in root.filters[:]:
+        root.removeFilter(log_filter)
+
+    root.setLevel(logging.getLevelName(level))
+    root.addFilter(SamplingFilter(sample_every))
+
+    if log_dir:     # Write to file if specified
+        pathlib.Path(log_dir).mkdir(parents=True, exist_ok=True)
+        handler = logging.FileHandler(str(pathlib.Path(log_dir) / 'ubotvk.log'), mode='a')
+    else:   # Write to stderr if not
+        handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter(FORMAT))
+
+    if not (log_dir and async_file):
+        root.addHandler(handler)
+        return None
+
+    log_queue = queue.Queue(-1)
+    root.addHandler(DeferredQueueHandler(log_queue))
+    _listener = logging.handlers.QueueListener(log_queue, handler, respect_handler_level=True)
+    _listener.start()
+    return _listener
+
+
+def configure(level=None, sample_every=None):
+    """
+    Changes the level and sampling of the root logger set up with setup(), keeping its handlers
+    """
+    root = logging.getLogger()
+    if level is not None:
+        root.setLevel(logging.getLevelName(level))
+    if sample_every is not None:
+        for log_filter in root.filters:
+            if isinstance(log_filter, SamplingFilter):
+                log_filter.every = max(int(sample_every), 1)
+
+
+def shutdown():
+    """
+    Writes out everything that is still queued for the log file
+    """
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+atexit.register(shutdown)
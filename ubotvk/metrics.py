@@ -0,0 +1,69 @@
+from contextlib import contextmanager
+import threading
+import time
+
+
+class Metrics:
+    """
+    Process-wide counters, gauges and timings.
+    Names are dotted strings, e.g. 'long_poll.reconnects'
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._gauges = {}
+        self._timings = {}
+
+    def incr(self, name, value=1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def gauge(self, name, value):
+        self._gauges[name] = value
+
+    def timing(self, name, seconds):
+        """
+        Records a duration, count, total and max are kept for every name
+        """
+        with self._lock:
+            count, total, maximum = self._timings.get(name, (0, 0.0, 0.0))
+            self._timings[name] = (count + 1, total + seconds, max(maximum, seconds))
+
+    @contextmanager
+    def timer(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timing(name, time.perf_counter() - start)
+
+    def get(self, name, default=0):
+        with self._lock:
+            if name in self._counters:
+                return self._counters[name]
+            if name in self._timings:
+                return self._timings[name]
+            return self._gauges.get(name, default)
+
+    def snapshot(self) -> dict:
+        """
+        :return: dict: {name: value}, timings are reported as name.count, name.avg and name.max
+        """
+        with self._lock:
+            snapshot = dict(self._counters)
+            snapshot.update(self._gauges)
+            for name, (count, total, maximum) in self._timings.items():
+                snapshot[name + '.count'] = count
+                snapshot[name + '.avg'] = round(total / count, 6) if count else 0
+                snapshot[name + '.max'] = round(maximum, 6)
+        return snapshot
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._gauges.clear()
+            self._timings.clear()
+
+
+metrics = Metrics()
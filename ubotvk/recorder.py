@@ -0,0 +1,126 @@
+import gzip
+import hashlib
+import hmac
+import json
+import logging
+import os
+import re
+import time
+
+from ubotvk.update import CHAT_PEER_OFFSET, MESSAGE_CODES
+
+FORMAT_VERSION = 1
+
+MENTION = re.compile(r'\[(id|club)(\d+)\|[^\]]*\]')
+COMMAND_PREFIXES = ('/', '!')
+# Keys of "extra" that are kept by Anonymizer, ids in them are replaced
+EXTRA_IDS = ('from', 'source_mid')
+EXTRA_KEPT = ('source_act', 'emoji')
+
+
+class Anonymizer:
+    """
+    Replaces user and chat ids with keyed hashes and text with placeholders.
+    The same id always gets the same replacement within one Anonymizer, so chats and users stay distinguishable.
+
+    Text of commands (messages that start with '/', '!', a mention or one of `commands`) is kept
+    with mentioned ids replaced, in other messages every non-space character is replaced with 'x',
+    so only lengths are kept.
+    Attachments are reduced to their types, other events to their codes
+    """
+
+    def __init__(self, salt=None, commands=()):
+        """
+        :param commands: iterable of command words that features accept without a prefix, e.g. 'pidor'
+        """
+        self._salt = salt if salt is not None else os.urandom(16)
+        self._commands = {command.lower() for command in commands}
+
+    def user_id(self, user_id: int) -> int:
+        digest = hmac.new(self._salt, str(abs(user_id)).encode('ascii'), hashlib.sha256).hexdigest()
+        hashed = int(digest[:12], 16) % 10 ** 9 + 1
+        return -hashed if user_id < 0 else hashed
+
+    def peer_id(self, peer_id: int) -> int:
+        if peer_id > CHAT_PEER_OFFSET:
+            return CHAT_PEER_OFFSET + self.user_id(peer_id - CHAT_PEER_OFFSET) % 10 ** 6 + 1
+        return self.user_id(peer_id)
+
+    def text(self, text: str) -> str:
+        stripped = text.lstrip()
+        words = stripped.split()
+        if stripped.startswith(COMMAND_PREFIXES) or MENTION.match(stripped) or \
+                (words and words[0].lower() in self._commands):
+            return MENTION.sub(self._mention, text)
+        return re.sub(r'\S', 'x', text)
+
+    def _mention(self, match) -> str:
+        if match.group(1) == 'club':
+            return '[club{}|group]'.format(-self.user_id(-int(match.group(2))))
+        return '[id{}|user]'.format(self.user_id(int(match.group(2))))
+
+    def update(self, raw: list) -> list:
+        if raw[0] not in MESSAGE_CODES:
+            return raw[:1]
+
+        raw = list(raw)
+        raw[3] = self.peer_id(int(raw[3]))
+        if len(raw) > 5 and raw[5]:
+            raw[5] = self.text(raw[5])
+        if len(raw) > 6 and raw[6]:
+            extra = {key: raw[6][key] for key in EXTRA_KEPT if key in raw[6]}
+            for key in EXTRA_IDS:
+                if raw[6].get(key):
+                    extra[key] = str(self.user_id(int(raw[6][key])))
+            raw[6] = extra
+        if len(raw) > 7 and raw[7]:
+            raw[7] = {key: value for key, value in raw[7].items() if re.match(r'attach\d+_type$', key)}
+        return raw
+
+
+class Recorder:
+    """
+    Writes updates to a gzip-compressed file, one JSON line per update: [time received, raw update].
+    The first line is a header: {"version": ..., "vk_id": ..., "anonymized": ...}
+    """
+
+    def __init__(self, path, vk_id, anonymize=False, commands=()):
+        """
+        :param path: str: File is overwritten if it exists
+        :param vk_id: int: Id of the bot, replay uses it to recognize mentions of the bot
+        :param anonymize: bool: Replace ids and text, see Anonymizer
+        :param commands: iterable of command words kept by Anonymizer
+        """
+        self.path = path
+        self.anonymizer = Anonymizer(commands=commands) if anonymize else None
+        self._file = gzip.open(path, 'wt', encoding='utf-8')
+        self._write({'version': FORMAT_VERSION, 'anonymized': anonymize,
+                     'vk_id': self.anonymizer.user_id(vk_id) if anonymize else vk_id})
+        logging.info('Recording updates to %s', path)
+
+    def write(self, raw: list):
+        if self.anonymizer is not None:
+            raw = self.anonymizer.update(raw)
+        self._write([round(time.time(), 3), raw])
+
+    def _write(self, item):
+        self._file.write(json.dumps(item, ensure_ascii=False) + '\n')
+
+    def close(self):
+        self._file.close()
+
+
+def read(path):
+    """
+    Reads a file written by Recorder. A file that was not closed properly is read up to the last complete line
+    :return: generator of the header (dict) followed by [time received, raw update] lists
+    """
+    with gzip.open(path, 'rt', encoding='utf-8') as file:
+        try:
+            for line in file:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    logging.warning('Skipped a broken line in %s', path)
+        except EOFError:
+            logging.warning('%s ends unexpectedly, the recorder was not stopped properly', path)
@@ -0,0 +1,218 @@
+"""
+Feeds updates recorded by ubotvk.recorder to a Bot with VK API stubbed out and reports how fast they were handled:
+
+    $ python -m ubotvk.replay data/records/updates-20181001-120000.jsonl.gz --speed 10
+"""
+import argparse
+from collections import Counter
+import json
+import os
+import shutil
+import tempfile
+import time
+
+from ubotvk import recorder
+from ubotvk.config import Config
+from ubotvk.flood import FloodControl
+from ubotvk.metrics import metrics
+from ubotvk.update import Update
+
+
+class StubVkApi:
+    """
+    Answers every VK API method without network requests, optionally after `latency` seconds.
+    Counts calls by method name in self.calls
+    """
+
+    def __init__(self, vk_id=1, latency=0.0, members=10):
+        """
+        :param vk_id: int: Id returned by users.get() without arguments
+        :param latency: float: Seconds every call takes
+        :param members: int: Number of members returned by messages.getConversationMembers
+        """
+        self.vk_id = vk_id
+        self.latency = latency
+        self.members = members
+        self.calls = Counter()
+
+    def __getattr__(self, group):
+        if group.startswith('_'):
+            raise AttributeError(group)
+        return _StubMethodGroup(self, group)
+
+    def call(self, method, params):
+        self.calls[method] += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+        if method == 'users.get':
+            ids = str(params.get('user_ids', self.vk_id)).split(',')
+            return [self._profile(int(user_id)) for user_id in ids]
+        if method == 'messages.getConversationMembers':
+            return {'items': [], 'profiles': [self._profile(user_id) for user_id in range(1, self.members + 1)]}
+        if method == 'messages.getLongPollServer':
+            return {'key': 'replay', 'server': 'replay', 'ts': 1}
+        return 1
+
+    @staticmethod
+    def _profile(user_id):
+        return {'id': user_id, 'first_name': 'User', 'last_name': str(user_id)}
+
+
+class _StubMethodGroup:
+    def __init__(self, api, group):
+        self._api = api
+        self._group = group
+
+    def __getattr__(self, method):
+        if method.startswith('_'):
+            raise AttributeError(method)
+        return lambda **params: self._api.call('{}.{}'.format(self._group, method), params)
+
+
+class _TimedFeature:
+    """
+    Wraps a feature and records how long its calls take, other attributes (hooks, triggered_by) are passed through
+    """
+
+    def __init__(self, feature, samples: list):
+        self._feature = feature
+        self._samples = samples
+
+    def __getattr__(self, name):
+        return getattr(self._feature, name)
+
+    def __call__(self, update):
+        start = time.perf_counter()
+        try:
+            self._feature(update)
+        finally:
+            self._samples.append(time.perf_counter() - start)
+
+
+def stats(samples) -> dict:
+    """
+    :param samples: list of durations in seconds
+    :return: dict: count and avg, p50, p95, max in milliseconds
+    """
+    samples = sorted(samples)
+    if not samples:
+        return {'count': 0}
+
+    def percentile(p):
+        return round(samples[min(int(len(samples) * p), len(samples) - 1)] * 1000, 3)
+
+    return {'count': len(samples), 'avg': round(sum(samples) / len(samples) * 1000, 3),
+            'p50': percentile(0.5), 'p95': percentile(0.95), 'max': round(samples[-1] * 1000, 3)}
+
+
+def replay(path, speed=None, vk_latency=0.0, members=10) -> dict:
+    """
+    Creates a Bot in a temporary directory (so that its databases are empty) and submits recorded updates
+    to its dispatcher with the recorded intervals divided by `speed`
+    :param path: str: File written by ubotvk.recorder.Recorder
+    :param speed: float: 1 for real time, 10 for 10 times faster, None for as fast as possible
+    :param vk_latency: float: Seconds every VK API call takes
+    :param members: int: Number of members in every chat
+    :return: dict: Report, see format_report()
+    """
+    from ubotvk.bot import Bot
+
+    records = recorder.read(path)
+    header = next(records)
+    vk_api = StubVkApi(vk_id=header['vk_id'], latency=vk_latency, members=members)
+
+    overrides = {'DEBUG': False, 'RECORD_DIR': None, 'SNAPSHOT_FILE': 'data/bot.snapshot', 'SNAPSHOT_INTERVAL': 0}
+    saved = {name: getattr(Config, name, None) for name in overrides}
+    cwd = os.getcwd()
+    workdir = tempfile.mkdtemp(prefix='ubotvk-replay-')
+    os.makedirs(os.path.join(workdir, 'data'))
+    bot = None
+    try:
+        for name, value in overrides.items():
+            setattr(Config, name, value)
+        os.chdir(workdir)
+
+        bot = Bot(vk_api=vk_api)
+        feature_samples = {feature: [] for feature in bot.features}
+        bot.features = {feature: _TimedFeature(bot.features[feature], feature_samples[feature])
+                        for feature in bot.features}
+        handler_samples = []
+        bot.dispatcher.handler = _TimedFeature(bot.dispatcher.handler, handler_samples)
+        # Flood control runs on the recorded time, so a faster replay doesn't drop more updates than the bot did
+        timeline = [0.0]
+        bot.dispatcher.flood_control = FloodControl(
+            chat_rate=Config.FLOOD_CHAT_RATE, chat_burst=Config.FLOOD_CHAT_BURST,
+            user_rate=Config.FLOOD_USER_RATE, user_burst=Config.FLOOD_USER_BURST, clock=lambda: timeline[0])
+        metrics.reset()
+
+        bot.dispatcher.start()
+        count = 0
+        first = None
+        start = time.perf_counter()
+        for received, raw in records:
+            first = received if first is None else first
+            timeline[0] = received - first
+            if speed:
+                delay = (received - first) / speed - (time.perf_counter() - start)
+                if delay > 0:
+                    time.sleep(delay)
+            bot.dispatcher.submit(Update.from_raw(raw))
+            count += 1
+        bot.dispatcher.wait_idle()
+        bot.dispatcher.raise_error()
+        elapsed = time.perf_counter() - start
+        wait_count, wait_total, wait_max = metrics.get('dispatch.wait', (0, 0.0, 0.0))
+    finally:
+        if bot is not None:
+            bot.shutdown()
+        os.chdir(cwd)
+        for name, value in saved.items():
+            setattr(Config, name, value)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    return {
+        'updates': count,
+        'flood_dropped': metrics.get('dispatch.flood_dropped'),
+        'shed': metrics.get('dispatch.shed'),
+        'seconds': round(elapsed, 3),
+        'throughput': round(count / elapsed, 1) if elapsed else None,
+        'handler': stats(handler_samples),
+        'queue_wait': {'count': wait_count, 'avg': round(wait_total / wait_count * 1000, 3) if wait_count else 0,
+                       'max': round(wait_max * 1000, 3)},
+        'features': {feature: stats(samples) for feature, samples in feature_samples.items()},
+        'vk_calls': dict(vk_api.calls),
+    }
+
+
+def format_report(report: dict) -> str:
+    lines = ['{updates} updates in {seconds} s, {throughput} updates/s, '
+             '{flood_dropped} dropped by flood control, {shed} shed'.format(**report),
+             'Queue wait, ms: avg {avg}, max {max}'.format(**report['queue_wait'])]
+    for name, timing in [('handler', report['handler'])] + sorted(report['features'].items()):
+        if timing['count']:
+            lines.append('{:<20} {count:>8} calls, ms: avg {avg}, p50 {p50}, p95 {p95}, max {max}'
+                         .format(name, **timing))
+        else:
+            lines.append('{:<20} {:>8} calls'.format(name, 0))
+    lines.append('VK API calls: ' + ', '.join('{} {}'.format(method, count)
+                                              for method, count in sorted(report['vk_calls'].items())))
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Replay recorded updates with VK API stubbed out')
+    parser.add_argument('path', help='File written with UBOTVK_RECORD_DIR')
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help='1 for real time (default), 10 for 10 times faster, 0 for as fast as possible')
+    parser.add_argument('--vk-latency', type=float, default=0.0, help='Seconds every VK API call takes')
+    parser.add_argument('--members', type=int, default=10, help='Number of members in every chat')
+    parser.add_argument('--json', action='store_true', help='Print the report as JSON')
+    args = parser.parse_args(argv)
+
+    report = replay(args.path, speed=args.speed or None, vk_latency=args.vk_latency, members=args.members)
+    print(json.dumps(report, indent=2) if args.json else format_report(report))
+
+
+if __name__ == '__main__':
+    main()
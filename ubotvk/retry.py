@@ -0,0 +1,77 @@
+import random
+import time
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class Backoff:
+    """
+    Exponential backoff with full jitter: n-th delay is a random number between 0 and min(cap, base * 2**n)
+    """
+
+    MAX_EXPONENT = 32   # 2 ** attempt overflows a float after ~1024 attempts
+
+    def __init__(self, base=1.0, cap=60.0):
+        self.base = base
+        self.cap = cap
+        self.attempt = 0
+
+    def next_delay(self) -> float:
+        delay = random.uniform(0, min(self.cap, self.base * 2 ** min(self.attempt, self.MAX_EXPONENT)))
+        self.attempt += 1
+        return delay
+
+    def sleep(self, stop=None) -> float:
+        """
+        :param stop: threading.Event that ends the sleep early when set, or None
+        :return: float: Delay that was chosen
+        """
+        delay = self.next_delay()
+        if stop is None:
+            time.sleep(delay)
+        else:
+            stop.wait(delay)
+        return delay
+
+    def reset(self):
+        self.attempt = 0
+
+
+class CircuitBreaker:
+    """
+    Stops calling a failing function for `reset_timeout` seconds after `failure_threshold` failures in a row.
+    After the timeout one call is let through, it closes the circuit if it succeeds and opens it again if not
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=60.0, clock=time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._clock = clock
+
+    @property
+    def is_open(self) -> bool:
+        return self.opened_at is not None and self._clock() - self.opened_at < self.reset_timeout
+
+    def call(self, func, *args, **kwargs):
+        """
+        :raises CircuitOpenError: if the circuit is open, func is not called in this case
+        """
+        if self.is_open:
+            raise CircuitOpenError('{} is failing, retry in {:.0f} seconds'.format(
+                getattr(func, '__name__', func), self.reset_timeout - (self._clock() - self.opened_at)))
+
+        try:
+            result = func(*args, **kwargs)
+        except Exception:
+            self.failures += 1
+            if self.failures >= self.failure_threshold:
+                self.opened_at = self._clock()
+            raise
+
+        self.failures = 0
+        self.opened_at = None
+        return result
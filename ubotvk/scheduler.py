@@ -0,0 +1,130 @@
+from datetime import datetime, timedelta
+import logging
+import time
+
+from apscheduler.events import EVENT_JOB_ERROR, EVENT_JOB_EXECUTED, EVENT_JOB_MAX_INSTANCES, EVENT_JOB_MISSED
+from apscheduler.executors.pool import ThreadPoolExecutor
+from apscheduler.jobstores.base import JobLookupError
+from apscheduler.schedulers.background import BackgroundScheduler
+from apscheduler.triggers.cron import CronTrigger
+from apscheduler.triggers.interval import IntervalTrigger
+from pytz import utc
+
+from ubotvk.metrics import metrics
+
+
+TRIGGERS = {'cron': CronTrigger, 'interval': IntervalTrigger}
+
+
+class Scheduler:
+    """
+    The bot's only APScheduler instance, features add their jobs to it in register_jobs(scheduler).
+
+    All jobs run in one bounded thread pool, a job never runs concurrently with itself,
+    and runs that were missed (e.g. the pool was busy) are coalesced into one.
+    Start time, duration and error of the last run of every job are saved to the database,
+    so jobs added with catch_up=True run once on start if their run was missed while the bot was down.
+
+    Metrics: scheduler.<job id>.duration, .lag (seconds between scheduled and actual start), .errors, .missed
+    """
+
+    def __init__(self, database=None, max_workers=4, misfire_grace_time=60):
+        """
+        :param database: ubotvk.database.Database to keep job state in, None to not keep it
+        :param max_workers: int: Size of the thread pool shared by all jobs
+        :param misfire_grace_time: int: Seconds a run may be late before it is skipped
+        """
+        self._db = database
+        self._scheduler = BackgroundScheduler(
+            executors={'default': ThreadPoolExecutor(max_workers)},
+            job_defaults={'coalesce': True, 'max_instances': 1, 'misfire_grace_time': misfire_grace_time}
+        )
+        self._scheduler.add_listener(self._on_event,
+                                     EVENT_JOB_EXECUTED | EVENT_JOB_ERROR | EVENT_JOB_MISSED | EVENT_JOB_MAX_INSTANCES)
+        self._started = {}  # {job id: start time of the current run}
+
+    @property
+    def running(self) -> bool:
+        return self._scheduler.running
+
+    def add_job(self, func, trigger='cron', job_id=None, catch_up=False, jitter=None, timezone=None, **trigger_args):
+        """
+        :param func: Function without arguments
+        :param trigger: str: 'cron' or 'interval'
+        :param job_id: str: Name of the job in metrics and in the database, func.__qualname__ by default
+        :param catch_up: bool: Run once on start if the last run was missed
+        :param jitter: int: Start every run up to this many seconds later, so that jobs don't start at the same time
+        :param timezone: tzinfo: Time zone of cron fields, local time zone by default
+        :param trigger_args: Arguments of the trigger, e.g. hour=8 for cron or minutes=15 for interval
+        """
+        job_id = job_id or func.__qualname__
+        if timezone is not None:
+            trigger_args['timezone'] = timezone
+        trigger = TRIGGERS[trigger](jitter=jitter, **trigger_args)
+        self._scheduler.add_job(self._wrap(job_id, func), trigger, id=job_id, name=job_id, replace_existing=True)
+
+        if catch_up and self._missed(job_id, trigger):
+            logging.info('Job %s missed its run, it will run now', job_id)
+            self._scheduler.add_job(self._wrap(job_id, func), 'date', id=job_id + '.catch_up', name=job_id,
+                                    replace_existing=True)
+
+    def remove_job(self, job_id):
+        """
+        Removes the job if it exists, a running job finishes its run
+        """
+        try:
+            self._scheduler.remove_job(job_id)
+        except JobLookupError:
+            pass
+
+    def _missed(self, job_id, trigger) -> bool:
+        if self._db is None:
+            return False
+        state = self._db.get_job_state(job_id)
+        if state is None or state['last_run'] is None:
+            return False    # New job
+        last_run = datetime.fromtimestamp(state['last_run'], utc) + timedelta(seconds=1)
+        next_run = trigger.get_next_fire_time(None, last_run)
+        return next_run is not None and next_run <= datetime.now(utc)
+
+    def _wrap(self, job_id, func):
+        def job():
+            started = time.time()
+            self._started[job_id] = started
+            error = None
+            try:
+                return func()
+            except Exception as err:
+                error = repr(err)
+                raise
+            finally:
+                duration = time.time() - started
+                metrics.timing('scheduler.{}.duration'.format(job_id), duration)
+                if self._db is not None:
+                    self._db.save_job_state(job_id, started, duration, error)
+        return job
+
+    def _on_event(self, event):
+        job_id = event.job_id[:-len('.catch_up')] if event.job_id.endswith('.catch_up') else event.job_id
+        if event.code in (EVENT_JOB_MISSED, EVENT_JOB_MAX_INSTANCES):
+            metrics.incr('scheduler.{}.missed'.format(job_id))
+            logging.warning('Job %s missed its run at %s', job_id, event.scheduled_run_time)
+            return
+
+        started = self._started.pop(job_id, None)
+        if started is not None:
+            metrics.timing('scheduler.{}.lag'.format(job_id), max(started - event.scheduled_run_time.timestamp(), 0))
+        if event.code == EVENT_JOB_ERROR:
+            metrics.incr('scheduler.{}.errors'.format(job_id))
+            logging.error('Job %s failed: %r\n%s', job_id, event.exception, event.traceback)
+
+    def start(self):
+        self._scheduler.start()
+        logging.info('Scheduler started with jobs: %s', ', '.join(job.id for job in self._scheduler.get_jobs()))
+
+    def shutdown(self, wait=True):
+        """
+        :param wait: bool: Wait for running jobs to finish
+        """
+        if self._scheduler.running:
+            self._scheduler.shutdown(wait=wait)
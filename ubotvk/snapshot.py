@@ -0,0 +1,145 @@
+from array import array
+import json
+import logging
+import mmap
+import os
+import struct
+import zlib
+
+
+MAGIC = b'UBSN'
+FORMAT_VERSION = 2
+
+# magic, format version, crc32 of meta, length of meta, number of sections
+_HEADER = struct.Struct('<4sHIII')
+# length of name, number of items, crc32 of items
+_SECTION = struct.Struct('<HQI')
+_ITEM_SIZE = 8  # Items are signed 64-bit integers in native byte order, snapshots are not portable
+
+
+def _padding(offset):
+    return -offset % _ITEM_SIZE
+
+
+def write(path, meta: dict, sections: dict):
+    """
+    Writes a snapshot to a temporary file and renames it to `path`, so readers never see a partial snapshot
+    :param meta: dict: Small JSON-serializable dict, e.g. database version the snapshot was made at
+    :param sections: dict: {str: iterable of ints}
+    """
+    meta = json.dumps(meta).encode('utf-8')
+    body = [meta]
+    offset = _HEADER.size + len(meta)
+    for name, items in sections.items():
+        name = name.encode('utf-8')
+        items = array('q', items).tobytes()
+        header = _SECTION.pack(len(name), len(items) // _ITEM_SIZE, zlib.crc32(items)) + name
+        header += b'\0' * _padding(offset + len(header))
+        body.append(header)
+        body.append(items)
+        offset += len(header) + len(items)
+
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as file:
+        file.write(_HEADER.pack(MAGIC, FORMAT_VERSION, zlib.crc32(meta), len(meta), len(sections)))
+        file.write(b''.join(body))
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(tmp_path, path)
+
+
+class Snapshot:
+    """
+    Read-only memory map of a snapshot file. Sections are memoryviews of the mapped file,
+    nothing is copied until the caller converts them (e.g. with set()).
+    Only meta is checked on open, a section is checked when it is first accessed,
+    so pages of sections that are not used are never read
+    """
+
+    def __init__(self, path):
+        self._file = open(path, 'rb')
+        try:
+            self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:  # Empty file can't be mapped
+            self._file.close()
+            raise
+        self._view = memoryview(self._mmap)
+        self.meta = {}
+        self._sections = {}     # {name: (memoryview of items, crc32)}
+        self._checked = set()
+        try:
+            self._parse()
+        except Exception:
+            self.close()
+            raise
+
+    def _parse(self):
+        if len(self._view) < _HEADER.size:
+            raise ValueError('Snapshot is truncated')
+        magic, version, crc, meta_length, count = _HEADER.unpack_from(self._view)
+        if magic != MAGIC or version != FORMAT_VERSION:
+            raise ValueError('Not a snapshot or unsupported format version {}'.format(version))
+        offset = _HEADER.size
+        meta = bytes(self._view[offset:offset + meta_length])
+        if zlib.crc32(meta) != crc:
+            raise ValueError('Snapshot meta checksum mismatch')
+
+        self.meta = json.loads(meta.decode('utf-8'))
+        offset += meta_length
+        for _ in range(count):
+            name_length, items, crc = _SECTION.unpack_from(self._view, offset)
+            offset += _SECTION.size
+            name = bytes(self._view[offset:offset + name_length]).decode('utf-8')
+            offset += name_length
+            offset += _padding(offset)
+            if offset + items * _ITEM_SIZE > len(self._view):
+                raise ValueError('Snapshot is truncated')
+            self._sections[name] = (self._view[offset:offset + items * _ITEM_SIZE].cast('q'), crc)
+            offset += items * _ITEM_SIZE
+
+    def get(self, name, default=None):
+        """
+        :return: memoryview of the section's items or `default` if there is no such section
+        :raise ValueError: if the section doesn't match its checksum
+        """
+        if name not in self._sections:
+            return default
+        items, crc = self._sections[name]
+        if name not in self._checked:
+            if zlib.crc32(items.cast('B')) != crc:
+                raise ValueError('Snapshot section {} checksum mismatch'.format(name))
+            self._checked.add(name)
+        return items
+
+    def names(self) -> list:
+        return list(self._sections)
+
+    def __contains__(self, name):
+        return name in self._sections
+
+    def close(self):
+        for items, _ in self._sections.values():
+            items.release()
+        self._sections = {}
+        self._view.release()
+        self._mmap.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def read(path):
+    """
+    :return: Snapshot or None if there is no valid snapshot at `path`
+    """
+    try:
+        return Snapshot(path)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError):
+        logging.warning('Snapshot %s is broken, ignoring it', path, exc_info=True)
+        return None
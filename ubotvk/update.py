@@ -0,0 +1,122 @@
+CHAT_PEER_OFFSET = 2000000000
+
+# Long Poll codes of events that carry a whole message. More info: https://vk.com/dev/using_longpoll
+MESSAGE_CODES = (4, 5)
+
+FLAG_OUTBOX = 2
+
+
+def peer_id(chat_id: int) -> int:
+    """
+    :param chat_id: int: Chat id as stored by the bot
+    :return: int: peer_id of the chat for messages.* API methods
+    """
+    return chat_id + CHAT_PEER_OFFSET
+
+
+class Update:
+    """
+    Long Poll event, decoded once from the raw array returned by VK and then passed to every handler.
+
+    For message events (codes 4 and 5) all fields are filled:
+    [4, message_id, flags, peer_id, timestamp, text, extra, attachments]
+    For other events only `code` and `raw` are meaningful.
+
+    chat_id is peer_id without the 2e9 offset (negative for private dialogs),
+    from_id is the id of the message author, action is 'source_act' of service messages
+    """
+    __slots__ = ('code', 'message_id', 'flags', 'peer_id', 'chat_id', 'from_id', 'timestamp',
+                 'text', 'extra', 'attachments', 'action', 'action_member_id', 'raw')
+
+    def __init__(self, code, message_id=None, flags=0, peer_id=None, from_id=None, timestamp=None,
+                 text='', extra=None, attachments=None, raw=None):
+        self.code = code
+        self.message_id = message_id
+        self.flags = flags
+        self.peer_id = peer_id
+        self.chat_id = peer_id - CHAT_PEER_OFFSET if peer_id is not None else None
+        self.timestamp = timestamp
+        self.text = text
+        self.extra = extra or {}
+        self.attachments = attachments or {}
+        self.raw = raw
+
+        if from_id is None and 'from' in self.extra:
+            from_id = int(self.extra['from'])
+        self.from_id = from_id if from_id is not None else peer_id
+
+        self.action = self.extra.get('source_act')
+        self.action_member_id = int(self.extra['source_mid']) if self.extra.get('source_mid') else None
+
+    @classmethod
+    def from_raw(cls, raw: list):
+        """
+        :param raw: list: Update as returned by Long Poll server
+        :return: Update
+        """
+        if raw[0] not in MESSAGE_CODES:
+            return cls(raw[0], raw=raw)
+
+        length = len(raw)
+        return cls(
+            raw[0],
+            message_id=raw[1],
+            flags=int(raw[2]),
+            peer_id=int(raw[3]),
+            timestamp=raw[4] if length > 4 else None,
+            text=raw[5].strip() if length > 5 and raw[5] else '',
+            extra=raw[6] if length > 6 else None,
+            attachments=raw[7] if length > 7 else None,
+            raw=raw
+        )
+
+    @classmethod
+    def from_callback(cls, event: dict):
+        """
+        Converts Callback API message event to the same form as Long Poll message
+        :param event: dict: {"type": "message_new", "object": {...}, "group_id": ..., "secret": ...}
+        :return: Update
+        """
+        message = event['object']
+        extra = {'from': str(message.get('from_id', message['peer_id']))}
+        action = message.get('action')
+        if action:
+            extra['source_act'] = action['type']
+            if 'member_id' in action:
+                extra['source_mid'] = str(action['member_id'])
+
+        attachments = {}
+        for number, attachment in enumerate(message.get('attachments', []), start=1):
+            attachments['attach{}_type'.format(number)] = attachment['type']
+            item = attachment.get(attachment['type'], {})
+            if 'owner_id' in item and 'id' in item:
+                attachments['attach{}'.format(number)] = '{}_{}'.format(item['owner_id'], item['id'])
+
+        outbox = event['type'] == 'message_reply' or message.get('out')
+        return cls(
+            4,
+            message_id=message.get('id'),
+            flags=FLAG_OUTBOX if outbox else 0,
+            peer_id=int(message['peer_id']),
+            timestamp=message.get('date'),
+            text=(message.get('text') or '').strip(),
+            extra=extra,
+            attachments=attachments,
+            raw=message
+        )
+
+    def to_raw(self) -> list:
+        """
+        :return: list: The update as Long Poll returns it, also for updates from Callback API
+        """
+        if isinstance(self.raw, list):
+            return self.raw
+        return [self.code, self.message_id, self.flags, self.peer_id, self.timestamp, self.text,
+                self.extra, self.attachments]
+
+    @property
+    def is_inbox(self) -> bool:
+        return (self.flags & FLAG_OUTBOX) == 0
+
+    def __repr__(self):
+        return 'Update({!r})'.format(self.raw)
@@ -1,17 +1,19 @@
 import re
 
+from ubotvk.config import Config
+
 
 def command_in_string(text: str, commands: list):
     """
     Searches for commands in a string
-    :param text: a string, which contains a mention of the bot ('[id12345|Bot Name]' in text)
+    :param text: a string, which contains a mention of the bot ('[id12345|Bot Name]' or '[club12345|Bot Name]')
     :param commands: commands to find
     :return: normalized list of words if command was found, else None
     """
     assert isinstance(text, str)
     assert not isinstance(commands, str)
 
-    text = re.sub('\[id\d+\|.*\]', '', text)
+    text = re.sub(r'\[(?:id|club)\d+\|[^\]]*\]', '', text)
     lst = text.lower().split()
 
     if lst and len(lst[0]) > 1:
@@ -24,3 +26,43 @@ def command_in_string(text: str, commands: list):
     return None
 
 
+def own_id(vk_api) -> int:
+    """
+    :param vk_api: API session of the bot
+    :return: int: Id of the user the session belongs to, or minus id of the community with Callback API
+    """
+    if Config.CALLBACK_PORT:
+        return -Config.CALLBACK_GROUP_ID
+    return vk_api.users.get()[0]['id']
+
+
+def split_message(text: str, limit=4096) -> list:
+    """
+    Splits text into parts that fit into one VK message, on line breaks where possible
+    :param text: text to split
+    :param limit: max length of one part
+    :return: list of strings
+    """
+    assert limit > 0
+
+    parts = []
+    current = ''
+    for line in text.split('\n'):
+        while len(line) > limit:    # Line doesn't fit even alone
+            if current:
+                parts.append(current)
+                current = ''
+            parts.append(line[:limit])
+            line = line[limit:]
+
+        if not current:
+            current = line
+        elif len(current) + 1 + len(line) <= limit:
+            current += '\n' + line
+        else:
+            parts.append(current)
+            current = line
+
+    if current:
+        parts.append(current)
+    return parts